@@ -2,6 +2,7 @@
 
 import sys
 
+import click
 from flask.cli import FlaskGroup
 
 from src import create_app
@@ -9,5 +10,19 @@ from src import create_app
 app = create_app()
 cli = FlaskGroup(create_app=create_app)
 
+
+@cli.command("migrate_references")
+@click.option("--segments", default=4, help="Number of parallel scan segments.")
+@click.option("--rate", default=50.0, help="Maximum files rewritten per second.")
+@click.option("--state-file", default="reference_migration.json", help="Progress file.")
+def migrate_references(segments: int, rate: float, state_file: str) -> None:
+    """Rewrite file references and index keys to the current layout, resuming any progress."""
+    from src.dynamodb.connection_manager import cm
+    from src.dynamodb.migrations import ReferenceMigration
+
+    state = ReferenceMigration(cm, state_file, total_segments=segments, rate=rate).run()
+    click.echo(f"Migrated {state['migrated']} files, skipped {state['skipped']}.")
+
+
 if __name__ == '__main__':
-    cli()
\ No newline at end of file
+    cli()
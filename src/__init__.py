@@ -8,6 +8,7 @@ from flask_cors import CORS
 
 from src.dynamodb.connection_manager import cm
 from src.integration_manager import im
+from src.jobs import jm
 
 
 def create_app() -> Any:
@@ -28,6 +29,9 @@ def create_app() -> Any:
     # Setup the integration manager.
     im.initialise(cm, app.config)
 
+    # Setup the background jobs.
+    jm.initialise(app.config)
+
     # Register blueprints
     from src.api.files import files_blueprint
     from src.api.ping import ping_blueprint
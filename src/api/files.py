@@ -1,17 +1,129 @@
 """Define the Files API Resource."""
 
-from typing import Any
+import itertools
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, Iterator
 
-from flask import Blueprint, abort, request
+from flask import Blueprint, Response, abort, request, stream_with_context
 from flask_restx import Api, Resource
+from itsdangerous import BadSignature, URLSafeSerializer
 from marshmallow import INCLUDE, Schema, fields
 
 from src.auth import get_user_id, requires_auth
+from src.config import app_config
 from src.dynamodb.connection_manager import cm
 
 files_blueprint = Blueprint("files", __name__)
 api = Api(files_blueprint)
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Cursors are signed so clients can't forge a start key, e.g. to page into another user's files.
+cursor_serializer = URLSafeSerializer(app_config["SECRET_KEY"], salt="files-cursor")
+
+
+def _json_default(value: Any) -> Any:
+    """Serialise the Decimal numbers returned by DynamoDB."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(
+        f"Object of type {value.__class__.__name__} is not JSON serializable"
+    )
+
+
+def _cursor_query(filters: dict) -> dict:
+    """Describe the query a cursor belongs to, the index it reads and how it filters and orders."""
+    return {
+        "index": cm.files_index(**filters),
+        "from": filters["from_datetime"].isoformat()
+        if filters["from_datetime"]
+        else None,
+        "to": filters["to_datetime"].isoformat() if filters["to_datetime"] else None,
+        "sender": filters["sender"],
+        "type": filters["file_type"],
+        "order": "desc" if filters["descending"] else "asc",
+    }
+
+
+def _encode_cursor(last_evaluated_key: dict, filters: dict) -> str:
+    """Encode a LastEvaluatedKey, and the query it came from, as an opaque, signed cursor."""
+    return cursor_serializer.dumps(
+        {"key": last_evaluated_key, "query": _cursor_query(filters)}
+    )
+
+
+def _decode_cursor(cursor: str, user: str, filters: dict) -> dict:
+    """Decode a cursor back into an ExclusiveStartKey, aborting if it isn't valid for user.
+
+    A start key only makes sense for the query it came from, so the cursor must also have been
+    issued for the same index, filters and order as the current request.
+
+    """
+    try:
+        payload = cursor_serializer.loads(cursor)
+    except BadSignature:
+        abort(400, "Query parameter 'cursor' is invalid.")
+
+    if (
+        not isinstance(payload, dict)
+        or not isinstance(payload.get("key"), dict)
+        or payload["key"].get("user") != user
+    ):
+        abort(400, "Query parameter 'cursor' is invalid.")
+
+    if payload.get("query") != _cursor_query(filters):
+        abort(
+            400, "Query parameter 'cursor' was issued for different filters or order."
+        )
+    return payload["key"]
+
+
+def _parse_limit(limit: Any) -> int:
+    """Validate the limit query parameter, falling back to the default page size."""
+    if limit is None:
+        return app_config["FILES_PAGE_DEFAULT_LIMIT"]
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400, "Query parameter 'limit' must be an integer.")
+
+    if not 1 <= limit <= app_config["FILES_PAGE_MAX_LIMIT"]:
+        abort(
+            400,
+            f"Query parameter 'limit' must be between 1 and {app_config['FILES_PAGE_MAX_LIMIT']}.",
+        )
+    return limit
+
+
+def _parse_filters() -> dict:
+    """Validate the query parameters that filter and order the files."""
+    order = request.args.get("order", "asc")
+    if order not in ["asc", "desc"]:
+        abort(400, "Query parameter 'order' must be 'asc' or 'desc'.")
+
+    return {
+        "from_datetime": _parse_datetime("from"),
+        "to_datetime": _parse_datetime("to"),
+        "sender": request.args.get("sender") or None,
+        "file_type": request.args.get("type") or None,
+        "descending": order == "desc",
+    }
+
+
+def _parse_datetime(name: str) -> Any:
+    """Validate an optional ISO datetime query parameter."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError as e:
+        abort(400, f"Query parameter '{name}' is invalid: {e}")
+
 
 class File(Schema):
     """Validation schema for individual file objects in the list of files."""
@@ -34,23 +146,86 @@ class FilesSchema(Schema):
 class FilesList(Resource):
     """Files API Resource for getting, putting, and deleting files."""
 
-    def _scrub_files(self: Any, files: list) -> list:
-        """Remove user and reference properties from each file."""
-        scrubbed_files = []
+    def _scrub_files(self: Any, files: Iterator[dict]) -> Iterator[dict]:
+        """Remove user, reference and index key properties from each file."""
+        for f in files:
+            del f["user"]
+            del f["reference"]
+            f.pop("sender_key", None)
+            f.pop("type_key", None)
+            yield f
+
+    def _stream_json(self: Any, files: Iterator[dict]) -> Iterator[str]:
+        """Yield the files as chunks of a single {"files": [...]} JSON document."""
+        yield '{"files": ['
+        for i, f in enumerate(files):
+            yield ("," if i else "") + json.dumps(f, default=_json_default)
+        yield "]}"
+
+    def _stream_ndjson(self: Any, files: Iterator[dict]) -> Iterator[str]:
+        """Yield the files as newline delimited JSON, one file per line."""
         for f in files:
-            _scrubbed = f
-            del _scrubbed["user"]
-            del _scrubbed["reference"]
-            scrubbed_files.append(_scrubbed)
-        return scrubbed_files
+            yield json.dumps(f, default=_json_default) + "\n"
+
+    def _get_page(self: Any, id: str, filters: dict) -> Any:
+        """Respond with a single page of files and a cursor to the page after it."""
+        limit = _parse_limit(request.args.get("limit"))
+        cursor = request.args.get("cursor")
+        start_key = _decode_cursor(cursor, id, filters) if cursor else None
+
+        files, last_evaluated_key = cm.get_files_page(id, limit, start_key, **filters)
+        response_object = {
+            "files": list(self._scrub_files(files)),
+            "next_cursor": (
+                _encode_cursor(last_evaluated_key, filters)
+                if last_evaluated_key
+                else None
+            ),
+        }
+        return Response(
+            json.dumps(response_object, default=_json_default),
+            status=200,
+            mimetype="application/json",
+        )
 
     @requires_auth
     def get(self: Any) -> Any:
-        """Get all files from the database that belong to the authenticated user."""
+        """Get all files from the database that belong to the authenticated user.
+
+        The files are streamed as they are read from the database, either as a JSON document
+        or, if the client accepts application/x-ndjson, as newline delimited JSON.
+
+        If `limit` or `cursor` query parameters are given, only that page of files is
+        returned, along with a `next_cursor` to request the following page with. The `from`
+        and `to` query parameters restrict the files to those created in that range, and
+        `sender` and `type` to those matching exactly. Files are returned oldest first, or
+        newest first with `order=desc`. Filtering by sender or type reads a secondary index,
+        which only holds the name, created, sender, type and link of each file.
+
+        """
         id = get_user_id()
-        files = cm.get_files(id)
-        response_object = {"files": self._scrub_files(files)}
-        return response_object, 200
+        filters = _parse_filters()
+        if "limit" in request.args or "cursor" in request.args:
+            return self._get_page(id, filters)
+
+        # Read the first page before responding, so a failing query is answered with an error
+        # status rather than a 200 whose body is cut short.
+        files = cm.get_files(id, **filters)
+        first = next(files, None)
+        if first is not None:
+            files = itertools.chain([first], files)
+        files = self._scrub_files(files)
+
+        mimetype = request.accept_mimetypes.best_match(
+            ["application/json", NDJSON_MIMETYPE]
+        )
+        if mimetype == NDJSON_MIMETYPE:
+            body = self._stream_ndjson(files)
+        else:
+            mimetype = "application/json"
+            body = self._stream_json(files)
+
+        return Response(stream_with_context(body), status=200, mimetype=mimetype)
 
     @requires_auth
     def put(self: Any) -> Any:
@@ -71,10 +246,9 @@ class FilesList(Resource):
         post_data = request.get_json()
         new_files = post_data.get("files")
 
-        # Add all new files to the data base.
-        status = {}
-        for f in new_files:
-            status[f["name"]] = cm.put_file(id, f)
+        # Add all new files to the data base, reporting the status of each by name.
+        status = cm.put_files(id, new_files)
+        status = {f["name"]: status[f["reference"]] for f in new_files}
 
         return {"status": status}, 200
 
@@ -97,9 +271,7 @@ class FilesList(Resource):
         post_data = request.get_json()
         new_files = post_data.get("files")
 
-        status = {}
-        for f in new_files:
-            status[f["name"]] = cm.delete_file(id, f)
+        status = cm.delete_files(id, new_files)
 
         return {"status": status}, 200
 
@@ -0,0 +1,85 @@
+"""Define helpers for calling the provider APIs concurrently."""
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+
+
+def fetch_concurrently(fetch: Callable, items: Iterable, max_workers: int) -> Any:
+    """Yield fetch(item) for each item, calling fetch from a pool of worker threads.
+
+    Results are yielded in the same order as the items, whatever order the calls finish in.
+    Items are only taken from the iterable as workers free up, with at most twice
+    `max_workers` calls submitted but not yet yielded, so a lazy listing is not read far ahead
+    of the results being consumed. If a call raises, the exception is raised here once all
+    earlier results have been yielded, so the error seen is the same as it would be if the
+    calls were made one after another. Calls not yet started are then cancelled. If the
+    items themselves raise, e.g. a listing page fails, the calls already submitted are still
+    yielded before the error is raised, so the results fetched so far aren't lost.
+
+    """
+    if max_workers <= 1:
+        for item in items:
+            yield fetch(item)
+        return
+
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while True:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                except Exception:
+                    while pending:
+                        yield pending.popleft().result()
+                    raise
+
+                pending.append(executor.submit(fetch, item))
+                if len(pending) >= max_workers * 2:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Stop any queued calls, the pool still waits for those already running.
+            for future in pending:
+                future.cancel()
+
+
+async def fetch_concurrently_async(
+    fetch: Callable, items: Any, max_in_flight: int
+) -> Any:
+    """Yield await fetch(item) for each item of the async iterable, awaiting many at once.
+
+    The async counterpart of `fetch_concurrently`: results come back in the order of the items,
+    at most `max_in_flight` fetches are running, an error is raised in order with the rest
+    still running cancelled, and the fetches already started are yielded before an error
+    raised by the items themselves.
+
+    """
+    items = items.__aiter__()
+    pending = deque()
+    try:
+        while True:
+            try:
+                item = await items.__anext__()
+            except StopAsyncIteration:
+                break
+            except Exception:
+                while pending:
+                    yield await pending.popleft()
+                raise
+
+            pending.append(asyncio.ensure_future(fetch(item)))
+            if len(pending) >= max_in_flight:
+                yield await pending.popleft()
+
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
@@ -1,6 +1,7 @@
 """Define the Gmail Synchronise API Resource."""
 
-from datetime import datetime
+import asyncio
+from datetime import datetime, timezone
 from typing import Any
 
 import requests
@@ -8,23 +9,49 @@ from flask import abort, request
 from flask_cors import cross_origin
 from flask_restx import Resource
 
+from src.api.synchronisations.concurrency import (
+    fetch_concurrently,
+    fetch_concurrently_async,
+)
+from src.api.synchronisations.pipeline import write_files, write_files_async
 from src.auth import get_user_id, requires_auth
 from src.config import app_config
-from src.dynamodb.connection_manager import cm
 from src.integration_manager import im
+from src.integrations.aio import AsyncGoogleRequestor, create_session
+from src.integrations.batch import chunked
+from src.integrations.google import GMAIL_BATCH_SIZE
+from src.jobs import JobProgress, jm
+
+
+def _epoch_seconds(dt: datetime) -> int:
+    """Return the datetime as seconds since the epoch, naive datetimes are taken to be in UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
 
 
 class Gmail(Resource):
+    def _message_url(self: Any, email: dict) -> str:
+        """Return the URL of the message for the email, with only the headers and part names.
 
-    def _attachment_generator(self: Any, email: dict, google_requestor: Any) -> Any:
+        The metadata format leaves out the parts, so ask for the full format but use a partial
+        response to drop the message bodies and attachment data.
+
+        """
+        return (
+            f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{email['id']}"
+            "?format=full"
+            "&fields=payload(headers(name,value),parts(filename,mimeType))"
+        )
 
+    def _response_attachments(self: Any, email: dict, response: Any) -> Any:
+        """Yield the file data for each attachment in the response holding the full message."""
         # Nice examples of getting attachment data.
         # https://stackoverflow.com/questions/25832631/download-attachments-from-gmail-using-gmail-api
 
-        # Make the request using the requestor object (which handles reauthenticating if required).
-        response = google_requestor.get(
-            f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{email['id']}"
-        )
+        # The message may have been deleted since it was listed, there is nothing to add.
+        if response.status_code == requests.codes.not_found:
+            return
 
         if response.status_code == requests.codes.ok:
             data = response.json()
@@ -33,33 +60,77 @@ class Gmail(Resource):
             sender = ""
             received = ""
 
-            for header in data['payload']['headers']:
-                if header['name'] == 'From':
-                    sender = header['value'].split('>')[0].split('<')[1]
-                if header['name'] == 'Date':
-                    dt = ' '.join(header['value'].split(' ')[:5])
-                    dt = datetime.strptime(dt, '%a, %d %b %Y %H:%M:%S')
+            for header in data["payload"]["headers"]:
+                if header["name"] == "From":
+                    sender = header["value"].split(">")[0].split("<")[1]
+                if header["name"] == "Date":
+                    dt = " ".join(header["value"].split(" ")[:5])
+                    dt = datetime.strptime(dt, "%a, %d %b %Y %H:%M:%S")
                     received = dt.isoformat()
 
-            for part in data['payload']['parts']:
-                if part['filename']:
+            for part in data["payload"].get("parts", []):
+                if part["filename"]:
                     yield {
-                        "name": part['filename'],
+                        "name": part["filename"],
                         "created": received,
                         "sender": sender,
-                        "type": part['mimeType'],
+                        "type": part["mimeType"],
                         "link": f"https://mail.google.com/mail/#inbox/{email['id']}",
                     }
         else:
             abort(response.status_code, f"Unable to get attachment: {response.text}")
 
-    def _email_generator(self: Any, from_datetime: str, google_requestor: Any) -> Any:
+    def _attachment_generator(self: Any, email: dict, google_requestor: Any) -> Any:
+
+        # Make the request using the requestor object (which handles reauthenticating if required).
+        response = google_requestor.get(self._message_url(email))
+
+        yield from self._response_attachments(email, response)
+
+    def _batch_attachment_generator(
+        self: Any, emails: list, google_requestor: Any
+    ) -> Any:
+        """Yield the file data for the attachments of several emails, fetched in batch requests.
+
+        The output is the same as `_attachment_generator` for each email in turn.
+
+        """
+        responses = google_requestor.batch_get(
+            [self._message_url(email) for email in emails]
+        )
+
+        for email, response in zip(emails, responses):
+            yield from self._response_attachments(email, response)
+
+    def _messages_url(
+        self: Any,
+        from_datetime: datetime,
+        to_datetime: datetime,
+        page_token: str = None,
+    ) -> str:
+        """Return the URL of a page of emails with attachments in the date window."""
+        # Gmail filters by date and attachments for us.
+        query = f"has:attachment after:{_epoch_seconds(from_datetime)}"
+        if to_datetime is not None:
+            query += f" before:{_epoch_seconds(to_datetime)}"
 
         get_messages_url = (
             "https://gmail.googleapis.com/gmail/v1/users/me/messages?"
-            'q="has:attachment after:2021/01/01"'
-            '&maxResults=100'
+            f'q="{query}"'
+            "&maxResults=100"
         )
+        if page_token is not None:
+            get_messages_url += f"&pageToken={page_token}"
+        return get_messages_url
+
+    def _email_generator(
+        self: Any,
+        from_datetime: datetime,
+        google_requestor: Any,
+        to_datetime: datetime = None,
+    ) -> Any:
+
+        get_messages_url = self._messages_url(from_datetime, to_datetime)
 
         while True:
 
@@ -67,33 +138,188 @@ class Gmail(Resource):
             response = google_requestor.get(get_messages_url)
 
             # Assuming the request succeeded, iterate through the emails, returning each one in turn.
-            # This automatically handles exiting when the email are beyond the date limit or no more emails.
             if response.status_code != requests.codes.ok:
                 abort(response.status_code, f"Unable to get emails: {response.text}")
             else:
                 data = response.json()
-                emails = data["messages"]
+                emails = data.get("messages", [])
 
                 for email in emails:
                     yield email
 
                 # Exit Condition.
                 if "nextPageToken" in data.keys():
-                    get_messages_url = (
-                        "https://gmail.googleapis.com/gmail/v1/users/me/messages?"
-                        'q="has:attachment after:2021/01/01"'
-                        '&maxResults=100'
+                    get_messages_url = self._messages_url(
+                        from_datetime, to_datetime, page_token=data["nextPageToken"]
+                    )
+                else:
+                    return
+
+    async def _async_email_generator(
+        self: Any,
+        from_datetime: datetime,
+        async_requestor: Any,
+        to_datetime: datetime = None,
+    ) -> Any:
+        """Yield the emails with attachments in the date window, as `_email_generator` does."""
+        get_messages_url = self._messages_url(from_datetime, to_datetime)
+
+        while True:
+
+            response = await async_requestor.get(get_messages_url)
+            if response.status_code != requests.codes.ok:
+                abort(response.status_code, f"Unable to get emails: {response.text}")
+
+            data = response.json()
+            for email in data.get("messages", []):
+                yield email
+
+            if "nextPageToken" in data.keys():
+                get_messages_url = self._messages_url(
+                    from_datetime, to_datetime, page_token=data["nextPageToken"]
+                )
+            else:
+                return
+
+    async def _async_attachment_generator(
+        self: Any, email: dict, async_requestor: Any
+    ) -> Any:
+        """Yield the file data for the email's attachments, as `_attachment_generator` does."""
+        response = await async_requestor.get(self._message_url(email))
+
+        for file in self._response_attachments(email, response):
+            yield file
+
+    async def _synchronise_async(
+        self: Any,
+        id: str,
+        from_datetime: datetime,
+        to_datetime: datetime,
+        google_requestor: Any,
+        progress: JobProgress,
+    ) -> int:
+        """Run a full sync on the async engine, returning how many attachments were written."""
+        async with create_session(app_config) as session:
+            async_requestor = AsyncGoogleRequestor(
+                google_requestor,
+                session,
+                max_in_flight=app_config["GMAIL_API_ASYNC_IN_FLIGHT"],
+            )
+            email_generator = progress.count_async(
+                "emails",
+                self._async_email_generator(
+                    from_datetime, async_requestor, to_datetime=to_datetime
+                ),
+            )
+
+            async def _fetch(email: dict) -> list:
+                return [
+                    file
+                    async for file in self._async_attachment_generator(
+                        email, async_requestor
+                    )
+                ]
+
+            attachment_lists = fetch_concurrently_async(
+                _fetch,
+                email_generator,
+                max_in_flight=app_config["GMAIL_API_ASYNC_IN_FLIGHT"],
+            )
+
+            async def _files() -> Any:
+                async for attachments in attachment_lists:
+                    for attachment in attachments:
+                        yield attachment
+
+            return await write_files_async(
+                id,
+                _files(),
+                batch_size=app_config["SYNC_WRITE_BATCH_SIZE"],
+                progress=progress,
+            )
+
+    def _get_history_id(self: Any, google_requestor: Any) -> str:
+        """Return the current history ID of the mailbox, the point the next sync starts from."""
+        response = google_requestor.get(
+            "https://gmail.googleapis.com/gmail/v1/users/me/profile?fields=historyId"
+        )
+        if response.status_code != requests.codes.ok:
+            abort(
+                response.status_code, f"Unable to get mailbox profile: {response.text}"
+            )
+        return response.json()["historyId"]
+
+    def _history_email_generator(
+        self: Any, from_datetime: datetime, google_requestor: Any
+    ) -> Any:
+        """Yield the emails added to the mailbox since the last history sync.
+
+        Walks users.history.list from the history ID stored on the google integration by the
+        previous history sync, keeping only messagesAdded records, so an unchanged mailbox
+        costs a single request. Without a stored history ID, or once Gmail has expired it
+        (the list returns 404), falls back to a full scan bounded to emails received after
+        from_datetime. The history ID for next time is left in `self.history_id` once the
+        generator is exhausted, for the caller to store once the attachments are saved.
+
+        """
+        history_id = google_requestor.google_info.get("history_id")
+
+        if history_id:
+            get_history_url = (
+                "https://gmail.googleapis.com/gmail/v1/users/me/history?"
+                f"startHistoryId={history_id}"
+                "&historyTypes=messageAdded"
+                "&maxResults=500"
+            )
+            seen = set()
+
+            while True:
+
+                response = google_requestor.get(get_history_url)
+
+                # The history ID has expired, fall through to a full scan.
+                if response.status_code == requests.codes.not_found:
+                    break
+
+                if response.status_code != requests.codes.ok:
+                    abort(
+                        response.status_code, f"Unable to get history: {response.text}"
+                    )
+
+                data = response.json()
+                for record in data.get("history", []):
+                    for added in record.get("messagesAdded", []):
+                        # A message can be listed by several records, only fetch it once.
+                        if added["message"]["id"] not in seen:
+                            seen.add(added["message"]["id"])
+                            yield added["message"]
+
+                if "nextPageToken" in data.keys():
+                    get_history_url = (
+                        "https://gmail.googleapis.com/gmail/v1/users/me/history?"
+                        f"startHistoryId={history_id}"
+                        "&historyTypes=messageAdded"
+                        "&maxResults=500"
                         f'&pageToken={data["nextPageToken"]}'
                     )
-                else:                    
+                else:
+                    self.history_id = data["historyId"]
                     return
 
+        # Note the history ID before listing, so nothing added during the scan is missed.
+        self.history_id = self._get_history_id(google_requestor)
+        yield from self._email_generator(from_datetime, google_requestor)
+
     @requires_auth
     @cross_origin()
     def get(self: Any) -> Any:
+        """Start a job adding the attachments in the user's Gmail mailbox to the database.
 
-        print("Starting Processing.")
+        Emails are read from `from_datetime`, up to `to_datetime` if given. With `mode=delta`
+        only the emails added since the last history sync are read. Responds with the job and
+        its status URL in the Location header.
 
+        """
         # Validate the request.
         from_datetime = request.args.get("from_datetime")
         if from_datetime is None:
@@ -104,31 +330,136 @@ class Gmail(Resource):
         except ValueError as e:
             abort(400, str(e))
 
+        mode = request.args.get("mode", "full")
+        if mode not in ["full", "delta"]:
+            abort(400, "Query parameter 'mode' must be 'full' or 'delta'.")
+
+        to_datetime = request.args.get("to_datetime")
+        if to_datetime is not None:
+            if mode == "delta":
+                abort(
+                    400,
+                    "Query parameter 'to_datetime' can't be used with mode 'delta'.",
+                )
+            try:
+                to_datetime = datetime.fromisoformat(to_datetime)
+            except ValueError as e:
+                abort(400, str(e))
+
         id = get_user_id()
 
-        # Try and get MSAL integration information, this will throw a KeyError if the msal
-        # integration doesn't exist, so handle and return gracefully.
+        # Check now that the user has a Google integration, so they are told straight away.
+        try:
+            im.get_integration(id, "google")
+        except KeyError:
+            abort(
+                406,
+                "No Google integration found for this user, have you subscribed yet?",
+            )
 
+        # Hand the crawl to a background job, the caller polls its status.
+        job = jm.submit(
+            id,
+            "gmail",
+            {
+                "from_datetime": from_datetime.isoformat(),
+                "mode": mode,
+                "to_datetime": to_datetime.isoformat()
+                if to_datetime is not None
+                else None,
+            },
+        )
+        return job, 202, {"Location": f"/synchronise/jobs/{job['id']}"}
+
+    def synchronise(
+        self: Any,
+        id: str,
+        from_datetime: datetime,
+        mode: str,
+        to_datetime: datetime,
+        progress: JobProgress,
+    ) -> dict:
+        """Add the attachments in the user's mailbox to the database, run as a background job."""
+        # Try and get Google integration information, this will throw a KeyError if the google
+        # integration doesn't exist, so handle and return gracefully.
         try:
             google_requestor = im.get_requestor(id, integration="google")
         except KeyError:
             abort(
-                406, "No Google integration found for this user, have you subscribed yet?"
+                406,
+                "No Google integration found for this user, have you subscribed yet?",
             )
 
+        # Full syncs can run on the async engine instead, keeping more requests in flight.
+        if mode == "full" and app_config["SYNC_ASYNC_ENGINE"]:
+            written = asyncio.run(
+                self._synchronise_async(
+                    id, from_datetime, to_datetime, google_requestor, progress
+                )
+            )
+            return {"message": f"{written} attachments added to the database."}
+
         # Iterate through all valid emails and process the attachments.
-        file_data = []
-        email_generator = self._email_generator(from_datetime, google_requestor)
-        for email in email_generator:
-            print("Processing Email...")
-            attachment_generator = self._attachment_generator(
-                email=email, google_requestor=google_requestor
+        if mode == "delta":
+            email_generator = self._history_email_generator(
+                from_datetime, google_requestor
+            )
+        else:
+            email_generator = self._email_generator(
+                from_datetime, google_requestor, to_datetime=to_datetime
+            )
+        email_generator = progress.count("emails", email_generator)
+        # Messages are fetched by a pool of workers, but their attachments come back in order.
+        if app_config["GMAIL_API_BATCH_REQUESTS"]:
+            attachment_lists = fetch_concurrently(
+                lambda emails: list(
+                    self._batch_attachment_generator(
+                        emails=emails, google_requestor=google_requestor
+                    )
+                ),
+                chunked(email_generator, GMAIL_BATCH_SIZE),
+                max_workers=app_config["GMAIL_API_BATCH_WORKERS"],
+            )
+        else:
+            attachment_lists = fetch_concurrently(
+                lambda email: list(
+                    self._attachment_generator(
+                        email=email, google_requestor=google_requestor
+                    )
+                ),
+                email_generator,
+                max_workers=app_config["GMAIL_API_FETCH_WORKERS"],
             )
-            for attachment in attachment_generator:
-                file_data.append(attachment)
+        # Add the files to the database for this user as they are found.
+        written = write_files(
+            id,
+            (
+                attachment
+                for attachments in attachment_lists
+                for attachment in attachments
+            ),
+            batch_size=app_config["SYNC_WRITE_BATCH_SIZE"],
+            progress=progress,
+        )
+
+        # Only now the attachments are saved, remember where the next history sync starts from.
+        if mode == "delta":
+            im.set_integration_fields(id, "google", {"history_id": self.history_id})
+
+        return {"message": f"{written} attachments added to the database."}
+
+
+def _run_job(user: str, params: dict, progress: JobProgress) -> dict:
+    """Run a Gmail synchronisation job."""
+    return Gmail().synchronise(
+        user,
+        datetime.fromisoformat(params["from_datetime"]),
+        params["mode"],
+        datetime.fromisoformat(params["to_datetime"])
+        if params["to_datetime"]
+        else None,
+        progress,
+    )
 
-        # Add all files to the database for this user.
-        for file in file_data:
-            cm.put_file(id, file)
 
-        return {"message": f"{len(file_data)} attachments added to the database."}, 200
\ No newline at end of file
+jm.register("gmail", _run_job)
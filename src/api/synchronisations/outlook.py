@@ -1,6 +1,7 @@
 """Define the Outlook Synchronise API Resource."""
 
-from datetime import datetime
+import asyncio
+from datetime import datetime, timezone
 from typing import Any
 
 import requests
@@ -8,74 +9,148 @@ from flask import abort, request
 from flask_cors import cross_origin
 from flask_restx import Resource
 
+from src.api.synchronisations.concurrency import (
+    fetch_concurrently,
+    fetch_concurrently_async,
+)
+from src.api.synchronisations.pipeline import write_files, write_files_async
 from src.auth import get_user_id, requires_auth
 from src.config import app_config
-from src.dynamodb.connection_manager import cm
 from src.integration_manager import im
+from src.integrations.aio import AsyncMSALRequestor, create_session
+from src.integrations.batch import chunked
+from src.integrations.msal import GRAPH_BATCH_SIZE
+from src.jobs import JobProgress, jm
 
 
-class Outlook(Resource):
+def _utc_datetime(dt: datetime) -> datetime:
+    """Return the datetime as an aware datetime in UTC, naive datetimes are taken to be in UTC."""
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
 
-    # Keep track of how many times we've called the Graph API so that we don't hit our rate limit.
-    request_count = 0
 
-    def _attachment_generator(self: Any, email: dict, msal_requestor: Any) -> Any:
+def _graph_datetime(dt: datetime) -> str:
+    """Format the datetime for a Graph $filter, naive datetimes are taken to be in UTC."""
+    return _utc_datetime(dt).strftime("%Y-%m-%dT%H:%M:%SZ")
 
-        # Make the request using the requestor object (which handles reauthenticating if required).
-        # If too many requests are being made, abort.
-        if self.request_count > app_config["GRAPH_API_REQUEST_LIMIT"]:
-            abort(
-                413,
-                "Stopped because this request was making too many calls to the Graph API.",
-            )
-        response = msal_requestor.get(
+
+class Outlook(Resource):
+    def _attachments_url(self: Any, email: dict) -> str:
+        """Return the URL listing the attachments of the email."""
+        return (
             f'https://graph.microsoft.com/v1.0/me/messages/{email["id"]}/attachments'
             f"?select=contentType,name,isInline"
         )
-        self.request_count += 1
 
+    def _file_data(self: Any, email: dict, attachments: list) -> Any:
+        """Yield the file data for each of the email's attachments that isn't inline."""
+        for attachment in attachments:
+            if not attachment["isInline"]:
+                yield {
+                    "name": attachment["name"],
+                    "created": email["receivedDateTime"],
+                    "sender": email["sender"]["emailAddress"]["address"],
+                    "type": attachment["contentType"],
+                    "link": email["webLink"],
+                }
+
+    def _response_attachments(self: Any, email: dict, response: Any) -> Any:
+        """Yield the file data for each attachment in the response listing the email's attachments."""
         if response.status_code == requests.codes.ok:
             data = response.json()
-            for attachment in data["value"]:
-                if not attachment["isInline"]:
-                    yield {
-                        "name": attachment["name"],
-                        "created": email["receivedDateTime"],
-                        "sender": email["sender"]["emailAddress"]["address"],
-                        "type": attachment["contentType"],
-                        "link": email["webLink"],
-                    }
+            yield from self._file_data(email, data["value"])
         else:
             abort(response.status_code, f"Unable to get attachment: {response.text}")
 
-    def _email_generator(self: Any, from_datetime: str, msal_requestor: Any) -> Any:
+    def _attachment_generator(self: Any, email: dict, msal_requestor: Any) -> Any:
+
+        # Make the request using the requestor object (which handles reauthenticating if required).
+        response = msal_requestor.get(self._attachments_url(email))
+
+        yield from self._response_attachments(email, response)
+
+    def _expanded_attachment_generator(
+        self: Any, email: dict, msal_requestor: Any
+    ) -> Any:
+        """Yield the file data for the attachments expanded into the email by the listing.
+
+        Falls back to listing the attachments with a call of its own if they weren't expanded.
+
+        """
+        if "attachments" in email.keys():
+            yield from self._file_data(email, email["attachments"])
+        else:
+            yield from self._attachment_generator(email, msal_requestor)
+
+    def _batch_attachment_generator(
+        self: Any, emails: list, msal_requestor: Any
+    ) -> Any:
+        """Yield the file data for the attachments of several emails, listed with $batch calls.
+
+        Each $batch call lists the attachments of up to 20 emails, the output is the same as
+        `_attachment_generator` for each email in turn.
+
+        """
+        responses = msal_requestor.batch_get(
+            [self._attachments_url(email) for email in emails]
+        )
+
+        for email, response in zip(emails, responses):
+            yield from self._response_attachments(email, response)
+
+    def _messages_url(
+        self: Any, from_datetime: datetime, expand: bool, to_datetime: datetime
+    ) -> str:
+        """Return the URL of the first page of emails with attachments in the date window."""
+        # Graph filters by date and attachments for us, newest first. Graph requires the
+        # property ordered by to be the first one filtered on.
+        date_filter = f"receivedDateTime ge {_graph_datetime(from_datetime)}"
+        if to_datetime is not None:
+            date_filter += f" and receivedDateTime lt {_graph_datetime(to_datetime)}"
 
         get_messages_url = (
             "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages?"
-            '$search="hasAttachments:true"'
+            f"$filter={date_filter} and hasAttachments eq true"
+            "&$orderby=receivedDateTime desc"
             "&$select=id,receivedDateTime,sender,webLink"
-            "&top=100"
+            "&$top=100"
         )
 
+        # Have each page bring the attachment metadata with it, saving a call per email.
+        if expand:
+            get_messages_url += (
+                "&$expand=attachments($select=name,contentType,isInline)"
+            )
+
+        return get_messages_url
+
+    def _email_generator(
+        self: Any,
+        from_datetime: datetime,
+        msal_requestor: Any,
+        expand: bool = False,
+        to_datetime: datetime = None,
+    ) -> Any:
+
+        get_messages_url = self._messages_url(from_datetime, expand, to_datetime)
+
         while True:
 
             # Make the request using the requestor object (which handles reauthenticating if required).
-            # If too many requests are being made, abort.
-            if self.request_count > app_config["GRAPH_API_REQUEST_LIMIT"]:
-                abort(
-                    413,
-                    "Stopped because this request was making too many calls to the Graph API.",
-                )
             response = msal_requestor.get(get_messages_url)
-            self.request_count += 1
 
             # Assuming the request succeeded, iterate through the emails, returning each one in turn.
-            # This automatically handles exiting when the email are beyond the date limit or no more emails.
             if response.status_code != requests.codes.ok:
                 abort(response.status_code, f"Unable to get emails: {response.text}")
             else:
                 data = response.json()
-                emails = data["value"]
+
+                for email in data["value"]:
+                    email["receivedDateTime"] = email["receivedDateTime"].replace(
+                        "Z", ""
+                    )
+                    yield email
 
                 # Exit Condition.
                 if "@odata.nextLink" in data.keys():
@@ -83,24 +158,185 @@ class Outlook(Resource):
                 else:
                     return
 
-                for email in emails:
-                    email["receivedDateTime"] = email["receivedDateTime"].replace(
-                        "Z", ""
+    def _delta_email_generator(
+        self: Any, from_datetime: datetime, msal_requestor: Any
+    ) -> Any:
+        """Yield the inbox emails with attachments that changed since the last delta sync.
+
+        Resumes from the deltaLink stored on the msal integration by the previous delta sync,
+        so an unchanged mailbox costs a single request. Without a stored link, or if it was
+        made for a later from_datetime than requested, a new delta sync is started from
+        from_datetime. The deltaLink for next time, and the from_datetime it started at, are
+        left in `self.delta_link` and `self.delta_from` once the generator is exhausted, for
+        the caller to store once the attachments are saved. If Graph has expired the stored
+        link it is dropped from the integration and a new delta sync started instead.
+
+        """
+        self.delta_link = None
+        delta_link = msal_requestor.msal_info.get("delta_link")
+        delta_from = msal_requestor.msal_info.get("delta_from")
+        new_delta_url = (
+            "https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages/delta?"
+            "$select=id,receivedDateTime,sender,webLink,hasAttachments"
+            f"&$filter=receivedDateTime ge {_graph_datetime(from_datetime)}"
+        )
+
+        # Compare in UTC, the stored and requested datetimes needn't both be naive or aware.
+        resuming = bool(
+            delta_link
+            and delta_from
+            and _utc_datetime(datetime.fromisoformat(delta_from))
+            <= _utc_datetime(from_datetime)
+        )
+        if resuming:
+            get_messages_url = delta_link
+            self.delta_from = delta_from
+        else:
+            get_messages_url = new_delta_url
+            self.delta_from = _utc_datetime(from_datetime).isoformat()
+
+        while True:
+
+            # Make the request using the requestor object (which handles reauthenticating if required).
+            response = msal_requestor.get(
+                get_messages_url, headers={"Prefer": "odata.maxpagesize=100"}
+            )
+
+            # Graph forgets delta state after a while, answering the stored link with 410 Gone.
+            # Forget the link, so later syncs don't replay it, and start again from from_datetime.
+            if resuming and response.status_code == requests.codes.gone:
+                im.set_integration_fields(
+                    msal_requestor.user, "msal", {}, remove=["delta_link", "delta_from"]
+                )
+                resuming = False
+                get_messages_url = new_delta_url
+                self.delta_from = _utc_datetime(from_datetime).isoformat()
+                continue
+
+            if response.status_code != requests.codes.ok:
+                abort(response.status_code, f"Unable to get emails: {response.text}")
+
+            # Only the first page of a resumed sync can find the link expired.
+            resuming = False
+
+            data = response.json()
+            for email in data["value"]:
+                # Deleted messages and those without attachments are of no interest.
+                if "@removed" in email.keys() or not email.get("hasAttachments"):
+                    continue
+
+                email["receivedDateTime"] = email["receivedDateTime"].replace("Z", "")
+                yield email
+
+            # Pages end with a nextLink, until the final page which has the deltaLink.
+            if "@odata.nextLink" in data.keys():
+                get_messages_url = data["@odata.nextLink"]
+            else:
+                self.delta_link = data.get("@odata.deltaLink")
+                return
+
+    async def _async_email_generator(
+        self: Any,
+        from_datetime: datetime,
+        async_requestor: Any,
+        expand: bool = False,
+        to_datetime: datetime = None,
+    ) -> Any:
+        """Yield the emails with attachments in the date window, as `_email_generator` does."""
+        get_messages_url = self._messages_url(from_datetime, expand, to_datetime)
+
+        while True:
+
+            response = await async_requestor.get(get_messages_url)
+
+            if response.status_code != requests.codes.ok:
+                abort(response.status_code, f"Unable to get emails: {response.text}")
+
+            data = response.json()
+            for email in data["value"]:
+                email["receivedDateTime"] = email["receivedDateTime"].replace("Z", "")
+                yield email
+
+            if "@odata.nextLink" in data.keys():
+                get_messages_url = data["@odata.nextLink"]
+            else:
+                return
+
+    async def _async_attachment_generator(
+        self: Any, email: dict, async_requestor: Any
+    ) -> Any:
+        """Yield the file data for the email's attachments, as `_expanded_attachment_generator` does."""
+        if "attachments" in email.keys():
+            for file in self._file_data(email, email["attachments"]):
+                yield file
+            return
+
+        response = await async_requestor.get(self._attachments_url(email))
+
+        for file in self._response_attachments(email, response):
+            yield file
+
+    async def _synchronise_async(
+        self: Any,
+        id: str,
+        from_datetime: datetime,
+        to_datetime: datetime,
+        msal_requestor: Any,
+        progress: JobProgress,
+    ) -> int:
+        """Run a full sync on the async engine, returning how many attachments were written."""
+        async with create_session(app_config) as session:
+            async_requestor = AsyncMSALRequestor(
+                msal_requestor,
+                session,
+                max_in_flight=app_config["GRAPH_API_ASYNC_IN_FLIGHT"],
+            )
+            email_generator = progress.count_async(
+                "emails",
+                self._async_email_generator(
+                    from_datetime,
+                    async_requestor,
+                    expand=app_config["GRAPH_API_EXPAND_ATTACHMENTS"],
+                    to_datetime=to_datetime,
+                ),
+            )
+
+            async def _fetch(email: dict) -> list:
+                return [
+                    file
+                    async for file in self._async_attachment_generator(
+                        email, async_requestor
                     )
+                ]
 
-                    # Exit if email beyond date range.
-                    if (
-                        datetime.fromisoformat(email["receivedDateTime"])
-                        < from_datetime
-                    ):
-                        return
+            attachment_lists = fetch_concurrently_async(
+                _fetch,
+                email_generator,
+                max_in_flight=app_config["GRAPH_API_ASYNC_IN_FLIGHT"],
+            )
 
-                    yield email
+            async def _files() -> Any:
+                async for attachments in attachment_lists:
+                    for attachment in attachments:
+                        yield attachment
+
+            return await write_files_async(
+                id,
+                _files(),
+                batch_size=app_config["SYNC_WRITE_BATCH_SIZE"],
+                progress=progress,
+            )
 
     @requires_auth
     @cross_origin()
     def get(self: Any) -> Any:
+        """Start a job adding the attachments in the user's Outlook mailbox to the database.
+
+        Emails are read from `from_datetime`, up to `to_datetime` if given. With `mode=delta`
+        only the emails changed since the last delta sync are read. Responds with the job and
+        its status URL in the Location header.
 
+        """
         # Validate the request.
         from_datetime = request.args.get("from_datetime")
         if from_datetime is None:
@@ -111,8 +347,55 @@ class Outlook(Resource):
         except ValueError as e:
             abort(400, str(e))
 
+        mode = request.args.get("mode", "full")
+        if mode not in ["full", "delta"]:
+            abort(400, "Query parameter 'mode' must be 'full' or 'delta'.")
+
+        to_datetime = request.args.get("to_datetime")
+        if to_datetime is not None:
+            if mode == "delta":
+                abort(
+                    400,
+                    "Query parameter 'to_datetime' can't be used with mode 'delta'.",
+                )
+            try:
+                to_datetime = datetime.fromisoformat(to_datetime)
+            except ValueError as e:
+                abort(400, str(e))
+
         id = get_user_id()
 
+        # Check now that the user has an MSAL integration, so they are told straight away.
+        try:
+            im.get_integration(id, "msal")
+        except KeyError:
+            abort(
+                406, "No MSAL integration found for this user, have you subscribed yet?"
+            )
+
+        # Hand the crawl to a background job, the caller polls its status.
+        job = jm.submit(
+            id,
+            "outlook",
+            {
+                "from_datetime": from_datetime.isoformat(),
+                "mode": mode,
+                "to_datetime": to_datetime.isoformat()
+                if to_datetime is not None
+                else None,
+            },
+        )
+        return job, 202, {"Location": f"/synchronise/jobs/{job['id']}"}
+
+    def synchronise(
+        self: Any,
+        id: str,
+        from_datetime: datetime,
+        mode: str,
+        to_datetime: datetime,
+        progress: JobProgress,
+    ) -> dict:
+        """Add the attachments in the user's mailbox to the database, run as a background job."""
         # Try and get MSAL integration information, this will throw a KeyError if the msal
         # integration doesn't exist, so handle and return gracefully.
         try:
@@ -122,21 +405,86 @@ class Outlook(Resource):
                 406, "No MSAL integration found for this user, have you subscribed yet?"
             )
 
-        # Start the request count from 0.
-        self.request_count = 0
+        # Full syncs can run on the async engine instead, keeping more requests in flight.
+        if mode == "full" and app_config["SYNC_ASYNC_ENGINE"]:
+            written = asyncio.run(
+                self._synchronise_async(
+                    id, from_datetime, to_datetime, msal_requestor, progress
+                )
+            )
+            return {"message": f"{written} attachments added to the database."}
 
         # Iterate through all valid emails and process the attachments.
-        file_data = []
-        email_generator = self._email_generator(from_datetime, msal_requestor)
-        for email in email_generator:
-            attachment_generator = self._attachment_generator(
-                email=email, msal_requestor=msal_requestor
+        expand = mode == "full" and app_config["GRAPH_API_EXPAND_ATTACHMENTS"]
+        if mode == "delta":
+            email_generator = self._delta_email_generator(from_datetime, msal_requestor)
+        else:
+            email_generator = self._email_generator(
+                from_datetime, msal_requestor, expand=expand, to_datetime=to_datetime
             )
-            for attachment in attachment_generator:
-                file_data.append(attachment)
+        email_generator = progress.count("emails", email_generator)
+
+        # Expanded attachments need no further calls. Otherwise attachments are listed by a pool
+        # of workers, but come back in the order of the emails.
+        if expand:
+            attachment_lists = (
+                list(self._expanded_attachment_generator(email, msal_requestor))
+                for email in email_generator
+            )
+        elif app_config["GRAPH_API_BATCH_REQUESTS"]:
+            attachment_lists = fetch_concurrently(
+                lambda emails: list(
+                    self._batch_attachment_generator(
+                        emails=emails, msal_requestor=msal_requestor
+                    )
+                ),
+                chunked(email_generator, GRAPH_BATCH_SIZE),
+                max_workers=app_config["GRAPH_API_BATCH_WORKERS"],
+            )
+        else:
+            attachment_lists = fetch_concurrently(
+                lambda email: list(
+                    self._attachment_generator(
+                        email=email, msal_requestor=msal_requestor
+                    )
+                ),
+                email_generator,
+                max_workers=app_config["GRAPH_API_FETCH_WORKERS"],
+            )
+        # Add the files to the database for this user as they are found.
+        written = write_files(
+            id,
+            (
+                attachment
+                for attachments in attachment_lists
+                for attachment in attachments
+            ),
+            batch_size=app_config["SYNC_WRITE_BATCH_SIZE"],
+            progress=progress,
+        )
+
+        # Only now the attachments are saved, remember where the next delta sync starts from.
+        if mode == "delta" and self.delta_link:
+            im.set_integration_fields(
+                id,
+                "msal",
+                {"delta_link": self.delta_link, "delta_from": self.delta_from},
+            )
+
+        return {"message": f"{written} attachments added to the database."}
+
+
+def _run_job(user: str, params: dict, progress: JobProgress) -> dict:
+    """Run an Outlook synchronisation job."""
+    return Outlook().synchronise(
+        user,
+        datetime.fromisoformat(params["from_datetime"]),
+        params["mode"],
+        datetime.fromisoformat(params["to_datetime"])
+        if params["to_datetime"]
+        else None,
+        progress,
+    )
 
-        # Add all files to the database for this user.
-        for file in file_data:
-            cm.put_file(id, file)
 
-        return {"message": f"{len(file_data)} attachments added to the database."}, 200
+jm.register("outlook", _run_job)
@@ -0,0 +1,135 @@
+"""Define the write stage shared by the synchronisation pipelines.
+
+A sync is a chain of generators: the email listing feeds the attachment fetches, which feed
+`write_files`. Each stage only holds a bounded number of items, so memory stays the same
+whatever the size of the mailbox.
+
+"""
+
+import asyncio
+import functools
+import logging
+from typing import Any, Iterable
+
+from flask import abort
+
+from src.dynamodb.connection_manager import cm
+
+logger = logging.getLogger(__name__)
+
+
+def _count_written(batch: list, status: dict, failed: list, progress: Any) -> int:
+    """Return how many files of the batch were written, adding those that weren't to failed.
+
+    The status is keyed by the reference put_files set on each file, as names needn't be unique.
+
+    """
+    written = 0
+    for file in batch:
+        if status.get(file.get("reference")) == "SUCCESS":
+            written += 1
+        else:
+            failed.append(file["name"])
+
+    if progress is not None:
+        progress.increment("attachments", written)
+        if len(batch) > written:
+            progress.increment("failed", len(batch) - written)
+    return written
+
+
+def _check_failed(failed: list) -> None:
+    """Fail the sync if any files couldn't be written, so it's retried rather than reported done."""
+    if failed:
+        abort(
+            503,
+            f"{len(failed)} attachments could not be written to the database: "
+            f"{', '.join(failed[:10])}{'...' if len(failed) > 10 else ''}",
+        )
+
+
+def write_files(
+    user: str, file_data: Iterable, batch_size: int, progress: Any = None
+) -> int:
+    """Write the files to the database batch_size at a time, returning how many were written.
+
+    If an earlier stage fails part way through, the files already found are still written
+    before the error is raised, so a sync that is aborted keeps the progress it made. Only
+    files the database reports as written are counted, in the `attachments` counter of the
+    job's progress if given, and any it reports as FAILED are counted under `failed`. Once
+    every file has been tried, a 503 is raised if any failed.
+
+    """
+    written = 0
+    failed = []
+    batch = []
+
+    def _flush() -> None:
+        nonlocal written
+        status = cm.put_files(user, batch)
+        written += _count_written(batch, status, failed, progress)
+
+    try:
+        for file in file_data:
+            batch.append(file)
+            if len(batch) >= batch_size:
+                _flush()
+                batch = []
+    except BaseException:
+        # Keep what was found, without letting a failed write hide the original error.
+        if batch:
+            try:
+                _flush()
+            except Exception:
+                logger.exception(
+                    "Unable to write the files found before the sync failed."
+                )
+        raise
+
+    if batch:
+        _flush()
+    _check_failed(failed)
+    return written
+
+
+async def write_files_async(
+    user: str, file_data: Any, batch_size: int, progress: Any = None
+) -> int:
+    """Write the files from an async iterable to the database, as `write_files` does.
+
+    The writes themselves are blocking, so they are run on the default executor.
+
+    """
+    loop = asyncio.get_running_loop()
+    written = 0
+    failed = []
+    batch = []
+
+    async def _flush() -> None:
+        nonlocal written
+        status = await loop.run_in_executor(
+            None, functools.partial(cm.put_files, user, batch)
+        )
+        written += _count_written(batch, status, failed, progress)
+
+    try:
+        async for file in file_data:
+            batch.append(file)
+            if len(batch) >= batch_size:
+                await _flush()
+                batch = []
+    except BaseException:
+        # Keep what was found, without letting a failed write hide the original error.
+        if batch:
+            try:
+                await _flush()
+            except Exception:
+                logger.exception(
+                    "Unable to write the files found before the sync failed."
+                )
+        raise
+
+    if batch:
+        await _flush()
+    _check_failed(failed)
+    return written
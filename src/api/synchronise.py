@@ -1,13 +1,42 @@
 """Define the Synchronise API Resource."""
 
-from flask import Blueprint
-from flask_restx import Api
+from typing import Any
+
+from flask import Blueprint, abort
+from flask_cors import cross_origin
+from flask_restx import Api, Resource
 
-from src.api.synchronisations.outlook import Outlook
 from src.api.synchronisations.gmail import Gmail
+from src.api.synchronisations.outlook import Outlook
+from src.auth import get_user_id, requires_auth
+from src.jobs import jm
 
 synchronise_blueprint = Blueprint("synchronise", __name__)
 api = Api(synchronise_blueprint)
 
+
+class Job(Resource):
+    """This route responds with the status of a synchronisation job."""
+
+    @requires_auth
+    @cross_origin()
+    def get(self: Any, job_id: str) -> Any:
+        """
+        Return the status, progress counters and result of one of the user's jobs.
+
+        Returns:
+            dict: The job, its status is one of QUEUED, RUNNING, SUCCESS or FAILED.
+
+        """
+        id = get_user_id()
+
+        # Jobs belonging to other users are reported as missing too.
+        try:
+            return jm.get_job(id, job_id), 200
+        except KeyError:
+            abort(404, "No job found with this id.")
+
+
 api.add_resource(Outlook, "/synchronise/outlook")
-api.add_resource(Gmail, "/synchronise/gmail")
\ No newline at end of file
+api.add_resource(Gmail, "/synchronise/gmail")
+api.add_resource(Job, "/synchronise/jobs/<string:job_id>")
@@ -1,15 +1,48 @@
 """Define functions, decorators, and errors for dealing with authentication."""
 
-import json
+import hashlib
+import time
 from functools import wraps
 from typing import Any
 
 import requests
 from flask import _request_ctx_stack, abort, request
 from jose import jwt
-from six.moves.urllib.request import urlopen
 
+from src.cache import TTLCache
 from src.config import app_config
+from src.http_session import create_session
+from src.jwks import JWKSKeyStore
+
+# Calls to the Auth0 tenant share a pooled session, so they reuse open connections.
+http_session = create_session(app_config)
+
+# The tenant's signing keys, fetched on first use and cached for the life of the process.
+jwks = JWKSKeyStore(
+    f"{app_config['AUTH_TENANT_URL']}/.well-known/jwks.json",
+    ttl=app_config["AUTH_JWKS_TTL"],
+    min_refetch_interval=app_config["AUTH_JWKS_MIN_REFETCH_INTERVAL"],
+    session=http_session,
+)
+
+# Emails looked up from /userinfo for tokens that don't carry the email claim, keyed by a
+# hash of the token and kept until the token expires.
+userinfo_cache = TTLCache(
+    maxsize=app_config["AUTH_USERINFO_CACHE_SIZE"],
+    ttl=app_config["AUTH_USERINFO_CACHE_TTL"],
+)
+
+# Payloads of tokens that have already passed verification, keyed by a hash of the token and
+# kept until the token expires, so a token reused across requests is only verified once.
+verified_tokens = TTLCache(
+    maxsize=app_config["AUTH_TOKEN_CACHE_SIZE"],
+    ttl=app_config["AUTH_TOKEN_CACHE_TTL"],
+)
+
+
+def _token_digest(token: str) -> str:
+    """Return a digest of the token suitable for use as a cache key."""
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
 def get_token_auth_header() -> str:
@@ -30,29 +63,38 @@ def get_token_auth_header() -> str:
     return parts[1]
 
 
-def authenticate_token(token: str) -> bool:
-    """Authenticate the provided JWT token using Auth0."""
-    jsonurl = urlopen(f"{app_config['AUTH_TENANT_URL']}/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"],
-            }
+def get_current_token() -> str:
+    """Return the access token for the current request, parsing the header at most once."""
+    ctx = _request_ctx_stack.top
+    token = getattr(ctx, "current_token", None)
+    if token is None:
+        token = get_token_auth_header()
+        ctx.current_token = token
+    return token
+
+
+def _verify_token(token: str) -> dict:
+    """Verify the signature and claims of the provided JWT token and return its payload."""
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except Exception:
+        abort(401, "Unable to parse authentication token.")
+
+    try:
+        rsa_key = jwks.get_key(unverified_header.get("kid"))
+    except Exception:
+        abort(503, "Unable to fetch the signing keys from the authentication server.")
+
     if rsa_key:
         try:
-            payload = jwt.decode(
+            # The key is wrapped in a list, jose only accepts prebuilt key objects that way.
+            return jwt.decode(
                 token,
-                rsa_key,
+                [rsa_key],
                 algorithms=["RS256"],
                 audience=app_config["AUTH_JWT_AUDIENCE"],
                 issuer=f"{app_config['AUTH_TENANT_URL']}/",
+                options={"leeway": app_config["AUTH_CLOCK_SKEW"]},
             )
         except jwt.ExpiredSignatureError:
             abort(401, "Token has expired.")
@@ -61,29 +103,66 @@ def authenticate_token(token: str) -> bool:
         except Exception:
             abort(401, "Unable to parse authentication token.")
 
-        _request_ctx_stack.top.current_user = payload
-        return True
     abort(401, "Unable to find RSA key.")
 
 
+def authenticate_token(token: str) -> bool:
+    """Authenticate the provided JWT token using Auth0.
+
+    Verified payloads are cached until the token's exp claim, so repeated requests with the
+    same token skip signature verification. Verification allows AUTH_CLOCK_SKEW seconds of
+    leeway, but the cache never serves a token past its exp. Tokens without an exp claim are
+    never cached.
+
+    """
+    digest = _token_digest(token)
+    payload = verified_tokens.get(digest)
+    if payload is None:
+        payload = _verify_token(token)
+        if "exp" in payload:
+            expires_at = min(payload["exp"], time.time() + verified_tokens.ttl)
+            verified_tokens.set(digest, payload, expires_at=expires_at)
+
+    _request_ctx_stack.top.current_user = payload
+    return True
+
+
 def requires_auth(f: Any) -> Any:
     """Decorate a function by validating the Access Token."""
 
     @wraps(f)
     def decorated(*args: list, **kwargs: dict) -> Any:
         token = get_token_auth_header()
+        _request_ctx_stack.top.current_token = token
         if authenticate_token(token):
             return f(*args, **kwargs)
 
     return decorated
 
 
-def get_user_id() -> str:
-    """Use the access token to retrieve the user profile and return the email as the user id."""
-    token = get_token_auth_header()
+def cache_stats() -> dict:
+    """Return the hit and miss counters of the authentication caches."""
+    return {
+        "verified_tokens": verified_tokens.stats(),
+        "userinfo": userinfo_cache.stats(),
+    }
+
 
+def _token_expiry(token: str) -> Any:
+    """Return the exp claim of the token, preferring the verified payload if there is one."""
+    payload = getattr(_request_ctx_stack.top, "current_user", None)
+    if payload is None:
+        try:
+            payload = jwt.get_unverified_claims(token)
+        except Exception:
+            return None
+    return payload.get("exp")
+
+
+def _fetch_user_email(token: str) -> str:
+    """Use the access token to retrieve the user profile from Auth0 and return the email."""
     # Try and get user profile data.
-    response = requests.get(
+    response = http_session.get(
         f"{app_config['AUTH_TENANT_URL']}/userinfo",
         headers={"Authorization": f"Bearer {token}"},
     )
@@ -101,3 +180,30 @@ def get_user_id() -> str:
             "The server was enable to fetch the user email with the provided access token. "
             "Ensure the access token has email scope.",
         )
+
+
+def get_user_id() -> str:
+    """Return the email of the authenticated user as the user id.
+
+    The email is read from the namespaced custom claim on the verified token when present,
+    so most requests need no further calls to Auth0. Otherwise it falls back to the /userinfo
+    endpoint, caching the result against the token until the token expires.
+
+    """
+    ctx = _request_ctx_stack.top
+    user_id = getattr(ctx, "current_user_id", None)
+    if user_id is not None:
+        return user_id
+
+    payload = getattr(ctx, "current_user", None) or {}
+    user_id = payload.get(app_config["AUTH_EMAIL_CLAIM"])
+    if not user_id:
+        token = get_current_token()
+        token_hash = _token_digest(token)
+        user_id = userinfo_cache.get(token_hash)
+        if user_id is None:
+            user_id = _fetch_user_email(token)
+            userinfo_cache.set(token_hash, user_id, expires_at=_token_expiry(token))
+
+    ctx.current_user_id = user_id
+    return user_id
@@ -0,0 +1,166 @@
+"""Define small caches shared by the rest of the app."""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class CacheBackend:
+    """The interface every cache backend provides.
+
+    Backends map string keys to values that expire after a time to live. Callers treat a
+    missing value and an expired one the same way, so backends are free to evict early.
+
+    """
+
+    def get(self: Any, key: str, default: Any = None) -> Any:
+        """Return the value for key, or default if it is missing or has expired."""
+        raise NotImplementedError
+
+    def set(
+        self: Any, key: str, value: Any, expires_at: Optional[float] = None
+    ) -> None:
+        """Store value under key until expires_at, or for the backend's default ttl."""
+        raise NotImplementedError
+
+    def delete(self: Any, key: str) -> None:
+        """Remove key from the cache if it is present."""
+        raise NotImplementedError
+
+    def clear(self: Any) -> None:
+        """Remove every entry from the cache."""
+        raise NotImplementedError
+
+
+class TTLCache(CacheBackend):
+    """A bounded, thread-safe LRU cache whose entries expire at a given time.
+
+    Each entry carries an absolute expiry (seconds since the epoch, to line up with JWT `exp`
+    claims). Expired entries are treated as missing and dropped when next looked up. Once the
+    cache holds `maxsize` entries the least recently used one is evicted to make room. Hits
+    and misses are counted so the effectiveness of the cache can be monitored.
+
+    """
+
+    def __init__(self: Any, maxsize: int, ttl: float) -> None:
+        """Create an empty cache, `ttl` is used for entries set without an explicit expiry."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self: Any, key: str, default: Any = None) -> Any:
+        """Return the value for key, or default if it is missing or has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(
+        self: Any, key: str, value: Any, expires_at: Optional[float] = None
+    ) -> None:
+        """Store value under key until expires_at, evicting the oldest entry if full."""
+        if expires_at is None:
+            expires_at = time.time() + self.ttl
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self: Any, key: str) -> None:
+        """Remove key from the cache if it is present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self: Any) -> None:
+        """Remove every entry from the cache."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self: Any) -> dict:
+        """Return the hit and miss counters and the current size of the cache."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+            }
+
+    def __len__(self: Any) -> int:
+        """Return the number of entries held, including any not yet purged after expiry."""
+        return len(self._entries)
+
+
+class RedisCache(CacheBackend):
+    """A cache kept in a Redis-like store, so it can be shared between worker processes.
+
+    The client only needs `get(key)`, `set(key, value, ex=seconds)`, `delete(*keys)` and
+    `scan_iter(match=pattern)`, as provided by redis-py. Keys are namespaced with `prefix`
+    so several caches can share one store. Values are pickled, so the store must be trusted.
+
+    """
+
+    def __init__(self: Any, client: Any, prefix: str, ttl: float) -> None:
+        """Wrap the client, `ttl` is used for entries set without an explicit expiry."""
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self: Any, key: str, default: Any = None) -> Any:
+        """Return the value for key, or default if it is missing or has expired."""
+        value = self.client.get(self.prefix + key)
+        return default if value is None else pickle.loads(value)
+
+    def set(
+        self: Any, key: str, value: Any, expires_at: Optional[float] = None
+    ) -> None:
+        """Store value under key until expires_at, or for the default ttl."""
+        ttl = self.ttl if expires_at is None else expires_at - time.time()
+        if ttl > 0:
+            self.client.set(self.prefix + key, pickle.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self: Any, key: str) -> None:
+        """Remove key from the cache if it is present."""
+        self.client.delete(self.prefix + key)
+
+    def clear(self: Any) -> None:
+        """Remove every entry under this cache's prefix."""
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+def create_cache(
+    app_config: dict, prefix: str, maxsize: int, ttl: float
+) -> CacheBackend:
+    """Create a cache in this process, or in Redis to share it between workers if configured.
+
+    Entries are kept for `ttl` seconds unless set with an expiry. An in-process cache holds at
+    most `maxsize` entries, a Redis one is namespaced by `prefix` and bounded by Redis itself.
+
+    """
+    if app_config["CACHE_REDIS_URL"]:
+        # redis is only needed when caches are shared, so only import it for them.
+        import redis
+
+        return RedisCache(
+            redis.Redis.from_url(app_config["CACHE_REDIS_URL"]), prefix, ttl
+        )
+    return TTLCache(maxsize=maxsize, ttl=ttl)
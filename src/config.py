@@ -20,10 +20,57 @@ class BaseConfig:
     # DynamoDB Config
     AWS_DEFAULT_REGION = "eu-west-2"
     DATABASE_URL = os.getenv("DATABASE_URL")
+    # Threads used to send BatchWriteItem calls in parallel.
+    DYNAMODB_BATCH_WRITE_WORKERS = 4
+    # Retries for items DynamoDB leaves unprocessed.
+    DYNAMODB_BATCH_WRITE_MAX_RETRIES = 8
+
+    # Cache Config
+    # Share caches between workers in Redis, if set.
+    CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+
+    # Integrations Config
+    INTEGRATIONS_CACHE_SIZE = 1024
+    # Seconds before a cached integration record is reread.
+    INTEGRATIONS_CACHE_TTL = 5 * 60
+    # Seconds before expiry to refresh access tokens.
+    INTEGRATIONS_TOKEN_REFRESH_MARGIN = 5 * 60
+    # Seconds one process may hold the lease on a token refresh.
+    INTEGRATIONS_REFRESH_LEASE = 30
+    # Seconds between checks for another process's refresh.
+    INTEGRATIONS_REFRESH_POLL = 0.5
+
+    # Outbound HTTP Config
+    HTTP_POOL_HOSTS = 10  # Hosts to keep a pool of open connections to.
+    # Connections kept open to each host, enough for every sync worker.
+    HTTP_POOL_SIZE = 32
+    HTTP_CONNECT_TIMEOUT = 5  # Seconds to wait for a connection.
+    HTTP_READ_TIMEOUT = 60  # Seconds to wait for a response.
+    # Retries for GETs that fail to connect or with a server error.
+    HTTP_GET_RETRIES = 3
+    HTTP_RETRY_BACKOFF = 0.5  # Seconds, doubled on each retry.
+
+    # Files API Config
+    # Also look up legacy references, until they're migrated.
+    FILES_LEGACY_REFERENCES = True
+    FILES_PAGE_DEFAULT_LIMIT = 50
+    FILES_PAGE_MAX_LIMIT = 1000
 
     # Auth Config
     AUTH_TENANT_URL = "https://thea-tenant.eu.auth0.com"
     AUTH_JWT_AUDIENCE = "https://thea-core.com/api"
+    AUTH_JWKS_TTL = 60 * 60  # Seconds before the cached signing keys are refreshed.
+    # Minimum seconds between refetches for unknown kids.
+    AUTH_JWKS_MIN_REFETCH_INTERVAL = 30
+    # Custom claim added by an Auth0 rule.
+    AUTH_EMAIL_CLAIM = "https://thea-core.com/email"
+    AUTH_USERINFO_CACHE_SIZE = 1024
+    AUTH_USERINFO_CACHE_TTL = 5 * 60  # Seconds, used when the token has no exp claim.
+    AUTH_TOKEN_CACHE_SIZE = 4096
+    # Seconds, upper bound on how long a verified token is kept.
+    AUTH_TOKEN_CACHE_TTL = 60 * 60
+    # Seconds of leeway allowed between our clock and the tenant's.
+    AUTH_CLOCK_SKEW = 30
 
     # MSAL Config
     MSAL_APP_ID = os.getenv("MSAL_APP_ID")
@@ -32,8 +79,38 @@ class BaseConfig:
     MSAL_SCOPES = ["mail.read"]
     MSAL_AUTHORITY = "https://login.microsoftonline.com/common"
 
+    # Synchronisation Config
+    # Attachments found by a sync are written this many at a time.
+    SYNC_WRITE_BATCH_SIZE = 100
+    # Times a throttled request is queued again before giving up.
+    SYNC_THROTTLE_RETRIES = 5
+    SYNC_LIMITER_CACHE_SIZE = 4096  # Mailboxes whose rate limiters are kept at once.
+    # Seconds a mailbox's rate limiter is kept after its last use.
+    SYNC_LIMITER_IDLE_TTL = 60 * 60
+    # "thread" runs jobs on background threads, "immediate" inline.
+    SYNC_JOB_QUEUE = "thread"
+    SYNC_JOB_WORKERS = 2  # Threads running synchronisation jobs.
+    SYNC_JOB_STORE_SIZE = 1024
+    SYNC_JOB_TTL = 24 * 60 * 60  # Seconds a job's status can be read for.
+    SYNC_ASYNC_ENGINE = False  # Run full syncs on the asyncio engine, needs aiohttp.
+    # Seconds before a request on the asyncio engine gives up.
+    SYNC_ASYNC_REQUEST_TIMEOUT = 60
+
     # Microsoft Outlook Graph API Config
-    GRAPH_API_REQUEST_LIMIT = 100
+    # Requests per second to start each mailbox at, adapted as Graph allows.
+    GRAPH_API_RATE = 8
+    GRAPH_API_MIN_RATE = 0.5
+    # Graph allows 10,000 requests per mailbox every ten minutes.
+    GRAPH_API_MAX_RATE = 16
+    GRAPH_API_FETCH_WORKERS = 4  # Graph allows four concurrent requests per mailbox.
+    # Fetch attachment metadata with each page of emails.
+    GRAPH_API_EXPAND_ATTACHMENTS = True
+    # List attachments 20 emails at a time with $batch calls.
+    GRAPH_API_BATCH_REQUESTS = True
+    # Concurrent $batch calls, each already counts many lookups.
+    GRAPH_API_BATCH_WORKERS = 1
+    # Requests in flight per mailbox on the asyncio engine.
+    GRAPH_API_ASYNC_IN_FLIGHT = 4
 
     # Google Config
     GOOGLE_APP_ID = os.getenv("GOOGLE_APP_ID")
@@ -42,6 +119,20 @@ class BaseConfig:
     GOOGLE_SCOPES = "openid email https://www.googleapis.com/auth/gmail.readonly"
     GOOGLE_AUTHORITY = "https://accounts.google.com/o/oauth2/v2/auth?access_type=offline&prompt=consent"
 
+    # Gmail API Config
+    # Requests per second to start each mailbox at, adapted as Gmail allows.
+    GMAIL_API_RATE = 20
+    GMAIL_API_MIN_RATE = 1
+    # Gmail allows 250 quota units per user per second, 5 per message.
+    GMAIL_API_MAX_RATE = 50
+    # Concurrent message fetches, well within Gmail's per-user quota.
+    GMAIL_API_FETCH_WORKERS = 10
+    GMAIL_API_BATCH_REQUESTS = True  # Fetch messages 50 at a time with batch requests.
+    # Concurrent batch requests, each already counts many fetches.
+    GMAIL_API_BATCH_WORKERS = 2
+    # Requests in flight per mailbox on the asyncio engine.
+    GMAIL_API_ASYNC_IN_FLIGHT = 50
+
 
 class DevelopmentConfig(BaseConfig):
     """Development configuration options."""
@@ -53,6 +144,7 @@ class TestingConfig(BaseConfig):
     """Testing configuration options."""
 
     TESTING = True
+    SYNC_JOB_QUEUE = "immediate"
 
 
 class ProductionConfig(BaseConfig):
@@ -2,13 +2,27 @@
 
 import json
 import pathlib
-from datetime import datetime
-from typing import Any
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Iterator, Optional, Union
 
-from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.conditions import Attr, Key
 
 from src.dynamodb.db_setup import get_dynamodb_connection
 
+# The most requests DynamoDB accepts in a single BatchWriteItem and BatchGetItem call.
+BATCH_WRITE_SIZE = 25
+BATCH_GET_SIZE = 100
+
+# References are "<created>#<name>", so a user's files sort by creation time. Legacy references
+# were "<name><created>", with created formatted like "nov-11-2021T07:45:15".
+REFERENCE_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+LEGACY_REFERENCE_TIMESTAMP_FORMAT = "%b-%d-%YT%H:%M:%S"
+REFERENCE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}#")
+
 
 class ConnectionManager:
     """Manages the connection to the dynamo database.
@@ -30,6 +44,9 @@ class ConnectionManager:
         region = app_config["AWS_DEFAULT_REGION"]
         in_production = app_config["PRODUCTION"]
         do_seed = app_config["SEED"]
+        self.batch_write_workers = app_config["DYNAMODB_BATCH_WRITE_WORKERS"]
+        self.batch_write_max_retries = app_config["DYNAMODB_BATCH_WRITE_MAX_RETRIES"]
+        self.legacy_references = app_config["FILES_LEGACY_REFERENCES"]
 
         self.db = get_dynamodb_connection(endpoint_url, region)
 
@@ -71,18 +88,54 @@ class ConnectionManager:
     def _create_table(self: Any, table_schema: dict) -> Any:
         """Create a table in the database using the provided schema and return it."""
         try:
-            return self.db.create_table(
-                TableName=table_schema["TableName"],
-                KeySchema=table_schema["KeySchema"],
-                AttributeDefinitions=table_schema["AttributeDefinitions"],
-                ProvisionedThroughput=table_schema["ProvisionedThroughput"],
-            )
+            table = {
+                "TableName": table_schema["TableName"],
+                "KeySchema": table_schema["KeySchema"],
+                "AttributeDefinitions": table_schema["AttributeDefinitions"],
+                "ProvisionedThroughput": table_schema["ProvisionedThroughput"],
+            }
+            for indexes in ["GlobalSecondaryIndexes", "LocalSecondaryIndexes"]:
+                if indexes in table_schema.keys():
+                    table[indexes] = table_schema[indexes]
+            return self.db.create_table(**table)
         except Exception as e:
             if e.__class__.__name__ == "ResourceInUseException":
-                return self.db.Table(table_schema["TableName"])
+                table = self.db.Table(table_schema["TableName"])
+                self._create_missing_indexes(table, table_schema)
+                return table
             else:
                 raise e
 
+    def _create_missing_indexes(self: Any, table: Any, table_schema: dict) -> None:
+        """Add any global secondary indexes in the schema that an existing table is missing.
+
+        Local secondary indexes can only be created along with the table, so tables that
+        predate one have to be recreated.
+
+        """
+        existing = {
+            index["IndexName"] for index in table.global_secondary_indexes or []
+        }
+        updates = [
+            {"Create": index}
+            for index in table_schema.get("GlobalSecondaryIndexes", [])
+            if index["IndexName"] not in existing
+        ]
+
+        # DynamoDB only allows one index to be created at a time, so wait for each to finish.
+        for update in updates:
+            table.update(
+                AttributeDefinitions=table_schema["AttributeDefinitions"],
+                GlobalSecondaryIndexUpdates=[update],
+            )
+            table.reload()
+            while any(
+                index["IndexStatus"] != "ACTIVE"
+                for index in table.global_secondary_indexes
+            ):
+                time.sleep(1)
+                table.reload()
+
     def seed_db(self: Any, seed_data: list) -> bool:
         """Add all items in the provided list to the table, do no validation checks."""
         for item in seed_data:
@@ -94,53 +147,596 @@ class ConnectionManager:
         all_items = self.files_table.scan()
         return all_items["Items"]
 
+    def _format_created(self: Any, created: Union[str, datetime], fmt: str) -> str:
+        """Format a created date time, given as a datetime or ISO string, for use in a key."""
+        if not isinstance(created, datetime):
+            created = datetime.fromisoformat(created)
+        if created.tzinfo is not None:
+            created = created.astimezone(timezone.utc).replace(tzinfo=None)
+        return created.strftime(fmt)
+
     def _build_reference(self: Any, name: str, created: str) -> str:
-        created_date_time = datetime.fromisoformat(created)
-        created_formatted = created_date_time.strftime("%b-%d-%YT%H:%M:%S").lower()
-        return name + created_formatted
-
-    def get_files(self: Any, user: str) -> list:
-        """Get all files from the database belonging to the specified user."""
-        response = self.files_table.query(
-            KeyConditionExpression=Key("user").eq(user), ConsistentRead=True
+        return f"{self._format_created(created, REFERENCE_TIMESTAMP_FORMAT)}#{name}"
+
+    def _build_legacy_reference(self: Any, name: str, created: str) -> str:
+        # Legacy items were keyed on the local time as given, so don't normalise it to UTC.
+        if not isinstance(created, datetime):
+            created = datetime.fromisoformat(created)
+        return name + created.strftime(LEGACY_REFERENCE_TIMESTAMP_FORMAT).lower()
+
+    def _references(self: Any, name: str, created: str) -> list:
+        """Return every reference a file could be stored under whilst migration is ongoing."""
+        references = [self._build_reference(name, created)]
+        if self.legacy_references:
+            references.append(self._build_legacy_reference(name, created))
+        return references
+
+    def _reference_bounds(
+        self: Any, from_datetime: Optional[datetime], to_datetime: Optional[datetime]
+    ) -> tuple:
+        """Return inclusive sort key bounds for the files created in the range.
+
+        "#" separates the timestamp from the name, so "$", the next character up, sorts after
+        every name created in the final second. Without a bound, "0" and "A" bracket every
+        time ordered reference.
+
+        """
+        lower = "0"
+        upper = "A"
+        if from_datetime is not None:
+            lower = self._format_created(from_datetime, REFERENCE_TIMESTAMP_FORMAT)
+        if to_datetime is not None:
+            upper = self._format_created(to_datetime, REFERENCE_TIMESTAMP_FORMAT) + "$"
+        return lower, upper
+
+    def files_index(
+        self: Any,
+        sender: Optional[str] = None,
+        file_type: Optional[str] = None,
+        **filters: Any,
+    ) -> Optional[str]:
+        """Return the name of the index a query with these filters reads, None for the table."""
+        if sender is not None:
+            return "SenderIndex"
+        if file_type is not None:
+            return "TypeIndex"
+        return None
+
+    def _build_query(
+        self: Any,
+        user: str,
+        from_datetime: Optional[datetime] = None,
+        to_datetime: Optional[datetime] = None,
+        sender: Optional[str] = None,
+        file_type: Optional[str] = None,
+        descending: bool = False,
+    ) -> dict:
+        """Build the query for a user's files, picking the index that fits the filters.
+
+        Filtering by sender uses the SenderIndex and by type the TypeIndex, whose sort keys
+        are "<sender or type>#<reference>", so either can be combined with a created range.
+        Filtering by both queries the SenderIndex, as senders are the more selective, and
+        filters the type on the results. Index queries only read the projected attributes.
+
+        """
+        ranged = from_datetime is not None or to_datetime is not None
+        query = {"ScanIndexForward": not descending}
+
+        index = self.files_index(sender=sender, file_type=file_type)
+        if index == "SenderIndex":
+            sort_key, prefix = "sender_key", f"{sender.lower()}#"
+        elif index == "TypeIndex":
+            sort_key, prefix = "type_key", f"{file_type.lower()}#"
+        else:
+            sort_key, prefix = "reference", ""
+        if index is not None:
+            query["IndexName"] = index
+
+        condition = Key("user").eq(user)
+        if ranged:
+            lower, upper = self._reference_bounds(from_datetime, to_datetime)
+            condition = condition & Key(sort_key).between(
+                prefix + lower, prefix + upper
+            )
+        elif prefix:
+            condition = condition & Key(sort_key).begins_with(prefix)
+        query["KeyConditionExpression"] = condition
+
+        if "IndexName" in query.keys():
+            attributes = [
+                "user",
+                "reference",
+                "name",
+                "created",
+                "sender",
+                "type",
+                "link",
+            ]
+            query["ProjectionExpression"] = ", ".join(f"#{a}" for a in attributes)
+            query["ExpressionAttributeNames"] = {f"#{a}": a for a in attributes}
+            if sender is not None and file_type is not None:
+                query["FilterExpression"] = Attr("type_key").begins_with(
+                    f"{file_type.lower()}#"
+                )
+
+        return query
+
+    def _legacy_filter(self: Any, query: dict, filters: dict) -> Any:
+        """Return a predicate that drops legacy items a range query matched by their name.
+
+        Legacy references start with the file name, so a range query on the table's sort key
+        can match them by accident. Index sort keys are only ever built from new references.
+
+        """
+        ranged = (
+            filters.get("from_datetime") is not None
+            or filters.get("to_datetime") is not None
         )
-        return response["Items"]
-        # Todo: Generalise to multiple batches, see LastEvaluatedKey.
+        if not ranged or "IndexName" in query.keys():
+            return lambda item: True
+        return lambda item: REFERENCE_PATTERN.match(item["reference"]) is not None
+
+    def get_files(self: Any, user: str, **filters: Any) -> Iterator[dict]:
+        """Yield all files from the database belonging to the specified user.
+
+        Results are read one query page at a time, following LastEvaluatedKey until the
+        partition is exhausted, so only a single page is ever held in memory. The files can
+        be restricted to a created range (`from_datetime`, `to_datetime`), a `sender` or a
+        `file_type`, and returned newest first (`descending`), see _build_query. Range
+        queries only see files already migrated to the time ordered references.
+
+        """
+        query = self._build_query(user, **filters)
+        is_current = self._legacy_filter(query, filters)
+
+        # Global secondary indexes don't support consistent reads.
+        query["ConsistentRead"] = "IndexName" not in query.keys()
+        while True:
+            response = self.files_table.query(**query)
+            for item in response["Items"]:
+                if is_current(item):
+                    yield item
+
+            if "LastEvaluatedKey" not in response.keys():
+                return
+            query["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def get_files_page(
+        self: Any,
+        user: str,
+        limit: int,
+        exclusive_start_key: Optional[dict] = None,
+        consistent_read: bool = False,
+        **filters: Any,
+    ) -> tuple:
+        """Get a single page of at most `limit` files belonging to the specified user.
+
+        Returns the files and the LastEvaluatedKey to pass back in as `exclusive_start_key`
+        to fetch the next page, which is None once there are no more files. Pages are read
+        with eventual consistency by default as they cost half the read capacity. The
+        filters are the same as for get_files.
+
+        """
+        query = self._build_query(user, **filters)
+        query["Limit"] = limit
+        query["ConsistentRead"] = consistent_read and "IndexName" not in query.keys()
+        if exclusive_start_key is not None:
+            query["ExclusiveStartKey"] = exclusive_start_key
+
+        response = self.files_table.query(**query)
+        is_current = self._legacy_filter(query, filters)
+        items = [item for item in response["Items"] if is_current(item)]
+        return items, response.get("LastEvaluatedKey")
+
+    def _prepare_file(self: Any, user: str, file: dict) -> dict:
+        """Add the user, reference and secondary index keys to a file about to be written."""
+        file["reference"] = self._build_reference(file["name"], file["created"])
+        file["user"] = user
+
+        # Index keys are only set for files that have the attribute, keeping the indexes sparse.
+        for attribute, index_key in [("sender", "sender_key"), ("type", "type_key")]:
+            if file.get(attribute):
+                file[index_key] = f"{str(file[attribute]).lower()}#{file['reference']}"
+            else:
+                file.pop(index_key, None)
+        return file
 
     def put_file(self: Any, user: str, file: str) -> bool:
         """Add a file to the database for the specified user."""
-        # Create and add the reference and user.
-        file["reference"] = self._build_reference(file["name"], file["created"])
-        file["user"] = user
+        # Create and add the reference, user and index keys.
+        self._prepare_file(user, file)
 
         self.files_table.put_item(Item=file)
         # Todo: Check it actually puts.
+
+        # Remove any copy stored under the legacy reference so the file isn't listed twice.
+        if self.legacy_references:
+            legacy_reference = self._build_legacy_reference(
+                file["name"], file["created"]
+            )
+            self.files_table.delete_item(
+                Key={"user": user, "reference": legacy_reference}
+            )
         return "SUCCESS"
 
-    def delete_file(self: Any, user: str, file: dict) -> bool:
-        """Delete a single file from the database belonging to the specified user."""
-        reference = self._build_reference(file["name"], file["created"])
+    def _backoff(self: Any, attempt: int) -> None:
+        """Sleep before retrying a batch, using exponential backoff with full jitter."""
+        time.sleep(random.uniform(0, min(5.0, 0.05 * 2 ** attempt)))
+
+    def _write_batch(self: Any, table: Any, batch: list) -> list:
+        """Write a single batch of requests to the table, returning any left unprocessed.
+
+        Unprocessed items are retried with exponential backoff and full jitter, giving up
+        after the configured number of retries.
+
+        """
+        attempt = 0
+        while batch:
+            response = self.db.batch_write_item(RequestItems={table.name: batch})
+            batch = response.get("UnprocessedItems", {}).get(table.name, [])
+            if not batch or attempt >= self.batch_write_max_retries:
+                break
+            self._backoff(attempt)
+            attempt += 1
+        return batch
+
+    def _batch_write(self: Any, table: Any, requests: list, max_workers: int) -> list:
+        """Write the requests in batches, optionally in parallel, returning any unprocessed."""
+        batches = [
+            requests[i : i + BATCH_WRITE_SIZE]
+            for i in range(0, len(requests), BATCH_WRITE_SIZE)
+        ]
+        if max_workers > 1 and len(batches) > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(
+                    executor.map(lambda b: self._write_batch(table, b), batches)
+                )
+        else:
+            results = [self._write_batch(table, b) for b in batches]
+        return [request for unprocessed in results for request in unprocessed]
+
+    def put_files(
+        self: Any, user: str, files: list, max_workers: Optional[int] = None
+    ) -> dict:
+        """Add many files to the database for the specified user using batch writes.
+
+        Returns the status of each file keyed by its reference, which is also set on each of
+        the files, SUCCESS once written or FAILED if it was still unprocessed after retrying.
+        Files sharing a name, e.g. attachments of different emails, are reported separately.
+        As with repeated calls to put_file, a later file with the same name and created date
+        replaces an earlier one.
+
+        """
+        if max_workers is None:
+            max_workers = self.batch_write_workers
+
+        # A batch can't contain the same key twice, so keep only the last of any duplicates.
+        items = {}
+        for file in files:
+            self._prepare_file(user, file)
+            items[file["reference"]] = file
+
+        requests = [{"PutRequest": {"Item": item}} for item in items.values()]
+        unprocessed = self._batch_write(self.files_table, requests, max_workers)
+        failed = {r["PutRequest"]["Item"]["reference"] for r in unprocessed}
+
+        # Remove any copies stored under legacy references so files aren't listed twice.
+        if self.legacy_references:
+            requests = [
+                {
+                    "DeleteRequest": {
+                        "Key": {"user": user, "reference": legacy_reference}
+                    }
+                }
+                for legacy_reference in {
+                    self._build_legacy_reference(item["name"], item["created"])
+                    for item in items.values()
+                    if item["reference"] not in failed
+                }
+            ]
+            self._batch_write(self.files_table, requests, max_workers)
+
+        status = {}
+        for reference in items.keys():
+            status[reference] = "FAILED" if reference in failed else "SUCCESS"
+        return status
 
-        # Try and get the file first, to see if it exists.
-        response = self.files_table.get_item(
-            Key={"user": user, "reference": reference}, ConsistentRead=True
+    def delete_file(self: Any, user: str, file: dict) -> bool:
+        """Delete a single file from the database belonging to the specified user.
+
+        The old item is returned by the delete itself, so a single round trip tells us whether
+        the file existed (DELETED) or not (NOT_FOUND). Whilst legacy references are enabled, a
+        file not found under its current reference is also looked for under its legacy one.
+
+        """
+        for reference in self._references(file["name"], file["created"]):
+            if self._delete_reference(user, reference) == "DELETED":
+                return "DELETED"
+        return "NOT_FOUND"
+
+    def _delete_reference(self: Any, user: str, reference: str) -> str:
+        """Delete the file with the given reference, reporting whether it existed."""
+        response = self.files_table.delete_item(
+            Key={"user": user, "reference": reference}, ReturnValues="ALL_OLD"
         )
-
-        # If the item exists, delete and return SUCCESS.
-        if "Item" in response.keys():
-            self.files_table.delete_item(Key={"user": user, "reference": reference})
-            # Todo: Check it actually deletes.
-            return "DELETED"
-
-        # Otherwise report NOT_FOUND
-        else:
-            return "NOT_FOUND"
+        return "DELETED" if "Attributes" in response.keys() else "NOT_FOUND"
+
+    def _existing_references(self: Any, user: str, references: list) -> tuple:
+        """Look up which of the references exist for the user using batch gets.
+
+        Returns the set of references that exist and the set of any that DynamoDB still left
+        unprocessed after retrying, whose existence is therefore unknown.
+
+        """
+        existing = set()
+        unresolved = set()
+        for i in range(0, len(references), BATCH_GET_SIZE):
+            request = {
+                "Keys": [
+                    {"user": user, "reference": r}
+                    for r in references[i : i + BATCH_GET_SIZE]
+                ],
+                "ProjectionExpression": "#r",
+                "ExpressionAttributeNames": {"#r": "reference"},
+                "ConsistentRead": True,
+            }
+            attempt = 0
+            while request:
+                response = self.db.batch_get_item(
+                    RequestItems={self.files_table.name: request}
+                )
+                for item in response["Responses"].get(self.files_table.name, []):
+                    existing.add(item["reference"])
+
+                request = response.get("UnprocessedKeys", {}).get(self.files_table.name)
+                if not request:
+                    break
+                if attempt >= self.batch_write_max_retries:
+                    unresolved.update(key["reference"] for key in request["Keys"])
+                    break
+                self._backoff(attempt)
+                attempt += 1
+
+        return existing, unresolved
+
+    def delete_files(
+        self: Any, user: str, files: list, max_workers: Optional[int] = None
+    ) -> dict:
+        """Delete many files from the database belonging to the specified user.
+
+        Existence is checked with BatchGetItem and the files that exist are removed with
+        BatchWriteItem, so large lists take a handful of round trips rather than one per
+        file. Returns the status of each file keyed by name: DELETED, NOT_FOUND, or FAILED if
+        the delete was still unprocessed after retrying.
+
+        """
+        if max_workers is None:
+            max_workers = self.batch_write_workers
+
+        # A single file is cheaper to delete directly.
+        if len(files) == 1:
+            return {files[0]["name"]: self.delete_file(user, files[0])}
+
+        names = {}
+        for file in files:
+            for reference in self._references(file["name"], file["created"]):
+                names[reference] = file["name"]
+
+        existing, unresolved = self._existing_references(user, list(names.keys()))
+
+        requests = [
+            {"DeleteRequest": {"Key": {"user": user, "reference": r}}} for r in existing
+        ]
+        unprocessed = self._batch_write(self.files_table, requests, max_workers)
+        failed = {r["DeleteRequest"]["Key"]["reference"] for r in unprocessed}
+
+        status = {}
+        for reference, name in names.items():
+            if reference in unresolved:
+                result = self._delete_reference(user, reference)
+            elif reference not in existing:
+                result = "NOT_FOUND"
+            else:
+                result = "FAILED" if reference in failed else "DELETED"
+
+            # A file may be checked under both its references, the one that was found wins.
+            if status.get(name, "NOT_FOUND") == "NOT_FOUND":
+                status[name] = result
+        return status
+
+    def migrate_references(
+        self: Any,
+        segment: int,
+        total_segments: int,
+        exclusive_start_key: Optional[dict] = None,
+        limit: int = 100,
+        before_write: Any = None,
+    ) -> tuple:
+        """Rewrite one scanned page of files to time ordered references and index keys.
+
+        Scans a single page of the given parallel scan segment. Each legacy file is put under
+        its new reference and, only once that put has succeeded, deleted from its old one, so
+        an interrupted page can simply be run again. Files missing their secondary index keys
+        are rewritten in place. `before_write` is called with the number
+        of files about to be rewritten, which lets the caller rate limit the migration.
+
+        Returns the number of files migrated, the number skipped (their created date could not
+        be parsed, or the put failed, in which case they stay put for a later run), and the
+        LastEvaluatedKey to continue the segment from, which is None once it is finished.
+
+        """
+        scan = {"Segment": segment, "TotalSegments": total_segments, "Limit": limit}
+        if exclusive_start_key is not None:
+            scan["ExclusiveStartKey"] = exclusive_start_key
+        response = self.files_table.scan(**scan)
+
+        skipped = 0
+        migrations = []
+        for item in response["Items"]:
+            try:
+                migrated_item = self._prepare_file(item["user"], dict(item))
+            except (KeyError, TypeError, ValueError):
+                skipped += 1
+                continue
+
+            # Files already up to date, including their index keys, are left alone.
+            if migrated_item != item:
+                migrations.append((item["reference"], migrated_item))
+
+        if before_write is not None and migrations:
+            before_write(len(migrations))
+
+        # Two legacy items can map onto the same new key, and a batch can't repeat a key.
+        puts = {(item["user"], item["reference"]): item for _, item in migrations}
+        requests = [{"PutRequest": {"Item": item}} for item in puts.values()]
+        unprocessed = self._batch_write(self.files_table, requests, max_workers=1)
+        failed = {
+            (r["PutRequest"]["Item"]["user"], r["PutRequest"]["Item"]["reference"])
+            for r in unprocessed
+        }
+
+        migrated = 0
+        requests = []
+        for old_reference, item in migrations:
+            if (item["user"], item["reference"]) in failed:
+                skipped += 1
+                continue
+            migrated += 1
+            if old_reference != item["reference"]:
+                requests.append(
+                    {
+                        "DeleteRequest": {
+                            "Key": {"user": item["user"], "reference": old_reference}
+                        }
+                    }
+                )
+        self._batch_write(self.files_table, requests, max_workers=1)
+
+        return migrated, skipped, response.get("LastEvaluatedKey")
 
     def put_integrations(self: Any, user: str, integrations: dict) -> bool:
         integrations["user"] = user
         self.integrations_table.put_item(Item=integrations)
         return "SUCCESS"
 
+    def set_integration(self: Any, user: str, integration: str, value: dict) -> dict:
+        """Replace a single integration for the user, leaving any others untouched.
+
+        Returns all of the user's integrations as they are after the update.
+
+        """
+        response = self.integrations_table.update_item(
+            Key={"user": user},
+            UpdateExpression="SET #i = :value",
+            ExpressionAttributeNames={"#i": integration},
+            ExpressionAttributeValues={":value": value},
+            ReturnValues="ALL_NEW",
+        )
+        integrations = response["Attributes"]
+        del integrations["user"]
+        return integrations
+
+    def update_integration(
+        self: Any,
+        user: str,
+        integration: str,
+        fields: dict,
+        expected_version: Any = None,
+        versioned: bool = True,
+        remove: list = None,
+    ) -> Optional[dict]:
+        """Update fields within a single integration, guarded by its version.
+
+        Only the given attribute paths (e.g. msal.access_token) are written, in one round trip.
+        The write only succeeds if the integration's `_version` still equals expected_version
+        (or it has no version, if expected_version is None), and the version is incremented,
+        so a writer working from a stale copy can't overwrite a newer one. With
+        `versioned=False` the fields are written regardless and the version is left alone,
+        for fields that never conflict, such as sync state. Any fields named in `remove` are
+        removed from the integration in the same write.
+
+        Returns all of the user's integrations after the update, or None if the version check
+        failed, in which case nothing was written.
+
+        """
+        names = {"#i": integration}
+        values = {}
+        updates = []
+        for n, (field, value) in enumerate(fields.items()):
+            names[f"#f{n}"] = field
+            values[f":f{n}"] = value
+            updates.append(f"#i.#f{n} = :f{n}")
+
+        removals = []
+        for n, field in enumerate(remove or []):
+            names[f"#r{n}"] = field
+            removals.append(f"#i.#r{n}")
+
+        condition = "attribute_exists(#i)"
+        if versioned:
+            names["#v"] = "_version"
+            values[":next"] = (expected_version or 0) + 1
+            updates.append("#i.#v = :next")
+            if expected_version is None:
+                condition += " AND attribute_not_exists(#i.#v)"
+            else:
+                condition += " AND #i.#v = :expected"
+                values[":expected"] = expected_version
+
+        update_expression = "SET " + ", ".join(updates) if updates else ""
+        if removals:
+            update_expression += " REMOVE " + ", ".join(removals)
+
+        # DynamoDB rejects an empty map of values.
+        kwargs = {"ExpressionAttributeValues": values} if values else {}
+
+        try:
+            response = self.integrations_table.update_item(
+                Key={"user": user},
+                UpdateExpression=update_expression.strip(),
+                ConditionExpression=condition,
+                ExpressionAttributeNames=names,
+                ReturnValues="ALL_NEW",
+                **kwargs,
+            )
+        except Exception as e:
+            if e.__class__.__name__ == "ConditionalCheckFailedException":
+                return None
+            else:
+                raise e
+
+        integrations = response["Attributes"]
+        del integrations["user"]
+        return integrations
+
+    def acquire_integration_lease(
+        self: Any, user: str, integration: str, lease_until: int, now: int
+    ) -> bool:
+        """Try to take the lease on refreshing an integration's tokens, held until lease_until.
+
+        The lease is a timestamp on the integration, set with a conditional write that only
+        succeeds if no one else holds an unexpired lease, so only one process at a time can
+        hold it. It is released by removing `_refresh_lease` along with the refreshed tokens.
+        Returns whether the lease was taken.
+
+        """
+        try:
+            self.integrations_table.update_item(
+                Key={"user": user},
+                UpdateExpression="SET #i.#l = :until",
+                ConditionExpression=(
+                    "attribute_exists(#i) AND (attribute_not_exists(#i.#l) OR #i.#l < :now)"
+                ),
+                ExpressionAttributeNames={"#i": integration, "#l": "_refresh_lease"},
+                ExpressionAttributeValues={":until": lease_until, ":now": now},
+            )
+        except Exception as e:
+            if e.__class__.__name__ == "ConditionalCheckFailedException":
+                return False
+            else:
+                raise e
+        return True
+
     def get_integrations(self: Any, user: str) -> dict:
         # Try and get the integrations for this user.
         integrations = self.integrations_table.get_item(
@@ -152,19 +748,11 @@ class ConnectionManager:
         return integrations
 
     def delete_integrations(self: Any, user: str) -> bool:
-        # Try and get the file first, to see if it exists.
-        response = self.integrations_table.get_item(
-            Key={"user": user}, ConsistentRead=True
+        # Delete and find out whether the item existed in a single round trip.
+        response = self.integrations_table.delete_item(
+            Key={"user": user}, ReturnValues="ALL_OLD"
         )
-
-        # If the item exists, delete and return SUCCESS.
-        if "Item" in response.keys():
-            self.integrations_table.delete_item(Key={"user": user})
-            return "DELETED"
-
-        # Otherwise report NOT_FOUND
-        else:
-            return "NOT_FOUND"
+        return "DELETED" if "Attributes" in response.keys() else "NOT_FOUND"
 
 
 cm = ConnectionManager()
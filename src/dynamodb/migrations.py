@@ -0,0 +1,110 @@
+"""Define resumable migrations of the items stored in the dynamo database."""
+
+import json
+import pathlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+
+class RateLimiter:
+    """A token bucket shared between threads, refilled at `rate` tokens per second."""
+
+    def __init__(self: Any, rate: float) -> None:
+        """Start with a full bucket holding one second's worth of tokens."""
+        self.rate = rate
+        self._tokens = rate
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self: Any, tokens: int = 1) -> None:
+        """Block until the requested number of tokens are available, then take them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.rate, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+
+                # Requests bigger than the bucket are let through once it is full.
+                if self._tokens >= min(tokens, self.rate):
+                    self._tokens -= tokens
+                    return
+                wait = (min(tokens, self.rate) - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ReferenceMigration:
+    """Rewrites every file to the time ordered reference layout with secondary index keys.
+
+    The files table is read with a parallel scan, one thread per segment. After each page
+    the position of every segment is saved to a JSON state file, so an interrupted migration
+    picks up where it left off when run again with the same number of segments. Writes are
+    rate limited across all segments to leave capacity for normal traffic.
+
+    """
+
+    def __init__(
+        self: Any, cm: Any, state_path: str, total_segments: int = 4, rate: float = 50.0
+    ) -> None:
+        """Set up the migration, loading any saved progress from the state file."""
+        self.cm = cm
+        self.state_path = pathlib.Path(state_path)
+        self.total_segments = total_segments
+        self.limiter = RateLimiter(rate)
+        self._lock = threading.Lock()
+        self.state = self._load_state()
+
+    def _load_state(self: Any) -> dict:
+        """Load the saved progress, or start afresh if there is none."""
+        if not self.state_path.exists():
+            return {
+                "total_segments": self.total_segments,
+                "migrated": 0,
+                "skipped": 0,
+                "segments": {
+                    str(s): {"last_evaluated_key": None, "done": False}
+                    for s in range(self.total_segments)
+                },
+            }
+
+        state = json.loads(self.state_path.read_text())
+        if state["total_segments"] != self.total_segments:
+            raise ValueError(
+                f"Saved migration used {state['total_segments']} segments, "
+                "resume it with the same number."
+            )
+        return state
+
+    def _save_state(self: Any) -> None:
+        """Write the progress to the state file, via a temporary file so it is never torn."""
+        temporary_path = self.state_path.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps(self.state, indent=2))
+        temporary_path.replace(self.state_path)
+
+    def _migrate_segment(self: Any, segment: int) -> None:
+        """Migrate pages of the segment until it is finished."""
+        progress = self.state["segments"][str(segment)]
+        while not progress["done"]:
+            migrated, skipped, last_evaluated_key = self.cm.migrate_references(
+                segment,
+                self.total_segments,
+                exclusive_start_key=progress["last_evaluated_key"],
+                before_write=self.limiter.acquire,
+            )
+
+            with self._lock:
+                self.state["migrated"] += migrated
+                self.state["skipped"] += skipped
+                progress["last_evaluated_key"] = last_evaluated_key
+                progress["done"] = last_evaluated_key is None
+                self._save_state()
+
+    def run(self: Any) -> dict:
+        """Run the migration to completion and return the final progress."""
+        with ThreadPoolExecutor(max_workers=self.total_segments) as executor:
+            # Consume the results so an exception in any segment is raised here.
+            list(executor.map(self._migrate_segment, range(self.total_segments)))
+        return self.state
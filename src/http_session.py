@@ -0,0 +1,60 @@
+"""Define the pooled HTTP sessions used for calls out to the providers and Auth0."""
+
+from typing import Any
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Server errors that are worth retrying a GET for. Throttling (429 and 503) is left to the
+# rate limiters, which slow the whole mailbox down rather than just retrying the one call.
+RETRY_STATUSES = [500, 502, 504]
+
+
+class PooledSession(requests.Session):
+    """A session that keeps connections open to each host and applies a default timeout.
+
+    Reusing connections saves a TCP and TLS handshake on every call, which otherwise dominates
+    the small requests made to Graph and Gmail. Idempotent GETs that fail to connect, or fail
+    with a server error, are retried with exponential backoff, other methods never are.
+
+    """
+
+    def __init__(self: Any, app_config: dict) -> None:
+        """Mount an adapter with pools sized by the config."""
+        super().__init__()
+        self.timeout = (
+            app_config["HTTP_CONNECT_TIMEOUT"],
+            app_config["HTTP_READ_TIMEOUT"],
+        )
+
+        retry = Retry(
+            total=app_config["HTTP_GET_RETRIES"],
+            backoff_factor=app_config["HTTP_RETRY_BACKOFF"],
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=["GET"],
+            # Throttled calls are retried by the rate limiters, after waiting out Retry-After.
+            respect_retry_after_header=False,
+            # Hand the last response back to the caller, which deals with any error status.
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=app_config["HTTP_POOL_HOSTS"],
+            pool_maxsize=app_config["HTTP_POOL_SIZE"],
+            max_retries=retry,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+        # Ask for compressed bodies, requests decompresses them transparently.
+        self.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def request(self: Any, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """Make the request, with the default timeout unless the caller gives one."""
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(app_config: dict) -> PooledSession:
+    """Create a pooled session, to be shared by everything calling out to the same hosts."""
+    return PooledSession(app_config)
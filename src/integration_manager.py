@@ -1,7 +1,14 @@
-from typing import Any
+import copy
+import threading
+import time
+from typing import Any, Callable
 
-from src.integrations.msal import MSALRequestor
+from src.cache import CacheBackend, create_cache
+from src.http_session import create_session
 from src.integrations.google import GoogleRequestor
+from src.integrations.msal import MSALRequestor
+from src.integrations.tokens import token_expires_at
+
 
 class IntegrationManager:
     """This provides methods for handling integrations for a user.
@@ -10,29 +17,206 @@ class IntegrationManager:
 
     """
 
-    def initialise(self: Any, cm: Any, app_config: dict) -> None:
+    def initialise(
+        self: Any,
+        cm: Any,
+        app_config: dict,
+        cache: CacheBackend = None,
+        session: Any = None,
+    ) -> None:
         self.cm = cm
         self.app_config = app_config
 
+        # Integration records are read on every sync and token refresh, so keep them in a cache
+        # that is written through on every put, and shared between workers if Redis is configured.
+        if cache is None:
+            cache = create_cache(
+                app_config,
+                "integrations:",
+                maxsize=app_config["INTEGRATIONS_CACHE_SIZE"],
+                ttl=app_config["INTEGRATIONS_CACHE_TTL"],
+            )
+        self.cache = cache
+
+        # The requestors share one pooled session, so their connections to each provider are reused.
+        if session is None:
+            session = create_session(app_config)
+        self.session = session
+
+        # One lock per user and integration, so only one thread in the process refreshes a token.
+        self._refresh_locks = {}
+        self._refresh_locks_lock = threading.Lock()
+
+    def _get_integrations(self: Any, user: str) -> dict:
+        """Return the integrations for the user, reading through the cache.
+
+        A copy is returned so callers are free to modify it without changing the cache.
+
+        """
+        integrations = self.cache.get(user)
+        if integrations is None:
+            integrations = self.cm.get_integrations(user)
+            self.cache.set(user, copy.deepcopy(integrations))
+        else:
+            integrations = copy.deepcopy(integrations)
+        return integrations
+
+    def put_integrations(self: Any, user: str, integrations: dict) -> bool:
+        """Write the integrations for the user to the database and the cache."""
+        status = self.cm.put_integrations(user, integrations)
+
+        cached = copy.deepcopy(integrations)
+        cached.pop("user", None)
+        self.cache.set(user, cached)
+        return status
+
+    def invalidate(self: Any, user: str) -> None:
+        """Drop the cached integrations for the user, the next read goes to the database."""
+        self.cache.delete(user)
+
+    def _cache_integrations(self: Any, user: str, integrations: dict) -> None:
+        """Write the integrations returned by an update through to the cache."""
+        self.cache.set(user, copy.deepcopy(integrations))
+
     def add_integration(self: Any, user: str, integration: str, object: str) -> bool:
-        # This returns an empty object if no integrations have been added yet.
-        existing_integrations = self.cm.get_integrations(user)
+        """Store a newly authorised integration for the user, replacing any previous one.
+
+        Only this integration is written, the user's other integrations are left untouched.
+
+        """
+        # Start from a fresh version, which no writer working from the old object can match.
+        object = {**object, "_version": int(time.time() * 1000)}
+
+        # Record when the access token expires, so it can be refreshed before it does.
+        expires_at = token_expires_at(object)
+        if expires_at is not None:
+            object["expires_at"] = expires_at
+
+        integrations = self.cm.set_integration(user, integration, object)
+        self._cache_integrations(user, integrations)
 
-        # Add the user.
-        existing_integrations["user"] = user
+        return {**integrations, "user": user}
 
-        # Merge new integration.
-        existing_integrations[integration] = object
+    def update_integration(
+        self: Any,
+        user: str,
+        integration: str,
+        fields: dict,
+        version: Any = None,
+        remove: list = None,
+    ) -> dict:
+        """Update fields of an integration, e.g. a refreshed access token, and return it.
 
-        # Put the object.
-        self.cm.put_integrations(user, existing_integrations)
+        The fields are written with a single conditional update against `version`, the
+        `_version` of the copy of the integration the caller was working from. If someone else
+        updated it in the meantime nothing is written and their newer copy is returned
+        instead, so concurrent token refreshes never lose writes. Fields named in `remove` are
+        removed in the same write.
+
+        """
+        integrations = self.cm.update_integration(
+            user, integration, fields, version, remove=remove
+        )
+
+        if integrations is None:
+            self.invalidate(user)
+            return self.get_integration(user, integration)
+
+        self._cache_integrations(user, integrations)
+        return copy.deepcopy(integrations[integration])
+
+    def _refresh_lock(self: Any, user: str, integration: str) -> threading.Lock:
+        """Return the lock guarding refreshes of the integration's tokens in this process."""
+        with self._refresh_locks_lock:
+            return self._refresh_locks.setdefault((user, integration), threading.Lock())
+
+    def _refreshed(self: Any, user: str, integration: str, info: dict) -> Any:
+        """Reread the integration, returning it if its access token has changed since info."""
+        self.invalidate(user)
+        current = self.get_integration(user, integration)
+        if current.get("access_token") != info.get("access_token"):
+            return current
+        return None
+
+    def refresh_integration(
+        self: Any, user: str, integration: str, info: dict, request_token: Callable
+    ) -> dict:
+        """Refresh the integration's tokens, unless someone else already has, and return it.
+
+        `info` is the caller's copy of the integration, and `request_token` asks the provider
+        for new tokens, returning the fields to store. Callers in this process queue on a lock,
+        and callers in other processes on a lease held in the integration itself, so each
+        token is only refreshed once. Whoever gets the lock or lease first rereads the
+        integration, and if the access token is no longer the one the caller had, someone else
+        has refreshed it and the new one is returned without asking the provider.
+
+        """
+        with self._refresh_lock(user, integration):
+            current = self._refreshed(user, integration, info)
+            if current is not None:
+                return current
+
+            lease = self.app_config["INTEGRATIONS_REFRESH_LEASE"]
+            while not self.cm.acquire_integration_lease(
+                user, integration, int(time.time()) + lease, int(time.time())
+            ):
+                # Another process is refreshing the token, wait for it to store the new one.
+                # If it dies its lease runs out and we can take over.
+                time.sleep(self.app_config["INTEGRATIONS_REFRESH_POLL"])
+                current = self._refreshed(user, integration, info)
+                if current is not None:
+                    return current
+
+            # The other process may have finished just before we took the lease.
+            current = self._refreshed(user, integration, info)
+            if current is not None:
+                self.cm.update_integration(
+                    user, integration, {}, versioned=False, remove=["_refresh_lease"]
+                )
+                return current
+            current = self.get_integration(user, integration)
+
+            try:
+                fields = request_token()
+            except Exception:
+                self.cm.update_integration(
+                    user, integration, {}, versioned=False, remove=["_refresh_lease"]
+                )
+                raise
+
+            return self.update_integration(
+                user,
+                integration,
+                fields,
+                version=current.get("_version"),
+                remove=["_refresh_lease"],
+            )
+
+    def set_integration_fields(
+        self: Any, user: str, integration: str, fields: dict, remove: list = None
+    ) -> dict:
+        """Write fields that no one else competes over, e.g. sync state, into an integration.
+
+        Unlike update_integration this doesn't check or bump the version, so it never
+        invalidates a token refresh that is happening at the same time. Fields named in
+        `remove` are removed in the same write.
+
+        """
+        integrations = self.cm.update_integration(
+            user, integration, fields, versioned=False, remove=remove
+        )
+
+        # The update only fails its condition if the integration doesn't exist.
+        if integrations is None:
+            raise KeyError(f"No entry found for {integration} on {user}.")
 
-        return existing_integrations
+        self._cache_integrations(user, integrations)
+        return copy.deepcopy(integrations[integration])
 
     def get_integration(self: Any, user: str, integration: str) -> dict:
 
         # Try and get the integrations for this user.
-        integrations = self.cm.get_integrations(user)
+        integrations = self._get_integrations(user)
 
         # If no integrations at all, raise a Key Error.
         if len(integrations) == 0:
@@ -48,7 +232,7 @@ class IntegrationManager:
         requestor_map = {"msal": MSALRequestor, "google": GoogleRequestor}
 
         # Try and get the integrations for this user.
-        integrations = self.cm.get_integrations(user)
+        integrations = self._get_integrations(user)
 
         # If no integrations at all, raise a Key Error.
         if len(integrations) == 0:
@@ -57,7 +241,13 @@ class IntegrationManager:
         if integration not in integrations.keys():
             raise KeyError(f"No entry found for {integration} on {user}.")
         else:
-            return requestor_map[integration](user, integrations[integration], self, self.app_config)
+            return requestor_map[integration](
+                user,
+                integrations[integration],
+                self,
+                self.app_config,
+                session=self.session,
+            )
 
     def list_integrations(self: Any, user: str) -> list:
         """Return a list of the integrations belonging to the specified user.
@@ -75,7 +265,7 @@ class IntegrationManager:
 
         """
         # Try and get the integrations for this user.
-        integrations = self.cm.get_integrations(user)
+        integrations = self._get_integrations(user)
 
         # If no integrations at all, raise a Key Error.
         if len(integrations) == 0:
@@ -0,0 +1,127 @@
+"""Define asyncio counterparts of the provider requestors.
+
+The async requestors wrap the blocking ones, reusing their integration info and token refresh,
+but make their GETs on an aiohttp session so a single thread can keep many requests in flight.
+
+"""
+
+import asyncio
+from typing import Any, Callable
+
+from src.integrations.batch import BatchResponse
+from src.integrations.rate_limit import send_paced_async
+from src.integrations.tokens import token_expiring
+
+
+def create_session(app_config: dict) -> Any:
+    """Create the aiohttp session the async requestors share, to be closed by the caller."""
+    # aiohttp is only needed by crawls using the async engine, so only import it for them.
+    import aiohttp
+
+    return aiohttp.ClientSession(
+        timeout=aiohttp.ClientTimeout(total=app_config["SYNC_ASYNC_REQUEST_TIMEOUT"])
+    )
+
+
+class AsyncRequestor:
+    """GETs provider URLs on an aiohttp session, refreshing the access token when it expires.
+
+    The access token is refreshed shortly before it expires, and on a 401 it is refreshed and
+    the request retried once, as the blocking requestors do. Coroutines that see a 401 at the
+    same time share a single refresh, and a coroutine whose token was already replaced by
+    someone else's refresh just retries. The refresh itself is the blocking requestor's, run
+    on the default executor. Requests are paced by the blocking requestor's rate limiter, so
+    they share the mailbox's budget with any threaded sync, and at most `max_in_flight` are
+    made at once.
+
+    """
+
+    # The attribute of the blocking requestor holding the integration info.
+    info_attribute = None
+
+    def __init__(self: Any, requestor: Any, session: Any, max_in_flight: int) -> None:
+        """Wrap the blocking requestor, making requests on the given session."""
+        self.requestor = requestor
+        self.session = session
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._refresh = None
+
+    @property
+    def info(self: Any) -> dict:
+        """Return the integration info, as updated by the latest refresh."""
+        return getattr(self.requestor, self.info_attribute)
+
+    async def refresh_access_token(self: Any, stale_token: str) -> None:
+        """Refresh the access token, unless it has already been replaced since stale_token."""
+        if self.info["access_token"] != stale_token:
+            return
+
+        if self._refresh is None:
+            loop = asyncio.get_running_loop()
+            self._refresh = loop.run_in_executor(
+                None, self.requestor.refresh_access_token
+            )
+
+        refresh = self._refresh
+        try:
+            # Shield the refresh, so one waiter being cancelled doesn't cancel it for the rest.
+            await asyncio.shield(refresh)
+        finally:
+            if self._refresh is refresh:
+                self._refresh = None
+
+    async def _get(
+        self: Any, url: str, headers: dict, access_token: str
+    ) -> BatchResponse:
+        """Make one GET, reading the whole body so the connection can be reused."""
+        async with self._semaphore:
+            async with self.session.get(
+                url, headers={**headers, "Authorization": f"Bearer {access_token}"}
+            ) as response:
+                return BatchResponse(
+                    response.status, dict(response.headers), await response.text()
+                )
+
+    async def _send(self: Any, send: Callable) -> BatchResponse:
+        """Make the request once the blocking requestor's rate limiter allows, retrying it if throttled."""
+        return await send_paced_async(
+            self.requestor.limiter,
+            send,
+            max_retries=self.requestor.app_config["SYNC_THROTTLE_RETRIES"],
+        )
+
+    async def get(self: Any, url: str, headers: dict = None) -> BatchResponse:
+        """GET the URL, returning a response that quacks like a requests.Response."""
+        headers = headers or {}
+
+        # Refresh the access token before it expires, rather than waiting to be rejected.
+        margin = self.requestor.app_config["INTEGRATIONS_TOKEN_REFRESH_MARGIN"]
+        if token_expiring(self.info, margin):
+            await self.refresh_access_token(self.info["access_token"])
+
+        access_token = self.info["access_token"]
+        response = await self._send(lambda: self._get(url, headers, access_token))
+
+        # Check for expired token error.
+        if response.status_code == 401:
+
+            # Try and refresh the access token.
+            await self.refresh_access_token(access_token)
+
+            response = await self._send(
+                lambda: self._get(url, headers, self.info["access_token"])
+            )
+
+        return response
+
+
+class AsyncMSALRequestor(AsyncRequestor):
+    """The async counterpart of MSALRequestor."""
+
+    info_attribute = "msal_info"
+
+
+class AsyncGoogleRequestor(AsyncRequestor):
+    """The async counterpart of GoogleRequestor."""
+
+    info_attribute = "google_info"
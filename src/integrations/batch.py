@@ -0,0 +1,60 @@
+"""Define the pieces shared by the batched requests to each provider."""
+
+import json
+from typing import Any, Iterable
+
+import requests
+
+# Statuses that mean a sub-request was throttled or hit a transient error, and is worth retrying.
+RETRY_STATUSES = [requests.codes.too_many_requests, requests.codes.service_unavailable]
+
+# Upper bound on how long we wait for a throttled request before retrying it.
+MAX_RETRY_AFTER = 60
+
+
+class BatchResponse:
+    """One response split out of a batch, it quacks like the requests.Response it stands in for.
+
+    Only what the synchronisations use is provided: `status_code`, `headers`, `json()` and `text`.
+
+    """
+
+    def __init__(self: Any, status_code: int, headers: dict, body: Any) -> None:
+        """Hold the parts of the response, the body already decoded from JSON if it was JSON."""
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        self.body = body
+
+    def json(self: Any) -> Any:
+        """Return the decoded body."""
+        if isinstance(self.body, str):
+            return json.loads(self.body)
+        return self.body
+
+    @property
+    def text(self: Any) -> str:
+        """Return the body as text, for error messages."""
+        if isinstance(self.body, str):
+            return self.body
+        return json.dumps(self.body)
+
+
+def retry_after(response: Any, default: float = 1) -> float:
+    """Return how many seconds the response asks us to wait before retrying, within reason."""
+    try:
+        seconds = float(response.headers.get("Retry-After", default))
+    except ValueError:
+        seconds = default
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+def chunked(items: Iterable, size: int) -> Any:
+    """Yield successive lists of at most size items, taking items from the iterable lazily."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
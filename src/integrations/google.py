@@ -1,58 +1,258 @@
-from typing import Any
+import uuid
+from typing import Any, Callable, Optional
 
 import msal
 import requests
 from flask import abort
 
+from src.integrations.batch import RETRY_STATUSES, BatchResponse, chunked, retry_after
+from src.integrations.rate_limit import get_limiter, send_paced
+from src.integrations.tokens import token_expires_at, token_expiring
+
+GMAIL_API_ROOT = "https://gmail.googleapis.com"
+
+# Gmail accepts 100 calls in one batch request, but throttles batches of more than 50.
+GMAIL_BATCH_SIZE = 50
+
+
 class GoogleRequestor:
-    def __init__(self: Any, user: str, google_info: dict, im: Any, app_config: dict) -> None:
+    def __init__(
+        self: Any,
+        user: str,
+        google_info: dict,
+        im: Any,
+        app_config: dict,
+        limiter: Any = None,
+        session: Any = None,
+    ) -> None:
         self.user = user
         self.google_info = google_info
         self.im = im
         self.app_config = app_config
 
-    def refresh_access_token(self: Any) -> bool:
+        # Calls are made on the shared pooled session, or a fresh connection each without one.
+        self.session = session or requests
 
-        response = requests.post(
+        # Requests to Gmail for this mailbox are paced by a limiter shared by all its syncs.
+        if limiter is None:
+            limiter = get_limiter(
+                user,
+                "google",
+                rate=app_config["GMAIL_API_RATE"],
+                min_rate=app_config["GMAIL_API_MIN_RATE"],
+                max_rate=app_config["GMAIL_API_MAX_RATE"],
+            )
+        self.limiter = limiter
+
+    def _request_token(self: Any) -> dict:
+        """Ask the provider for new tokens, returning the fields of the integration to update."""
+        response = self.session.post(
             f"https://www.googleapis.com/oauth2/v4/token",
             headers={
                 "Content-Type": "application/x-www-form-urlencoded",
                 "Authorization": f"Bearer {self.google_info['access_token']}",
             },
             data={
-                "client_id": self.app_config['GOOGLE_APP_ID'],
-                "scope": self.app_config['GOOGLE_SCOPES'],
+                "client_id": self.app_config["GOOGLE_APP_ID"],
+                "scope": self.app_config["GOOGLE_SCOPES"],
                 "refresh_token": self.google_info["refresh_token"],
-                "redirect_uri": self.app_config['GOOGLE_REDIRECT'],
+                "redirect_uri": self.app_config["GOOGLE_REDIRECT"],
                 "grant_type": "refresh_token",
-                "client_secret": self.app_config['GOOGLE_APP_SECRET'],
+                "client_secret": self.app_config["GOOGLE_APP_SECRET"],
             },
         )
         if response.status_code == 200:
             data = response.json()
-            self.google_info["access_token"] = data["access_token"]
-            self.im.add_integration(self.user, "msal", self.google_info)
-            return
+
+            # Only write the refreshed tokens, some providers also rotate the refresh token.
+            fields = {"access_token": data["access_token"]}
+            if "refresh_token" in data.keys():
+                fields["refresh_token"] = data["refresh_token"]
+
+            expires_at = token_expires_at(data)
+            if expires_at is not None:
+                fields["expires_at"] = expires_at
+
+            return fields
         else:
-            abort(
-                401, f"Could not refresh access token: {response.text}"
-            )
+            abort(401, f"Could not refresh access token: {response.text}")
 
-    def get(self: Any, request: Any) -> Any:
-        response = requests.get(
-            request,
-            headers={"Authorization": f"Bearer {self.google_info['access_token']}"},
+    def refresh_access_token(self: Any) -> None:
+        """Refresh the access token, sharing the refresh with anyone else refreshing it."""
+        self.google_info = self.im.refresh_integration(
+            self.user, "google", self.google_info, self._request_token
+        )
+
+    def _refresh_if_expiring(self: Any) -> None:
+        """Refresh the access token if it is about to expire, saving a rejected request."""
+        if token_expiring(
+            self.google_info, self.app_config["INTEGRATIONS_TOKEN_REFRESH_MARGIN"]
+        ):
+            self.refresh_access_token()
+
+    def _send(self: Any, send: Callable, tokens: int = 1) -> Any:
+        """Make the request once the rate limiter allows, retrying it if we are throttled."""
+        return send_paced(
+            self.limiter,
+            send,
+            max_retries=self.app_config["SYNC_THROTTLE_RETRIES"],
+            tokens=tokens,
         )
 
+    def get(self: Any, request: Any) -> Any:
+        def _get() -> Any:
+            return self.session.get(
+                request,
+                headers={"Authorization": f"Bearer {self.google_info['access_token']}"},
+            )
+
+        self._refresh_if_expiring()
+        response = self._send(_get)
+
         # Check for expired token error.
         if response.status_code == 401:
 
             # Try and refresh the access token.
             self.refresh_access_token()
 
-            response = requests.get(
-                request,
-                headers={"Authorization": f"Bearer {self.google_info['access_token']}"},
+            response = self._send(_get)
+
+        return response
+
+    def _post_batch(self: Any, body: str, boundary: str, tokens: int) -> Any:
+        """Send one batch request, refreshing the access token if it has expired."""
+
+        def _post() -> Any:
+            return self.session.post(
+                f"{GMAIL_API_ROOT}/batch/gmail/v1",
+                data=body.encode("utf-8"),
+                headers={
+                    "Content-Type": f"multipart/mixed; boundary={boundary}",
+                    "Authorization": f"Bearer {self.google_info['access_token']}",
+                },
             )
 
+        self._refresh_if_expiring()
+
+        # Gmail counts each call in the batch against our quota.
+        response = self._send(_post, tokens=tokens)
+
+        # Check for expired token error.
+        if response.status_code == 401:
+
+            # Try and refresh the access token.
+            self.refresh_access_token()
+
+            response = self._send(_post, tokens=tokens)
+
         return response
+
+    def batch_get(self: Any, urls: list) -> list:
+        """GET each of the Gmail URLs using batch requests, returning the responses in order.
+
+        The URLs are packed GMAIL_BATCH_SIZE to a multipart/mixed request and the multipart
+        response split back out, each part standing in for the response a plain `get` would
+        have returned. Parts that were throttled, or failed with an expired token, are retried
+        one at a time through `get`, throttled ones slowing the rate limiter first. If a whole
+        batch request fails, its response is returned for each of its URLs.
+
+        """
+        responses = []
+
+        for chunk in chunked(urls, GMAIL_BATCH_SIZE):
+            boundary = f"batch_{uuid.uuid4().hex}"
+            body = (
+                "".join(
+                    f"--{boundary}\r\n"
+                    "Content-Type: application/http\r\n"
+                    f"Content-ID: <item-{index}>\r\n"
+                    "\r\n"
+                    f"GET {url[len(GMAIL_API_ROOT):] if url.startswith(GMAIL_API_ROOT) else url}\r\n"
+                    "\r\n"
+                    for index, url in enumerate(chunk)
+                )
+                + f"--{boundary}--\r\n"
+            )
+
+            response = self._post_batch(body, boundary, tokens=len(chunk))
+            if response.status_code != requests.codes.ok:
+                responses.extend([response] * len(chunk))
+                continue
+
+            split = [None] * len(chunk)
+            for index, part in parse_batch_response(response):
+                if 0 <= index < len(chunk):
+                    split[index] = part
+
+            for index, part in enumerate(split):
+                if part is None or part.status_code in RETRY_STATUSES + [401]:
+                    if part is not None and part.status_code in RETRY_STATUSES:
+                        self.limiter.throttled(retry_after(part))
+                    split[index] = self.get(chunk[index])
+            responses.extend(split)
+
+        return responses
+
+
+def _split_head(text: str) -> tuple:
+    """Split the text into its header lines and the body after the first blank line."""
+    head, _, body = text.partition("\r\n\r\n")
+    return head.split("\r\n"), body
+
+
+def _parse_headers(lines: list) -> dict:
+    """Parse "Name: value" header lines into a dict."""
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(":")
+        if value:
+            headers[name.strip()] = value.strip()
+    return headers
+
+
+def _batch_boundary(response: Any) -> Optional[str]:
+    """Return the boundary of a multipart/mixed response, or None if it isn't one."""
+    content_type = response.headers.get("Content-Type", "")
+    if (
+        not content_type.lower().startswith("multipart/mixed")
+        or "boundary=" not in content_type
+    ):
+        return None
+    boundary = content_type.split("boundary=", 1)[1].split(";")[0].strip().strip('"')
+    return boundary or None
+
+
+def parse_batch_response(response: Any) -> Any:
+    """Yield (index, BatchResponse) for each part of a multipart/mixed batch response.
+
+    Each part wraps an HTTP response, and carries the Content-ID of the call it answers in the
+    form `<response-item-N>`, where N is the index given to the call in the request. Parts that
+    can't be parsed are skipped, as is the whole response if it isn't multipart, so the caller
+    makes those calls again on their own.
+
+    """
+    boundary = _batch_boundary(response)
+    if boundary is None:
+        return
+
+    text = response.content.decode("utf-8").replace("\r\n", "\n").replace("\n", "\r\n")
+
+    for part in text.split(f"--{boundary}"):
+        part = part.strip("\r\n")
+        if not part or part == "--":
+            continue
+
+        part_header_lines, http_response = _split_head(part)
+        content_id = _parse_headers(part_header_lines).get("Content-ID", "")
+        try:
+            index = int(content_id.strip("<>").rsplit("-", 1)[1])
+        except (IndexError, ValueError):
+            continue
+
+        header_lines, body = _split_head(http_response)
+        try:
+            status_code = int(header_lines[0].split(" ")[1])
+        except (IndexError, ValueError):
+            continue
+        headers = _parse_headers(header_lines[1:])
+        yield index, BatchResponse(status_code, headers, body.strip("\r\n") or "{}")
@@ -1,18 +1,57 @@
-from typing import Any
+import copy
+import threading
+from typing import Any, Callable
 
 import msal
 import requests
 from flask import abort
 
+from src.http_session import create_session
+from src.integrations.batch import RETRY_STATUSES, BatchResponse, chunked, retry_after
+from src.integrations.rate_limit import get_limiter, send_paced
+from src.integrations.tokens import token_expires_at, token_expiring
+
+GRAPH_API_ROOT = "https://graph.microsoft.com/v1.0"
+
+# Graph accepts at most this many sub-requests in one $batch call.
+GRAPH_BATCH_SIZE = 20
+
+# Building the MSAL app fetches the authority's metadata, so it's only built once per process.
+_msal_app = None
+_msal_app_lock = threading.Lock()
+
 
 def get_msal_app(app_config: dict, cache: Any = None) -> Any:
-    # Initialize the MSAL confidential client
-    auth_app = msal.ConfidentialClientApplication(
-        app_config["MSAL_APP_ID"],
-        authority=app_config["MSAL_AUTHORITY"],
-        client_credential=app_config["MSAL_APP_SECRET"],
-        token_cache=None,
-    )
+    """Return the MSAL confidential client, bound to the given token cache if there is one.
+
+    The client is built once per process, on a pooled session, and shared. A caller with its
+    own token cache gets a shallow copy bound to it, which reuses the resolved authority
+    rather than discovering it again.
+
+    """
+    global _msal_app
+
+    with _msal_app_lock:
+        if _msal_app is None:
+            # Initialize the MSAL confidential client
+            _msal_app = msal.ConfidentialClientApplication(
+                app_config["MSAL_APP_ID"],
+                authority=app_config["MSAL_AUTHORITY"],
+                client_credential=app_config["MSAL_APP_SECRET"],
+                http_client=create_session(app_config),
+            )
+    auth_app = _msal_app
+
+    if cache is not None:
+        auth_app = copy.copy(auth_app)
+        auth_app.token_cache = cache
+        # The client writes tokens it obtains to the cache it was built with, so build a new
+        # one for this cache. Building it only reads the authority's endpoints, it's offline.
+        # _build_client is private to MSAL, so requirements.txt pins its version and
+        # test_msal_app_built_once fails if a new version changes it.
+        auth_app.client = auth_app._build_client(
+            auth_app.client_credential, auth_app.authority
+        )
 
     return auth_app
 
@@ -29,57 +68,236 @@ def get_token_from_code(app_config: dict, request: Any, flow: dict) -> dict:
     cache = msal.SerializableTokenCache()
     auth_app = get_msal_app(app_config, cache)
     result = auth_app.acquire_token_by_auth_code_flow(flow, dict(request.args))
+
+    # Keep MSAL's token cache with the integration, so refreshes can go through MSAL.
+    if "access_token" in result:
+        result["token_cache"] = cache.serialize()
     return result
 
 
 class MSALRequestor:
-    def __init__(self: Any, user: str, msal_info: dict, im: Any, app_config: dict) -> None:
+    def __init__(
+        self: Any,
+        user: str,
+        msal_info: dict,
+        im: Any,
+        app_config: dict,
+        limiter: Any = None,
+        session: Any = None,
+    ) -> None:
         self.user = user
         self.msal_info = msal_info
         self.im = im
         self.app_config = app_config
 
-    def refresh_access_token(self: Any) -> bool:
-        response = requests.post(
+        # Calls are made on the shared pooled session, or a fresh connection each without one.
+        self.session = session or requests
+
+        # Requests to Graph for this mailbox are paced by a limiter shared by all its syncs.
+        if limiter is None:
+            limiter = get_limiter(
+                user,
+                "msal",
+                rate=app_config["GRAPH_API_RATE"],
+                min_rate=app_config["GRAPH_API_MIN_RATE"],
+                max_rate=app_config["GRAPH_API_MAX_RATE"],
+            )
+        self.limiter = limiter
+
+    def _request_token_silently(self: Any) -> dict:
+        """Get a new token through MSAL from the integration's token cache.
+
+        The refresh is forced, as MSAL would otherwise hand back the cached access token until
+        its last five minutes, however far ahead of expiry INTEGRATIONS_TOKEN_REFRESH_MARGIN
+        asks for a new one. The cache is only written back if MSAL changed it.
+
+        """
+        cache = msal.SerializableTokenCache()
+        cache.deserialize(self.msal_info["token_cache"])
+        auth_app = get_msal_app(self.app_config, cache)
+
+        accounts = auth_app.get_accounts()
+        result = None
+        if accounts:
+            result = auth_app.acquire_token_silent(
+                self.app_config["MSAL_SCOPES"], account=accounts[0], force_refresh=True
+            )
+        if not result or "access_token" not in result:
+            error = (result or {}).get(
+                "error_description", "No account found in the token cache."
+            )
+            abort(401, f"Could not refresh access token: {error}")
+
+        fields = {"access_token": result["access_token"]}
+        expires_at = token_expires_at(result)
+        if expires_at is not None:
+            fields["expires_at"] = expires_at
+        if cache.has_state_changed:
+            fields["token_cache"] = cache.serialize()
+        return fields
+
+    def _request_token(self: Any) -> dict:
+        """Ask the provider for new tokens, returning the fields of the integration to update."""
+        if "token_cache" in self.msal_info:
+            return self._request_token_silently()
+
+        # Integrations added before MSAL's token cache was kept redeem their refresh token directly.
+        response = self.session.post(
             f"{self.app_config['MSAL_AUTHORITY']}/oauth2/v2.0/token",
             headers={
                 "Content-Type": "application/x-www-form-urlencoded",
                 "Authorization": f"Bearer {self.msal_info['access_token']}",
             },
             data={
-                "client_id": self.app_config['MSAL_APP_ID'],
-                "scope": self.app_config['MSAL_SCOPES'],
+                "client_id": self.app_config["MSAL_APP_ID"],
+                "scope": self.app_config["MSAL_SCOPES"],
                 "refresh_token": self.msal_info["refresh_token"],
-                "redirect_uri": self.app_config['MSAL_REDIRECT'],
+                "redirect_uri": self.app_config["MSAL_REDIRECT"],
                 "grant_type": "refresh_token",
-                "client_secret": self.app_config['MSAL_APP_SECRET'],
+                "client_secret": self.app_config["MSAL_APP_SECRET"],
             },
         )
         if response.status_code == 200:
             data = response.json()
-            self.msal_info["access_token"] = data["access_token"]
-            self.im.add_integration(self.user, "msal", self.msal_info)
-            return
+
+            # Only write the refreshed tokens, some providers also rotate the refresh token.
+            fields = {"access_token": data["access_token"]}
+            if "refresh_token" in data.keys():
+                fields["refresh_token"] = data["refresh_token"]
+
+            expires_at = token_expires_at(data)
+            if expires_at is not None:
+                fields["expires_at"] = expires_at
+
+            return fields
         else:
-            abort(
-                401, f"Could not refresh access token: {response.text}"
-            )
+            abort(401, f"Could not refresh access token: {response.text}")
 
-    def get(self: Any, request: Any) -> Any:
-        response = requests.get(
-            request,
-            headers={"Authorization": f"Bearer {self.msal_info['access_token']}"},
+    def refresh_access_token(self: Any) -> None:
+        """Refresh the access token, sharing the refresh with anyone else refreshing it."""
+        self.msal_info = self.im.refresh_integration(
+            self.user, "msal", self.msal_info, self._request_token
         )
 
+    def _refresh_if_expiring(self: Any) -> None:
+        """Refresh the access token if it is about to expire, saving a rejected request."""
+        if token_expiring(
+            self.msal_info, self.app_config["INTEGRATIONS_TOKEN_REFRESH_MARGIN"]
+        ):
+            self.refresh_access_token()
+
+    def _send(self: Any, send: Callable, tokens: int = 1) -> Any:
+        """Make the request once the rate limiter allows, retrying it if we are throttled."""
+        return send_paced(
+            self.limiter,
+            send,
+            max_retries=self.app_config["SYNC_THROTTLE_RETRIES"],
+            tokens=tokens,
+        )
+
+    def get(self: Any, request: Any, headers: dict = None) -> Any:
+        headers = headers or {}
+
+        def _get() -> Any:
+            return self.session.get(
+                request,
+                headers={
+                    **headers,
+                    "Authorization": f"Bearer {self.msal_info['access_token']}",
+                },
+            )
+
+        self._refresh_if_expiring()
+        response = self._send(_get)
+
         # Check for expired token error.
         if response.status_code == 401:
 
             # Try and refresh the access token.
             self.refresh_access_token()
 
-            response = requests.get(
-                request,
+            response = self._send(_get)
+
+        return response
+
+    def _post_batch(self: Any, batch: dict) -> Any:
+        """Send one $batch call, refreshing the access token if it has expired."""
+
+        def _post() -> Any:
+            return self.session.post(
+                f"{GRAPH_API_ROOT}/$batch",
+                json=batch,
                 headers={"Authorization": f"Bearer {self.msal_info['access_token']}"},
             )
 
+        self._refresh_if_expiring()
+
+        # Graph counts each sub-request against our quota.
+        response = self._send(_post, tokens=len(batch["requests"]))
+
+        # Check for expired token error.
+        if response.status_code == 401:
+
+            # Try and refresh the access token.
+            self.refresh_access_token()
+
+            response = self._send(_post, tokens=len(batch["requests"]))
+
         return response
+
+    def batch_get(self: Any, urls: list, headers: dict = None) -> list:
+        """GET each of the Graph URLs using $batch calls, returning the responses in order.
+
+        The URLs are packed GRAPH_BATCH_SIZE to a call and the responses split back out, each
+        one standing in for the response a plain `get` would have returned. Sub-requests that
+        were throttled, or failed with an expired token, are retried one at a time through
+        `get`, throttled ones slowing the rate limiter first. If a whole $batch call fails, its
+        response is returned for each of its URLs so the caller handles it as it would any other
+        error.
+
+        """
+        headers = headers or {}
+        responses = []
+
+        for chunk in chunked(urls, GRAPH_BATCH_SIZE):
+            batch = {
+                "requests": [
+                    {
+                        "id": str(index),
+                        "method": "GET",
+                        "url": url[len(GRAPH_API_ROOT) :]
+                        if url.startswith(GRAPH_API_ROOT)
+                        else url,
+                        "headers": headers,
+                    }
+                    for index, url in enumerate(chunk)
+                ]
+            }
+            response = self._post_batch(batch)
+            if response.status_code != requests.codes.ok:
+                responses.extend([response] * len(chunk))
+                continue
+
+            # Sub-responses can come back in any order, match them up by id.
+            split = [None] * len(chunk)
+            for sub_response in response.json()["responses"]:
+                split[int(sub_response["id"])] = BatchResponse(
+                    sub_response["status"],
+                    sub_response.get("headers"),
+                    sub_response.get("body"),
+                )
+
+            for index, sub_response in enumerate(split):
+                if (
+                    sub_response is None
+                    or sub_response.status_code in RETRY_STATUSES + [401]
+                ):
+                    if (
+                        sub_response is not None
+                        and sub_response.status_code in RETRY_STATUSES
+                    ):
+                        self.limiter.throttled(retry_after(sub_response))
+                    split[index] = self.get(chunk[index], headers=headers)
+            responses.extend(split)
+
+        return responses
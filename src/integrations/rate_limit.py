@@ -0,0 +1,142 @@
+"""Define the rate limiters that pace requests to each provider."""
+
+import asyncio
+import threading
+import time
+from typing import Any, Callable
+
+from src.cache import TTLCache
+from src.config import app_config
+from src.integrations.batch import RETRY_STATUSES, retry_after
+
+
+class AdaptiveRateLimiter:
+    """A token bucket whose rate adapts to the provider's throttling, shared between threads.
+
+    Requests reserve tokens and wait until the bucket would have refilled enough to cover them,
+    so callers queue up behind each other instead of failing. The rate grows additively while
+    requests succeed, by `increase` requests per second for every second's worth of successes,
+    and is multiplied by `decrease` whenever the provider throttles us (AIMD). A throttled
+    response also pauses every caller for as long as its Retry-After asked.
+
+    """
+
+    def __init__(
+        self: Any,
+        rate: float,
+        min_rate: float,
+        max_rate: float,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+    ) -> None:
+        """Start at `rate` requests per second with a full bucket."""
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+
+        self._tokens = max(1.0, rate)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self: Any, tokens: int) -> float:
+        """Take the tokens, returning how many seconds to wait before they can be used."""
+        with self._lock:
+            now = time.monotonic()
+
+            # Refill for the time since the last update, unless we are still paused.
+            if now > self._updated_at:
+                capacity = max(1.0, self.rate)
+                self._tokens = min(
+                    capacity, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+
+            self._tokens -= tokens
+            return (
+                max(0.0, self._updated_at - now) + max(0.0, -self._tokens) / self.rate
+            )
+
+    def acquire(self: Any, tokens: int = 1) -> None:
+        """Block until the tokens are available."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self: Any, tokens: int = 1) -> None:
+        """Wait, without blocking the event loop, until the tokens are available."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def succeeded(self: Any) -> None:
+        """Record a request the provider accepted, nudging the rate up."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def throttled(self: Any, retry_after: float) -> None:
+        """Record a throttled request, cutting the rate and pausing for retry_after seconds."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+            self._updated_at = max(self._updated_at, time.monotonic() + retry_after)
+
+
+# One limiter per (user, provider), shared by every sync of that mailbox in this process. A
+# limiter is dropped once its mailbox has gone unused for a while, and the next sync starts
+# afresh, so the registry doesn't grow with every user the process has ever served.
+_limiters = TTLCache(
+    maxsize=app_config["SYNC_LIMITER_CACHE_SIZE"],
+    ttl=app_config["SYNC_LIMITER_IDLE_TTL"],
+)
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(
+    user: str, provider: str, rate: float, min_rate: float, max_rate: float
+) -> Any:
+    """Return the limiter for the user's provider, creating it with the given rates if new."""
+    key = f"{provider}:{user}"
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = AdaptiveRateLimiter(rate, min_rate, max_rate)
+
+        # Setting it again on every use pushes its expiry back, so only idle limiters expire.
+        _limiters.set(key, limiter)
+        return limiter
+
+
+def send_paced(
+    limiter: AdaptiveRateLimiter, send: Callable, max_retries: int, tokens: int = 1
+) -> Any:
+    """Call send() once the limiter allows, retrying while the provider throttles us.
+
+    Throttled responses (429 and 503) slow the limiter down and pause it for their Retry-After,
+    then the request queues up again. After max_retries the throttled response is returned for
+    the caller to handle.
+
+    """
+    for _ in range(max_retries + 1):
+        limiter.acquire(tokens)
+        response = send()
+        if response.status_code not in RETRY_STATUSES:
+            limiter.succeeded()
+            return response
+        limiter.throttled(retry_after(response))
+    return response
+
+
+async def send_paced_async(
+    limiter: AdaptiveRateLimiter, send: Callable, max_retries: int, tokens: int = 1
+) -> Any:
+    """Await send() once the limiter allows, retrying while throttled, as `send_paced` does."""
+    for _ in range(max_retries + 1):
+        await limiter.acquire_async(tokens)
+        response = await send()
+        if response.status_code not in RETRY_STATUSES:
+            limiter.succeeded()
+            return response
+        limiter.throttled(retry_after(response))
+    return response
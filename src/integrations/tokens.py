@@ -0,0 +1,29 @@
+"""Track when provider access tokens expire."""
+
+import time
+from typing import Any, Optional
+
+
+def token_expires_at(token: dict) -> Optional[int]:
+    """Return when the token returned by a provider expires, in epoch seconds, if it says.
+
+    Providers give the lifetime as `expires_in` seconds, some also give `expires_at`. It's kept
+    as a whole number of seconds, as DynamoDB won't store floats.
+
+    """
+    if token.get("expires_at") is not None:
+        return int(token["expires_at"])
+    if token.get("expires_in") is not None:
+        return int(time.time()) + int(token["expires_in"])
+    return None
+
+
+def token_expiring(info: dict, margin: Any) -> bool:
+    """Return whether the integration's access token expires within margin seconds.
+
+    Integrations stored before expiry was tracked are never treated as expiring, their tokens
+    are still refreshed when a request is rejected with a 401.
+
+    """
+    expires_at = info.get("expires_at")
+    return expires_at is not None and time.time() >= float(expires_at) - margin
@@ -0,0 +1,245 @@
+"""Define background jobs, used to run synchronisations outside of the web request."""
+
+import copy
+import logging
+import queue
+import threading
+import time
+import uuid
+from typing import Any, Callable
+
+from werkzeug.exceptions import HTTPException
+
+from src.cache import CacheBackend, create_cache
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """The interface every job queue provides.
+
+    A queue carries job ids from the web workers that submit jobs to whatever runs them. Only
+    the id is sent, the job itself is kept in the job store, so a backend only has to move
+    short strings around.
+
+    """
+
+    def start(self: Any, handler: Callable) -> None:
+        """Start taking jobs from the queue, calling handler(job_id) for each one."""
+        raise NotImplementedError
+
+    def put(self: Any, job_id: str) -> None:
+        """Add the job to the queue."""
+        raise NotImplementedError
+
+
+class ThreadJobQueue(JobQueue):
+    """Runs jobs on a pool of daemon threads in this process.
+
+    Good enough for development and a single server, but jobs in the queue are lost if the
+    process exits. The threads are started with the first job.
+
+    """
+
+    def __init__(self: Any, workers: int) -> None:
+        """Set up an empty queue, to be served by the given number of threads."""
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._handler = None
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self: Any, handler: Callable) -> None:
+        """Remember the handler, the threads are started when the first job arrives."""
+        self._handler = handler
+
+    def _work(self: Any) -> None:
+        """Run jobs from the queue forever."""
+        while True:
+            job_id = self._queue.get()
+            try:
+                self._handler(job_id)
+            finally:
+                self._queue.task_done()
+
+    def put(self: Any, job_id: str) -> None:
+        """Add the job to the queue, starting the threads if they aren't running yet."""
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put(job_id)
+
+    def join(self: Any) -> None:
+        """Block until every job put so far has been run."""
+        self._queue.join()
+
+
+class ImmediateJobQueue(JobQueue):
+    """Runs each job as soon as it is put, in the calling thread.
+
+    A stand-in for a real queue when testing, so a job has finished by the time its
+    submission returns.
+
+    """
+
+    def start(self: Any, handler: Callable) -> None:
+        """Remember the handler."""
+        self._handler = handler
+
+    def put(self: Any, job_id: str) -> None:
+        """Run the job."""
+        self._handler(job_id)
+
+
+class JobProgress:
+    """Counters a running job bumps to report its progress."""
+
+    def __init__(self: Any, jm: Any, job_id: str) -> None:
+        """Report progress on the given job."""
+        self.jm = jm
+        self.job_id = job_id
+
+    def increment(self: Any, counter: str, amount: int = 1) -> None:
+        """Add amount to the named counter."""
+        self.jm._update(
+            self.job_id,
+            lambda job: job["progress"].update(
+                {counter: job["progress"].get(counter, 0) + amount}
+            ),
+        )
+
+    def count(self: Any, counter: str, items: Any) -> Any:
+        """Yield each of the items, incrementing the named counter as each one passes."""
+        for item in items:
+            self.increment(counter)
+            yield item
+
+    async def count_async(self: Any, counter: str, items: Any) -> Any:
+        """Yield each item of the async iterable, incrementing the named counter as it passes."""
+        async for item in items:
+            self.increment(counter)
+            yield item
+
+
+class JobManager:
+    """This provides methods for submitting and tracking background jobs.
+
+    Jobs are dicts held in a cache backend, keyed by id, recording the user who submitted
+    them, their status (QUEUED, RUNNING, SUCCESS or FAILED), progress counters and result.
+    Each kind of job is a function registered by name, called with the user, the parameters
+    the job was submitted with, and a JobProgress. Parameters must be JSON serialisable, so
+    jobs can be moved by queues in other processes. An HTTPException raised by a job, as
+    from abort(), is recorded with its status code and description.
+
+    """
+
+    def __init__(self: Any) -> None:
+        """Start with no kinds of job registered, they register as their modules are imported."""
+        self.tasks = {}
+        self._lock = threading.Lock()
+
+    def initialise(
+        self: Any, app_config: dict, queue: JobQueue = None, store: CacheBackend = None
+    ) -> None:
+        """Set up the job store and queue from the app config, unless they are given."""
+        self.app_config = app_config
+
+        # Finished jobs are kept for a while so their status can still be read, from any worker
+        # if Redis is configured.
+        if store is None:
+            store = create_cache(
+                app_config,
+                "jobs:",
+                maxsize=app_config["SYNC_JOB_STORE_SIZE"],
+                ttl=app_config["SYNC_JOB_TTL"],
+            )
+        self.store = store
+
+        if queue is None:
+            if app_config["SYNC_JOB_QUEUE"] == "immediate":
+                queue = ImmediateJobQueue()
+            else:
+                queue = ThreadJobQueue(workers=app_config["SYNC_JOB_WORKERS"])
+        self.queue = queue
+        self.queue.start(self._run)
+
+    def register(self: Any, kind: str, task: Callable) -> None:
+        """Register the function that runs jobs of the given kind."""
+        self.tasks[kind] = task
+
+    def _update(self: Any, job_id: str, change: Callable) -> None:
+        """Apply change to the stored job and save it back."""
+        with self._lock:
+            job = self.store.get(job_id)
+            if job is None:
+                return
+            change(job)
+            job["updated"] = time.time()
+            self.store.set(job_id, job)
+
+    def submit(self: Any, user: str, kind: str, params: dict) -> dict:
+        """Queue a job of the given kind for the user, returning the job."""
+        if kind not in self.tasks.keys():
+            raise KeyError(kind)
+
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex,
+            "user": user,
+            "kind": kind,
+            "params": params,
+            "status": "QUEUED",
+            "progress": {},
+            "result": None,
+            "error": None,
+            "created": now,
+            "updated": now,
+        }
+        self.store.set(job["id"], job)
+        self.queue.put(job["id"])
+        return self.get_job(user, job["id"])
+
+    def _run(self: Any, job_id: str) -> None:
+        """Run the job, recording its outcome."""
+        job = self.store.get(job_id)
+        if job is None:
+            return
+
+        self._update(job_id, lambda job: job.update({"status": "RUNNING"}))
+        try:
+            result = self.tasks[job["kind"]](
+                job["user"], job["params"], JobProgress(self, job_id)
+            )
+        except HTTPException as e:
+            error = {"code": e.code, "message": e.description}
+            self._update(
+                job_id, lambda job: job.update({"status": "FAILED", "error": error})
+            )
+        except Exception as e:
+            logger.exception("Job %s of kind %s failed.", job_id, job["kind"])
+            error = {"code": 500, "message": f"{e.__class__.__name__}: {e}"}
+            self._update(
+                job_id, lambda job: job.update({"status": "FAILED", "error": error})
+            )
+        else:
+            self._update(
+                job_id, lambda job: job.update({"status": "SUCCESS", "result": result})
+            )
+
+    def get_job(self: Any, user: str, job_id: str) -> dict:
+        """Return the job, raising a KeyError if there is no such job for this user."""
+        with self._lock:
+            job = self.store.get(job_id)
+            if job is None or job["user"] != user:
+                raise KeyError(job_id)
+            return {
+                k: copy.deepcopy(v)
+                for k, v in job.items()
+                if k not in ["user", "params"]
+            }
+
+
+# Create the job manager.
+jm = JobManager()
@@ -0,0 +1,131 @@
+"""Define an in-process cache of the JSON Web Key Set used to verify access tokens."""
+
+import threading
+import time
+from typing import Any, Optional
+
+import requests
+from jose import jwk
+
+
+class JWKSKeyStore:
+    """Caches the signing keys published by the Auth0 tenant.
+
+    The key set is fetched once and kept for `ttl` seconds. Once stale, the cached keys are
+    still served whilst a background thread fetches a fresh copy, so requests never wait on
+    Auth0 after the first load. A token carrying a `kid` we have not seen before causes an
+    immediate refetch (to pick up key rotation), but no more often than once every
+    `min_refetch_interval` seconds, so a stream of forged tokens cannot hammer the tenant.
+
+    Keys are stored already constructed, so verifying a token doesn't rebuild the RSA key.
+
+    """
+
+    def __init__(
+        self: Any,
+        jwks_url: str,
+        ttl: float,
+        min_refetch_interval: float,
+        session: Any = None,
+    ) -> None:
+        """Set up an empty store, nothing is fetched until a key is first requested."""
+        self.jwks_url = jwks_url
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.session = session or requests
+
+        self._keys = None
+        self._fetched_at = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def _fetch(self: Any) -> dict:
+        """Download and parse the JSON Web Key Set."""
+        response = self.session.get(self.jwks_url)
+        response.raise_for_status()
+        return response.json()
+
+    def _build_keys(self: Any, jwks: dict) -> dict:
+        """Construct a verification key for each RSA signing key in the set, keyed by kid."""
+        keys = {}
+        for key in jwks["keys"]:
+            if key.get("kty") != "RSA" or key.get("use", "sig") != "sig":
+                continue
+            rsa_key = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key.get("use", "sig"),
+                "n": key["n"],
+                "e": key["e"],
+            }
+            # Keep the backend's native key object, jose accepts it as-is without reparsing.
+            keys[key["kid"]] = jwk.construct(rsa_key, algorithm="RS256").prepared_key
+        return keys
+
+    def refresh(self: Any, force: bool = True) -> bool:
+        """Fetch the key set and replace the cached keys.
+
+        Only one thread fetches at a time, any others wait for it and then reuse its result.
+        With `force=False` the fetch is skipped if it already happened within the refetch
+        interval. Returns True if the keys were refetched.
+
+        """
+        requested_at = time.monotonic()
+        with self._fetch_lock:
+            # Someone else refreshed whilst we were waiting for the lock.
+            if self._fetched_at > requested_at:
+                return False
+            recently_fetched = (
+                requested_at - self._fetched_at < self.min_refetch_interval
+            )
+            if not force and self._keys is not None and recently_fetched:
+                return False
+
+            keys = self._build_keys(self._fetch())
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = time.monotonic()
+            return True
+
+    def _refresh_in_background(self: Any) -> None:
+        """Start a daemon thread to refresh the keys, unless one is already running."""
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _refresh() -> None:
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the stale keys, the next stale read will try again.
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=_refresh, daemon=True).start()
+
+    def get_key(self: Any, kid: str) -> Optional[Any]:
+        """Return the verification key for the given kid, or None if it isn't published."""
+        if self._keys is None:
+            self.refresh(force=False)
+        elif time.monotonic() - self._fetched_at > self.ttl:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None:
+            # Possibly a rotated key, refetch if we haven't done so too recently.
+            try:
+                if self.refresh(force=False):
+                    key = self._keys.get(kid)
+            except Exception:
+                pass
+        return key
+
+    def clear(self: Any) -> None:
+        """Drop the cached keys so the next lookup fetches them again."""
+        with self._lock:
+            self._keys = None
+            self._fetched_at = 0.0
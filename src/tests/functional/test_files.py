@@ -83,6 +83,147 @@ def test_get_files_no_user(
     assert len(data["files"]) == 0
 
 
+def test_get_files_ndjson(
+    test_app: Any, add_file: Any, reset_db: Any, monkeypatch: Any
+) -> None:
+    """Get files with an NDJSON Accept header streams one file per line."""
+    # Patch the auth functions.
+    def mock_get_token_auth_header() -> str:
+        """Mock get token auth header."""
+        return "token"
+
+    def mock_authenticate_token(token: str) -> bool:
+        """Mock authenticate token."""
+        return True
+
+    def mock_get_user_id() -> str:
+        """Respond with specific user when asked for user ID."""
+        return "harry"
+
+    monkeypatch.setattr(src.auth, "get_token_auth_header", mock_get_token_auth_header)
+    monkeypatch.setattr(src.auth, "authenticate_token", mock_authenticate_token)
+    monkeypatch.setattr(src.api.files, "get_user_id", mock_get_user_id)
+
+    # Given
+    reset_db()  # Empty all items.
+    client = test_app.test_client()
+    add_file("harry", "file_1")
+    add_file("harry", "file_2")
+    add_file("arnaud", "file_3")
+
+    # When
+    resp = client.get("/files", headers={"Accept": "application/x-ndjson"})
+    lines = resp.data.decode().splitlines()
+
+    # Then
+    assert resp.status_code == 200
+    assert resp.content_type == "application/x-ndjson"
+    assert len(lines) == 2
+    assert "file_1" in [json.loads(line)["name"] for line in lines]
+    assert "file_2" in [json.loads(line)["name"] for line in lines]
+    assert "user" not in json.loads(lines[0]).keys()
+
+
+def test_get_files_query_error(test_app: Any, monkeypatch: Any) -> None:
+    """A query failing on the first page is answered with an error, not a truncated 200."""
+    # Patch the auth functions.
+    def mock_get_token_auth_header() -> str:
+        """Mock get token auth header."""
+        return "token"
+
+    def mock_authenticate_token(token: str) -> bool:
+        """Mock authenticate token."""
+        return True
+
+    def mock_get_user_id() -> str:
+        """Respond with specific user when asked for user ID."""
+        return "harry"
+
+    def mock_get_files(user: str, **filters: Any) -> Any:
+        """Fail the first query, as DynamoDB would when throttling the table."""
+        raise RuntimeError("ProvisionedThroughputExceededException")
+        yield
+
+    monkeypatch.setattr(src.auth, "get_token_auth_header", mock_get_token_auth_header)
+    monkeypatch.setattr(src.auth, "authenticate_token", mock_authenticate_token)
+    monkeypatch.setattr(src.api.files, "get_user_id", mock_get_user_id)
+    monkeypatch.setattr(src.api.files.cm, "get_files", mock_get_files)
+    monkeypatch.setitem(test_app.config, "PROPAGATE_EXCEPTIONS", False)
+
+    # Given
+    client = test_app.test_client()
+
+    # When
+    resp = client.get("/files")
+
+    # Then
+    assert resp.status_code == 500
+
+
+def test_get_files_paginated(
+    test_app: Any, add_file: Any, reset_db: Any, monkeypatch: Any
+) -> None:
+    """Get files with a limit returns pages that can be followed with next_cursor."""
+    # Patch the auth functions.
+    def mock_get_token_auth_header() -> str:
+        """Mock get token auth header."""
+        return "token"
+
+    def mock_authenticate_token(token: str) -> bool:
+        """Mock authenticate token."""
+        return True
+
+    def mock_get_user_id() -> str:
+        """Respond with specific user when asked for user ID."""
+        return "harry"
+
+    monkeypatch.setattr(src.auth, "get_token_auth_header", mock_get_token_auth_header)
+    monkeypatch.setattr(src.auth, "authenticate_token", mock_authenticate_token)
+    monkeypatch.setattr(src.api.files, "get_user_id", mock_get_user_id)
+
+    # Given
+    reset_db()  # Empty all items.
+    client = test_app.test_client()
+    add_file("harry", "file_1")
+    add_file("harry", "file_2")
+    add_file("harry", "file_3")
+    add_file("arnaud", "file_4")
+
+    # When
+    names = []
+    resp = client.get("/files?limit=2")
+    data = json.loads(resp.data.decode())
+    names += [f["name"] for f in data["files"]]
+
+    # Then
+    assert resp.status_code == 200
+    assert len(data["files"]) == 2
+    assert data["next_cursor"] is not None
+
+    # When
+    resp = client.get(f"/files?limit=2&cursor={data['next_cursor']}")
+    data = json.loads(resp.data.decode())
+    names += [f["name"] for f in data["files"]]
+
+    # Then
+    assert resp.status_code == 200
+    assert sorted(names) == ["file_1", "file_2", "file_3"]
+
+    # When
+    resp = client.get("/files?cursor=not-a-cursor")
+
+    # Then
+    assert resp.status_code == 400
+
+    # When
+    resp = client.get("/files?limit=2")
+    cursor = json.loads(resp.data.decode())["next_cursor"]
+    resp = client.get(f"/files?limit=2&sender=ron@example.com&cursor={cursor}")
+
+    # Then
+    assert resp.status_code == 400
+
+
 def test_put_files(
     test_app: Any, add_file: Any, reset_db: Any, monkeypatch: Any
 ) -> None:
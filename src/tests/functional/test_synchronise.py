@@ -0,0 +1,211 @@
+"""Tests for the Synchronise routes."""
+
+import json
+from typing import Any
+
+import src.api.files
+import src.api.synchronisations.outlook
+import src.api.synchronise
+import src.auth
+from src.api.synchronisations.outlook import Outlook
+from src.config import app_config
+
+
+class MockResponse:
+    """Stand in for a successful requests.Response."""
+
+    def __init__(self: Any, body: dict) -> None:
+        """Hold the body."""
+        self.status_code = 200
+        self.body = body
+        self.text = str(body)
+
+    def json(self: Any) -> dict:
+        """Return the body."""
+        return self.body
+
+
+class MockRequestor:
+    """Serve one page of emails with their attachments expanded, recording the urls requested."""
+
+    def __init__(self: Any) -> None:
+        """Start with no urls requested."""
+        self.urls = []
+
+    def get(self: Any, url: str, headers: dict = None) -> MockResponse:
+        """Return the page of emails."""
+        self.urls.append(url)
+        email = {
+            "receivedDateTime": "2021-03-01T10:00:00Z",
+            "sender": {"emailAddress": {"address": "ron@example.com"}},
+        }
+        return MockResponse(
+            {
+                "value": [
+                    {
+                        **email,
+                        "id": "1",
+                        "webLink": "https://outlook/1",
+                        "attachments": [
+                            {
+                                "name": "a.pdf",
+                                "contentType": "application/pdf",
+                                "isInline": False,
+                            },
+                            {
+                                "name": "logo.png",
+                                "contentType": "image/png",
+                                "isInline": True,
+                            },
+                        ],
+                    },
+                    {
+                        **email,
+                        "id": "2",
+                        "webLink": "https://outlook/2",
+                        "attachments": [
+                            {
+                                "name": "b.docx",
+                                "contentType": "application/msword",
+                                "isInline": False,
+                            }
+                        ],
+                    },
+                ]
+            }
+        )
+
+    def batch_get(self: Any, urls: list, headers: dict = None) -> list:
+        """Fail, the attachments were already expanded."""
+        raise AssertionError("Attachments should not be listed separately.")
+
+
+def test_synchronise_job(test_app: Any, monkeypatch: Any) -> None:
+    """A sync is accepted as a job whose progress and status can be polled."""
+    # Patch the auth functions.
+    def mock_get_token_auth_header() -> str:
+        """Mock get token auth header."""
+        return "token"
+
+    def mock_authenticate_token(token: str) -> bool:
+        """Mock authenticate token."""
+        return True
+
+    def mock_get_user_id() -> str:
+        """Respond with specific user when asked for user ID."""
+        return "harry"
+
+    def mock_get_integration(user: str, integration: str) -> dict:
+        """Respond as if the user has subscribed."""
+        return {"access_token": "abc"}
+
+    def mock_synchronise(
+        self: Any,
+        id: str,
+        from_datetime: Any,
+        mode: str,
+        to_datetime: Any,
+        progress: Any,
+    ) -> dict:
+        """Count some emails and attachments instead of crawling the mailbox."""
+        progress.increment("emails", 3)
+        progress.increment("attachments", 2)
+        return {"message": "2 attachments added to the database."}
+
+    monkeypatch.setattr(src.auth, "get_token_auth_header", mock_get_token_auth_header)
+    monkeypatch.setattr(src.auth, "authenticate_token", mock_authenticate_token)
+    monkeypatch.setattr(src.api.synchronise, "get_user_id", mock_get_user_id)
+    monkeypatch.setattr(
+        src.api.synchronisations.outlook, "get_user_id", mock_get_user_id
+    )
+    monkeypatch.setattr(
+        src.api.synchronisations.outlook.im, "get_integration", mock_get_integration
+    )
+    monkeypatch.setattr(Outlook, "synchronise", mock_synchronise)
+
+    # Given
+    client = test_app.test_client()
+
+    # When
+    resp = client.get("/synchronise/outlook?from_datetime=2021-01-01T00:00:00")
+    data = json.loads(resp.data.decode())
+
+    # Then
+    assert resp.status_code == 202
+    assert resp.headers["Location"].endswith(f"/synchronise/jobs/{data['id']}")
+
+    # When
+    resp = client.get(resp.headers["Location"])
+    data = json.loads(resp.data.decode())
+
+    # Then
+    assert resp.status_code == 200
+    assert data["status"] == "SUCCESS"
+    assert data["progress"] == {"emails": 3, "attachments": 2}
+    assert data["result"] == {"message": "2 attachments added to the database."}
+
+    # When
+    resp = client.get("/synchronise/jobs/unknown")
+
+    # Then
+    assert resp.status_code == 404
+
+
+def test_synchronise_outlook_expanded_attachments(
+    test_app: Any, reset_db: Any, monkeypatch: Any
+) -> None:
+    """A page of emails with expanded attachments is synced without listing them per email."""
+    # Patch the auth functions.
+    def mock_get_token_auth_header() -> str:
+        """Mock get token auth header."""
+        return "token"
+
+    def mock_authenticate_token(token: str) -> bool:
+        """Mock authenticate token."""
+        return True
+
+    def mock_get_user_id() -> str:
+        """Respond with specific user when asked for user ID."""
+        return "harry"
+
+    def mock_get_integration(user: str, integration: str) -> dict:
+        """Respond as if the user has subscribed."""
+        return {"access_token": "abc"}
+
+    requestor = MockRequestor()
+
+    def mock_get_requestor(user: str, integration: str) -> MockRequestor:
+        """Hand out the mock requestor."""
+        return requestor
+
+    monkeypatch.setattr(src.auth, "get_token_auth_header", mock_get_token_auth_header)
+    monkeypatch.setattr(src.auth, "authenticate_token", mock_authenticate_token)
+    monkeypatch.setattr(src.api.files, "get_user_id", mock_get_user_id)
+    monkeypatch.setattr(src.api.synchronise, "get_user_id", mock_get_user_id)
+    monkeypatch.setattr(
+        src.api.synchronisations.outlook, "get_user_id", mock_get_user_id
+    )
+    monkeypatch.setattr(
+        src.api.synchronisations.outlook.im, "get_integration", mock_get_integration
+    )
+    monkeypatch.setattr(
+        src.api.synchronisations.outlook.im, "get_requestor", mock_get_requestor
+    )
+    monkeypatch.setitem(app_config, "SYNC_ASYNC_ENGINE", False)
+    monkeypatch.setitem(app_config, "GRAPH_API_EXPAND_ATTACHMENTS", True)
+
+    # Given
+    reset_db()  # Empty all items.
+    client = test_app.test_client()
+
+    # When
+    resp = client.get("/synchronise/outlook?from_datetime=2021-01-01T00:00:00")
+    job = json.loads(client.get(resp.headers["Location"]).data.decode())
+    files = json.loads(client.get("/files").data.decode())["files"]
+
+    # Then
+    assert job["status"] == "SUCCESS"
+    assert job["progress"] == {"emails": 2, "attachments": 2}
+    assert len(requestor.urls) == 1
+    assert "$expand=attachments" in requestor.urls[0]
+    assert sorted(f["name"] for f in files) == ["a.pdf", "b.docx"]
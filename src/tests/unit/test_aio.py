@@ -0,0 +1,157 @@
+"""Test the asyncio requestors and pipeline helpers."""
+
+import asyncio
+import threading
+from typing import Any
+
+import pytest
+
+from src.api.synchronisations.concurrency import fetch_concurrently_async
+from src.integrations.aio import AsyncMSALRequestor
+from src.integrations.rate_limit import AdaptiveRateLimiter
+
+
+class MockRequestor:
+    """Stand in for a blocking requestor, counting token refreshes."""
+
+    def __init__(self: Any) -> None:
+        """Start with an expired access token."""
+        self.msal_info = {"access_token": "expired"}
+        self.app_config = {
+            "SYNC_THROTTLE_RETRIES": 2,
+            "INTEGRATIONS_TOKEN_REFRESH_MARGIN": 300,
+        }
+        self.limiter = AdaptiveRateLimiter(rate=1000, min_rate=1, max_rate=1000)
+        self.refreshes = 0
+        self._lock = threading.Lock()
+
+    def refresh_access_token(self: Any) -> None:
+        """Replace the access token."""
+        with self._lock:
+            self.refreshes += 1
+        self.msal_info = {"access_token": "fresh"}
+
+
+class MockResponse:
+    """Stand in for an aiohttp response."""
+
+    def __init__(self: Any, status: int, text: str) -> None:
+        """Hold the status and body."""
+        self.status = status
+        self.headers = {}
+        self._text = text
+
+    async def text(self: Any) -> str:
+        """Return the body."""
+        return self._text
+
+    async def __aenter__(self: Any) -> Any:
+        """Enter the context."""
+        return self
+
+    async def __aexit__(self: Any, *args: Any) -> None:
+        """Exit the context."""
+
+
+class MockSession:
+    """Stand in for an aiohttp session, rejecting expired tokens and tracking concurrency."""
+
+    def __init__(self: Any) -> None:
+        """Start with no requests in flight."""
+        self.in_flight = 0
+        self.peak = 0
+
+    def get(self: Any, url: str, headers: dict) -> Any:
+        """Return a context manager for the response."""
+        session = self
+
+        class _Request:
+            async def __aenter__(self: Any) -> MockResponse:
+                session.in_flight += 1
+                session.peak = max(session.peak, session.in_flight)
+                await asyncio.sleep(0.01)
+                session.in_flight -= 1
+                if headers["Authorization"] == "Bearer expired":
+                    return MockResponse(401, "{}")
+                return MockResponse(200, f'{{"url": "{url}"}}')
+
+            async def __aexit__(self: Any, *args: Any) -> None:
+                pass
+
+        return _Request()
+
+
+def test_concurrent_401s_share_one_refresh() -> None:
+    """Many requests seeing an expired token refresh it only once, then all succeed."""
+    # Given
+    requestor = MockRequestor()
+    session = MockSession()
+
+    async def _crawl() -> list:
+        async_requestor = AsyncMSALRequestor(requestor, session, max_in_flight=5)
+        return await asyncio.gather(*[async_requestor.get(f"/{i}") for i in range(20)])
+
+    # When
+    responses = asyncio.run(_crawl())
+
+    # Then
+    assert requestor.refreshes == 1
+    assert [response.json()["url"] for response in responses] == [
+        f"/{i}" for i in range(20)
+    ]
+    assert session.peak <= 5
+
+
+def test_fetch_concurrently_async_in_order() -> None:
+    """Results come back in the order of the items, with a bounded number in flight."""
+    # Given
+    in_flight = [0, 0]
+
+    async def _items() -> Any:
+        for item in range(10):
+            yield item
+
+    async def _fetch(item: int) -> int:
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep((10 - item) / 1000)
+        in_flight[0] -= 1
+        return item * 2
+
+    async def _collect() -> list:
+        return [
+            result async for result in fetch_concurrently_async(_fetch, _items(), 3)
+        ]
+
+    # When
+    results = asyncio.run(_collect())
+
+    # Then
+    assert results == [item * 2 for item in range(10)]
+    assert in_flight[1] <= 3
+
+
+def test_fetch_concurrently_async_listing_error() -> None:
+    """Fetches already started are yielded before an error raised by the items."""
+    # Given
+    results = []
+
+    async def _items() -> Any:
+        for item in range(6):
+            yield item
+        raise RuntimeError("listing failed")
+
+    async def _fetch(item: int) -> int:
+        await asyncio.sleep(0.01)
+        return item
+
+    async def _collect() -> None:
+        async for result in fetch_concurrently_async(_fetch, _items(), 10):
+            results.append(result)
+
+    # When
+    with pytest.raises(RuntimeError):
+        asyncio.run(_collect())
+
+    # Then
+    assert results == list(range(6))
@@ -0,0 +1,93 @@
+"""Test resolving the user identity from the authenticated request."""
+
+import time
+from typing import Any
+
+from flask import Flask, _request_ctx_stack
+
+import src.auth
+from src.config import app_config
+
+
+class MockResponse:
+    """Stand in for a successful /userinfo response."""
+
+    status_code = 200
+
+    def json(self: Any) -> dict:
+        """Return the profile."""
+        return {"email": "harry@example.com"}
+
+
+def test_get_user_id_from_claim(monkeypatch: Any) -> None:
+    """The email claim on the verified payload is used without calling /userinfo."""
+
+    def mock_get(*args: list, **kwargs: dict) -> Any:
+        """Fail if /userinfo is called."""
+        raise AssertionError("/userinfo should not be called.")
+
+    monkeypatch.setattr(src.auth.http_session, "get", mock_get)
+
+    # Given
+    app = Flask(__name__)
+    with app.test_request_context(headers={"Authorization": "Bearer token"}):
+        _request_ctx_stack.top.current_user = {
+            app_config["AUTH_EMAIL_CLAIM"]: "harry@example.com"
+        }
+
+        # Then
+        assert src.auth.get_user_id() == "harry@example.com"
+
+
+def test_get_user_id_falls_back_to_cached_userinfo(monkeypatch: Any) -> None:
+    """Without the email claim, /userinfo is called once per token."""
+    calls = []
+
+    def mock_get(*args: list, **kwargs: dict) -> Any:
+        """Count calls to /userinfo."""
+        calls.append(1)
+        return MockResponse()
+
+    monkeypatch.setattr(src.auth.http_session, "get", mock_get)
+    src.auth.userinfo_cache.clear()
+
+    # Given
+    app = Flask(__name__)
+    for _ in range(3):
+        with app.test_request_context(headers={"Authorization": "Bearer token"}):
+            _request_ctx_stack.top.current_user = {"exp": time.time() + 60}
+
+            # Then
+            assert src.auth.get_user_id() == "harry@example.com"
+
+    assert len(calls) == 1
+
+
+def test_authenticate_token_caches_verified_payload(monkeypatch: Any) -> None:
+    """A token that has been verified once is not verified again until it expires."""
+    calls = []
+
+    def mock_verify_token(token: str) -> dict:
+        """Count verifications."""
+        calls.append(token)
+        return {"sub": "harry", "exp": time.time() + 60}
+
+    monkeypatch.setattr(src.auth, "_verify_token", mock_verify_token)
+    src.auth.verified_tokens.clear()
+    before = src.auth.verified_tokens.stats()
+
+    # Given
+    app = Flask(__name__)
+    for _ in range(3):
+        with app.test_request_context(headers={"Authorization": "Bearer token"}):
+
+            # When
+            assert src.auth.authenticate_token("token")
+
+            # Then
+            assert _request_ctx_stack.top.current_user["sub"] == "harry"
+
+    after = src.auth.verified_tokens.stats()
+    assert len(calls) == 1
+    assert after["hits"] - before["hits"] == 2
+    assert after["misses"] - before["misses"] == 1
@@ -0,0 +1,113 @@
+"""Test the in-process caches."""
+
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any
+
+from src.cache import RedisCache, TTLCache, create_cache
+
+
+def test_ttl_cache_expires_entries() -> None:
+    """Entries are missing once their expiry has passed."""
+    # Given
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("fresh", "a")
+    cache.set("expired", "b", expires_at=time.time() - 1)
+
+    # Then
+    assert cache.get("fresh") == "a"
+    assert cache.get("expired") is None
+    assert cache.get("expired", "default") == "default"
+
+
+def test_ttl_cache_evicts_least_recently_used() -> None:
+    """Once full, the least recently used entry is evicted."""
+    # Given
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # When
+    cache.get("a")
+    cache.set("c", 3)
+
+    # Then
+    assert len(cache) == 2
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+class MockRedis:
+    """Stand in for a redis-py client, keeping values in a dict."""
+
+    def __init__(self: Any) -> None:
+        """Start empty."""
+        self.values = {}
+        self.expiries = {}
+
+    @classmethod
+    def from_url(cls: Any, url: str) -> "MockRedis":
+        """Create a client, as redis.Redis.from_url does."""
+        return cls()
+
+    def get(self: Any, key: str) -> Any:
+        """Return the value, or None if missing."""
+        return self.values.get(key)
+
+    def set(self: Any, key: str, value: bytes, ex: int) -> None:
+        """Store the value, recording its expiry in seconds."""
+        self.values[key] = value
+        self.expiries[key] = ex
+
+    def delete(self: Any, *keys: str) -> None:
+        """Remove the keys."""
+        for key in keys:
+            self.values.pop(key, None)
+
+    def scan_iter(self: Any, match: str) -> Any:
+        """Yield the keys starting with the pattern's prefix."""
+        return (key for key in list(self.values) if key.startswith(match.rstrip("*")))
+
+
+def test_redis_cache_namespaces_and_expires() -> None:
+    """Entries are stored under the prefix with their time to live, and cleared by prefix."""
+    # Given
+    client = MockRedis()
+    cache = RedisCache(client, "jobs:", ttl=60)
+    other = RedisCache(client, "integrations:", ttl=60)
+
+    # When
+    cache.set("a", {"status": "RUNNING"})
+    cache.set("b", 2, expires_at=time.time() + 10.5)
+    cache.set("expired", 3, expires_at=time.time() - 1)
+    other.set("a", 4)
+    cache.delete("b")
+    cache_a = cache.get("a")
+    cache.clear()
+
+    # Then
+    assert cache_a == {"status": "RUNNING"}
+    assert client.expiries == {"jobs:a": 60, "jobs:b": 10, "integrations:a": 60}
+    assert cache.get("a") is None
+    assert cache.get("expired", "default") == "default"
+    assert other.get("a") == 4
+
+
+def test_create_cache_uses_redis_when_url_set(monkeypatch: Any) -> None:
+    """Caches are kept in the process unless a Redis URL is configured."""
+    # Given
+    monkeypatch.setitem(sys.modules, "redis", SimpleNamespace(Redis=MockRedis))
+
+    # When
+    local = create_cache({"CACHE_REDIS_URL": None}, "jobs:", maxsize=10, ttl=60)
+    shared = create_cache(
+        {"CACHE_REDIS_URL": "redis://cache"}, "jobs:", maxsize=10, ttl=60
+    )
+
+    # Then
+    assert isinstance(local, TTLCache)
+    assert isinstance(shared, RedisCache)
+    assert shared.prefix == "jobs:"
+    assert shared.ttl == 60
@@ -0,0 +1,93 @@
+"""Test fetching from the provider APIs concurrently."""
+
+import threading
+import time
+from typing import Any
+
+import pytest
+
+from src.api.synchronisations.concurrency import fetch_concurrently
+
+
+def test_results_in_order() -> None:
+    """Results come back in the order of the items, not the order they finish in."""
+    # Given
+    def fetch(item: int) -> int:
+        """Finish the earliest items last."""
+        time.sleep((10 - item) / 1000)
+        return item * 2
+
+    # When
+    results = list(fetch_concurrently(fetch, range(10), max_workers=4))
+
+    # Then
+    assert results == [item * 2 for item in range(10)]
+
+
+def test_concurrency_is_bounded() -> None:
+    """No more than max_workers calls run at once."""
+    # Given
+    lock = threading.Lock()
+    running = [0]
+    peak = [0]
+
+    def fetch(item: int) -> int:
+        """Record how many calls are running alongside this one."""
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return item
+
+    # When
+    list(fetch_concurrently(fetch, range(20), max_workers=3))
+
+    # Then
+    assert 1 < peak[0] <= 3
+
+
+def test_first_error_raised() -> None:
+    """The error from the earliest failing item is raised after the results before it."""
+    # Given
+    def fetch(item: int) -> int:
+        """Fail quickly on a late item and slowly on an early one."""
+        if item == 8:
+            raise KeyError(item)
+        if item == 3:
+            time.sleep(0.02)
+            raise ValueError(item)
+        return item
+
+    # When
+    results = []
+    with pytest.raises(ValueError):
+        for result in fetch_concurrently(fetch, range(10), max_workers=4):
+            results.append(result)
+
+    # Then
+    assert results == [0, 1, 2]
+
+
+def test_listing_error_keeps_submitted_results() -> None:
+    """Calls already submitted are yielded before an error raised by the items."""
+    # Given
+    def items() -> Any:
+        """List six items, then fail as a listing page would."""
+        yield from range(6)
+        raise RuntimeError("listing failed")
+
+    def fetch(item: int) -> int:
+        """Finish slowly, so every call is still pending when the listing fails."""
+        time.sleep(0.01)
+        return item
+
+    # When
+    results = []
+    with pytest.raises(RuntimeError):
+        for result in fetch_concurrently(fetch, items(), max_workers=4):
+            results.append(result)
+
+    # Then
+    assert results == list(range(6))
@@ -0,0 +1,262 @@
+"""Test the batching behaviour of the connection manager."""
+
+from datetime import datetime
+from typing import Any
+
+import src.dynamodb.connection_manager
+from src.dynamodb.connection_manager import ConnectionManager
+
+
+class MockTable:
+    """Stand in for a boto3 table, scanning a fixed list of items."""
+
+    name = "FilesTable"
+
+    def __init__(self: Any, items: list = None) -> None:
+        """Hold the items to scan."""
+        self.items = items or []
+
+    def scan(
+        self: Any, Segment: int, TotalSegments: int, Limit: int, **kwargs: dict
+    ) -> dict:
+        """Return a single page holding every item."""
+        return {"Items": self.items}
+
+
+class MockDB:
+    """Stand in for a boto3 resource that leaves the first item of each call unprocessed once."""
+
+    def __init__(self: Any) -> None:
+        """Start with no calls recorded."""
+        self.calls = []
+        self.retried = set()
+        self.existing = set()
+
+    def batch_write_item(self: Any, RequestItems: dict) -> dict:
+        """Record the batch and report the first never-retried request as unprocessed."""
+        batch = RequestItems["FilesTable"]
+        self.calls.append(batch)
+        assert len(batch) <= 25
+
+        unprocessed = [r for r in batch[:1] if str(r) not in self.retried]
+        self.retried.update(str(r) for r in unprocessed)
+        return {"UnprocessedItems": {"FilesTable": unprocessed} if unprocessed else {}}
+
+    def batch_get_item(self: Any, RequestItems: dict) -> dict:
+        """Return the requested keys that exist."""
+        keys = RequestItems["FilesTable"]["Keys"]
+        assert len(keys) <= 100
+        found = [
+            {"reference": k["reference"]}
+            for k in keys
+            if k["reference"] in self.existing
+        ]
+        return {"Responses": {"FilesTable": found}, "UnprocessedKeys": {}}
+
+
+def _connection_manager(max_retries: int = 8) -> ConnectionManager:
+    """Create a connection manager backed by the mock database."""
+    connection_manager = ConnectionManager()
+    connection_manager.db = MockDB()
+    connection_manager.files_table = MockTable()
+    connection_manager.batch_write_workers = 1
+    connection_manager.batch_write_max_retries = max_retries
+    connection_manager.legacy_references = False
+    return connection_manager
+
+
+def test_put_files_batches_and_retries(monkeypatch: Any) -> None:
+    """Files are written 25 at a time and unprocessed items are retried."""
+    monkeypatch.setattr(src.dynamodb.connection_manager.time, "sleep", lambda s: None)
+
+    # Given
+    connection_manager = _connection_manager()
+    files = [
+        {"name": f"file_{i}", "created": "2021-11-11T07:45:15", "type": "pdf"}
+        for i in range(60)
+    ]
+
+    # When
+    status = connection_manager.put_files("harry", files)
+
+    # Then
+    assert len(status) == 60
+    assert set(status.values()) == {"SUCCESS"}
+    assert [len(c) for c in connection_manager.db.calls] == [25, 1, 25, 1, 10, 1]
+
+
+def test_put_files_reports_failures_and_duplicates(monkeypatch: Any) -> None:
+    """Items still unprocessed after retrying are FAILED, and duplicates are written once."""
+    monkeypatch.setattr(src.dynamodb.connection_manager.time, "sleep", lambda s: None)
+
+    # Given
+    connection_manager = _connection_manager(max_retries=0)
+    files = [
+        {"name": "file_1", "created": "2021-11-11T07:45:15", "feature_1": "123"},
+        {"name": "file_1", "created": "2021-11-11T07:45:15", "feature_2": "456"},
+        {"name": "file_2", "created": "2021-11-11T07:45:15"},
+    ]
+
+    # When
+    status = connection_manager.put_files("harry", files)
+
+    # Then
+    assert status == {files[0]["reference"]: "FAILED", files[2]["reference"]: "SUCCESS"}
+    written = connection_manager.db.calls[0]
+    assert len(written) == 2
+    assert written[0]["PutRequest"]["Item"]["feature_2"] == "456"
+
+
+def test_delete_files_reports_status(monkeypatch: Any) -> None:
+    """Only existing files are deleted, in batches, and missing ones are NOT_FOUND."""
+    monkeypatch.setattr(src.dynamodb.connection_manager.time, "sleep", lambda s: None)
+
+    # Given
+    connection_manager = _connection_manager()
+    files = [
+        {"name": f"file_{i}", "created": "2021-11-11T07:45:15"} for i in range(150)
+    ]
+    for file in files[:30]:
+        connection_manager.db.existing.add(
+            connection_manager._build_reference(file["name"], file["created"])
+        )
+
+    # When
+    status = connection_manager.delete_files("harry", files)
+
+    # Then
+    assert list(status.values()).count("DELETED") == 30
+    assert list(status.values()).count("NOT_FOUND") == 120
+    assert status["file_0"] == "DELETED"
+    assert status["file_149"] == "NOT_FOUND"
+    # 30 plus two retries.
+    assert sum(len(c) for c in connection_manager.db.calls) == 32
+
+
+def test_references_sort_by_created() -> None:
+    """References sort by created date, and range bounds include the whole final second."""
+    # Given
+    connection_manager = _connection_manager()
+    references = [
+        connection_manager._build_reference("b.pdf", "2021-01-02T00:00:00"),
+        connection_manager._build_reference("a.pdf", "2021-02-01T00:00:00"),
+        connection_manager._build_reference("c.pdf", "2020-12-31T23:59:59"),
+    ]
+
+    # When
+    lower, upper = connection_manager._reference_bounds(
+        datetime.fromisoformat("2021-01-01T00:00:00"),
+        datetime.fromisoformat("2021-01-02T00:00:00"),
+    )
+
+    # Then
+    assert sorted(references) == [references[2], references[0], references[1]]
+    assert references[2] < lower <= references[0] <= upper < references[1]
+
+
+def test_migrate_references(monkeypatch: Any) -> None:
+    """Legacy files are put under their new reference and their old one is deleted."""
+    monkeypatch.setattr(src.dynamodb.connection_manager.time, "sleep", lambda s: None)
+
+    # Given
+    connection_manager = _connection_manager()
+    created = "2021-01-02T03:04:05"
+    legacy_reference = connection_manager._build_legacy_reference("a.pdf", created)
+    new_reference = connection_manager._build_reference("b.pdf", created)
+    connection_manager.files_table = MockTable(
+        [
+            {
+                "user": "harry",
+                "reference": legacy_reference,
+                "name": "a.pdf",
+                "created": created,
+            },
+            {
+                "user": "harry",
+                "reference": new_reference,
+                "name": "b.pdf",
+                "created": created,
+            },
+            {
+                "user": "harry",
+                "reference": "c.pdfbroken",
+                "name": "c.pdf",
+                "created": "broken",
+            },
+        ]
+    )
+    written = []
+
+    # When
+    migrated, skipped, last_evaluated_key = connection_manager.migrate_references(
+        0, 1, before_write=written.append
+    )
+
+    # Then
+    assert (migrated, skipped, last_evaluated_key) == (1, 1, None)
+    assert written == [1]
+    requests = [r for call in connection_manager.db.calls for r in call]
+    assert requests[0]["PutRequest"]["Item"]["reference"] == "2021-01-02T03:04:05#a.pdf"
+    assert requests[-1]["DeleteRequest"]["Key"]["reference"] == legacy_reference
+
+
+def test_build_query_picks_index() -> None:
+    """Sender and type filters query their index, reading only the projected attributes."""
+    # Given
+    connection_manager = _connection_manager()
+
+    # When
+    by_sender = connection_manager._build_query("harry", sender="Bob@Example.com")
+    by_type = connection_manager._build_query("harry", file_type="pdf", descending=True)
+    by_both = connection_manager._build_query(
+        "harry", sender="bob@example.com", file_type="pdf"
+    )
+    unfiltered = connection_manager._build_query("harry")
+
+    # Then
+    assert by_sender["IndexName"] == "SenderIndex"
+    assert "FilterExpression" not in by_sender.keys()
+    assert "#name" in by_sender["ProjectionExpression"]
+    assert by_type["IndexName"] == "TypeIndex"
+    assert by_type["ScanIndexForward"] is False
+    assert by_both["IndexName"] == "SenderIndex"
+    assert "FilterExpression" in by_both.keys()
+    assert "IndexName" not in unfiltered.keys()
+
+
+def test_prepare_file_adds_index_keys() -> None:
+    """Index keys are built from the lower cased attribute and the reference."""
+    # Given
+    connection_manager = _connection_manager()
+    file = {
+        "name": "a.pdf",
+        "created": "2021-01-02T03:04:05",
+        "sender": "Bob@Example.com",
+    }
+
+    # When
+    connection_manager._prepare_file("harry", file)
+
+    # Then
+    assert file["sender_key"] == "bob@example.com#2021-01-02T03:04:05#a.pdf"
+    assert "type_key" not in file.keys()
+
+
+def test_legacy_reference_keeps_offset_time() -> None:
+    """Legacy references use the time as given, as they were built before migration."""
+    # Given
+    connection_manager = _connection_manager()
+    created = "2021-01-02T03:04:05+01:00"
+
+    # When
+    legacy_reference = connection_manager._build_legacy_reference("a.pdf", created)
+    reference = connection_manager._build_reference("a.pdf", created)
+
+    # Then
+    assert (
+        legacy_reference
+        == "a.pdf"
+        + datetime.fromisoformat(created).strftime("%b-%d-%YT%H:%M:%S").lower()
+    )
+    assert legacy_reference == "a.pdfjan-02-2021t03:04:05"
+    assert reference.startswith("2021-01-02T02:04:05")
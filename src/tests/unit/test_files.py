@@ -0,0 +1,56 @@
+"""Test the cursors used to page through files."""
+
+from datetime import datetime
+
+import pytest
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+
+from src.api.files import _decode_cursor, _encode_cursor
+
+FILTERS = {
+    "from_datetime": datetime(2021, 1, 1),
+    "to_datetime": None,
+    "sender": None,
+    "file_type": None,
+    "descending": False,
+}
+
+
+def test_cursor_round_trip() -> None:
+    """A cursor decodes back to its start key for the same user and query."""
+    # Given
+    start_key = {"user": "harry", "reference": "2021-01-02T03:04:05#a.pdf"}
+
+    # When
+    cursor = _encode_cursor(start_key, FILTERS)
+
+    # Then
+    with Flask(__name__).test_request_context():
+        assert _decode_cursor(cursor, "harry", dict(FILTERS)) == start_key
+
+
+@pytest.mark.parametrize(
+    "user, changes",
+    [
+        ("ron", {}),
+        ("harry", {"sender": "ron@example.com"}),
+        ("harry", {"file_type": "pdf"}),
+        ("harry", {"descending": True}),
+        ("harry", {"from_datetime": None}),
+    ],
+)
+def test_cursor_rejected_for_other_query(user: str, changes: dict) -> None:
+    """A cursor replayed for another user, index, filter or order is a bad request."""
+    # Given
+    cursor = _encode_cursor(
+        {"user": "harry", "reference": "2021-01-02T03:04:05#a.pdf"}, FILTERS
+    )
+
+    # When
+    with Flask(__name__).test_request_context():
+        with pytest.raises(HTTPException) as e:
+            _decode_cursor(cursor, user, {**FILTERS, **changes})
+
+    # Then
+    assert e.value.code == 400
@@ -0,0 +1,125 @@
+"""Test the Google requestor."""
+
+import re
+from typing import Any
+
+from src.integrations import google as google_module
+from src.integrations.google import GoogleRequestor
+from src.integrations.rate_limit import AdaptiveRateLimiter
+
+
+class MockResponse:
+    """Stand in for a requests.Response."""
+
+    def __init__(
+        self: Any, status_code: int, content: bytes = b"", headers: dict = None
+    ) -> None:
+        """Hold the status, content and headers."""
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.text = content.decode("utf-8")
+
+    def json(self: Any) -> Any:
+        """Return the content as an id."""
+        return {"id": self.text}
+
+
+def _batch_response(parts: list) -> MockResponse:
+    """Build a multipart batch response from (index, status, body) tuples."""
+    content = (
+        "".join(
+            "--batch_abc\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <response-item-{index}>\r\n"
+            "\r\n"
+            f"HTTP/1.1 {status} OK\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n"
+            "\r\n"
+            f"{body}\r\n"
+            for index, status, body in parts
+        )
+        + "--batch_abc--\r\n"
+    )
+    return MockResponse(
+        200,
+        content.encode("utf-8"),
+        {"Content-Type": "multipart/mixed; boundary=batch_abc"},
+    )
+
+
+def test_batch_get(monkeypatch: Any) -> None:
+    """Calls are packed into multipart requests and the parts matched back up by Content-ID."""
+    # Given
+    urls = [
+        f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{i}" for i in range(3)
+    ]
+    posts = []
+    gets = []
+
+    def mock_post(url: str, data: bytes, headers: dict) -> MockResponse:
+        """Answer out of order, throttling the last call."""
+        posts.append(data.decode("utf-8"))
+        return _batch_response(
+            [(1, 200, '{"id": "1"}'), (2, 429, "{}"), (0, 200, '{"id": "0"}')]
+        )
+
+    def mock_get(url: str, headers: dict) -> MockResponse:
+        """Succeed, recording the url."""
+        gets.append(url)
+        return MockResponse(200, url.rsplit("/", 1)[1].encode("utf-8"))
+
+    monkeypatch.setattr(google_module.requests, "post", mock_post)
+    monkeypatch.setattr(google_module.requests, "get", mock_get)
+    requestor = GoogleRequestor(
+        "harry",
+        {"access_token": "abc"},
+        None,
+        {"SYNC_THROTTLE_RETRIES": 2, "INTEGRATIONS_TOKEN_REFRESH_MARGIN": 300},
+        limiter=AdaptiveRateLimiter(rate=1000, min_rate=1, max_rate=1000),
+    )
+
+    # When
+    responses = requestor.batch_get(urls)
+
+    # Then
+    assert re.findall(r"GET (\S+)", posts[0]) == [
+        f"/gmail/v1/users/me/messages/{i}" for i in range(3)
+    ]
+    assert gets == [urls[2]]
+    assert [response.json()["id"] for response in responses] == ["0", "1", "2"]
+
+
+def test_batch_get_falls_back_when_not_multipart(monkeypatch: Any) -> None:
+    """A batch answered with something other than a multipart response is fetched call by call."""
+    # Given
+    urls = [
+        f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{i}" for i in range(2)
+    ]
+    gets = []
+
+    def mock_post(url: str, data: bytes, headers: dict) -> MockResponse:
+        """Answer with plain JSON."""
+        return MockResponse(200, b"{}", {"Content-Type": "application/json"})
+
+    def mock_get(url: str, headers: dict) -> MockResponse:
+        """Succeed, recording the url."""
+        gets.append(url)
+        return MockResponse(200, url.rsplit("/", 1)[1].encode("utf-8"))
+
+    monkeypatch.setattr(google_module.requests, "post", mock_post)
+    monkeypatch.setattr(google_module.requests, "get", mock_get)
+    requestor = GoogleRequestor(
+        "harry",
+        {"access_token": "abc"},
+        None,
+        {"SYNC_THROTTLE_RETRIES": 2, "INTEGRATIONS_TOKEN_REFRESH_MARGIN": 300},
+        limiter=AdaptiveRateLimiter(rate=1000, min_rate=1, max_rate=1000),
+    )
+
+    # When
+    responses = requestor.batch_get(urls)
+
+    # Then
+    assert gets == urls
+    assert [response.json()["id"] for response in responses] == ["0", "1"]
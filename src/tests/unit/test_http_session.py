@@ -0,0 +1,45 @@
+"""Test the pooled HTTP session."""
+
+from typing import Any
+
+import requests
+
+from src.http_session import create_session
+
+APP_CONFIG = {
+    "HTTP_POOL_HOSTS": 2,
+    "HTTP_POOL_SIZE": 4,
+    "HTTP_CONNECT_TIMEOUT": 5,
+    "HTTP_READ_TIMEOUT": 60,
+    "HTTP_GET_RETRIES": 3,
+    "HTTP_RETRY_BACKOFF": 0.5,
+}
+
+
+def test_session_defaults(monkeypatch: Any) -> None:
+    """Requests ask for gzip and carry the default timeout, and only GETs are retried."""
+    # Given
+    session = create_session(APP_CONFIG)
+    adapter = session.get_adapter("https://graph.microsoft.com")
+    sent = []
+
+    def mock_send(request: Any, **kwargs: Any) -> requests.Response:
+        """Record the request and its timeout."""
+        sent.append((request, kwargs["timeout"]))
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(adapter, "send", mock_send)
+
+    # When
+    session.get("https://graph.microsoft.com/v1.0/me")
+    session.post("https://graph.microsoft.com/v1.0/$batch", timeout=10)
+
+    # Then
+    assert sent[0][0].headers["Accept-Encoding"] == "gzip, deflate"
+    assert [timeout for _, timeout in sent] == [(5, 60), 10]
+    assert adapter.max_retries.total == 3
+    assert adapter.max_retries.is_retry("GET", 502)
+    assert not adapter.max_retries.is_retry("POST", 502)
+    assert not adapter.max_retries.is_retry("GET", 429, has_retry_after=True)
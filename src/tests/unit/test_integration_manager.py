@@ -0,0 +1,215 @@
+"""Test the integration manager's cache of integration records."""
+
+import threading
+import time
+from typing import Any
+
+import requests
+
+from src.integration_manager import IntegrationManager
+
+
+class MockConnectionManager:
+    """Stand in for the connection manager, counting reads of the integrations table."""
+
+    def __init__(self: Any) -> None:
+        """Start with a single msal integration."""
+        self.reads = 0
+        self.integrations = {"harry": {"msal": {"access_token": "abc"}}}
+
+    def get_integrations(self: Any, user: str) -> dict:
+        """Return a copy of the user's integrations, as a fresh read would."""
+        self.reads += 1
+        return {k: dict(v) for k, v in self.integrations.get(user, {}).items()}
+
+    def set_integration(self: Any, user: str, integration: str, value: dict) -> dict:
+        """Replace a single integration."""
+        self.integrations.setdefault(user, {})[integration] = dict(value)
+        return {k: dict(v) for k, v in self.integrations[user].items()}
+
+    def update_integration(
+        self: Any,
+        user: str,
+        integration: str,
+        fields: dict,
+        expected_version: Any = None,
+        versioned: bool = True,
+        remove: list = None,
+    ) -> Any:
+        """Update fields of an integration if its version matches."""
+        current = self.integrations[user][integration]
+        if versioned:
+            if current.get("_version") != expected_version:
+                return None
+            current["_version"] = (expected_version or 0) + 1
+        current.update(fields)
+        for field in remove or []:
+            current.pop(field, None)
+        return {k: dict(v) for k, v in self.integrations[user].items()}
+
+    def acquire_integration_lease(
+        self: Any, user: str, integration: str, lease_until: int, now: int
+    ) -> bool:
+        """Take the lease on refreshing the integration if no one holds it."""
+        current = self.integrations[user][integration]
+        if current.get("_refresh_lease", 0) >= now:
+            return False
+        current["_refresh_lease"] = lease_until
+        return True
+
+    def put_integrations(self: Any, user: str, integrations: dict) -> bool:
+        """Store the integrations."""
+        integrations["user"] = user
+        self.integrations[user] = {k: v for k, v in integrations.items() if k != "user"}
+        return "SUCCESS"
+
+
+def _integration_manager() -> tuple:
+    """Create an integration manager backed by the mock connection manager."""
+    connection_manager = MockConnectionManager()
+    integration_manager = IntegrationManager()
+    integration_manager.initialise(
+        connection_manager,
+        {
+            "CACHE_REDIS_URL": None,
+            "INTEGRATIONS_CACHE_SIZE": 10,
+            "INTEGRATIONS_CACHE_TTL": 60,
+            "INTEGRATIONS_REFRESH_LEASE": 30,
+            "INTEGRATIONS_REFRESH_POLL": 0.01,
+        },
+        session=requests.Session(),
+    )
+    return integration_manager, connection_manager
+
+
+def test_integrations_read_through_cache() -> None:
+    """Repeated reads of a user's integrations only hit the database once."""
+    # Given
+    integration_manager, connection_manager = _integration_manager()
+
+    # When
+    integration_manager.get_integration("harry", "msal")
+    integration_manager.list_integrations("harry")
+    integration = integration_manager.get_integration("harry", "msal")
+    integration["access_token"] = "changed"
+
+    # Then
+    assert connection_manager.reads == 1
+    assert integration_manager.get_integration("harry", "msal")["access_token"] == "abc"
+
+
+def test_add_integration_writes_through() -> None:
+    """Adding an integration updates the cache without reading from the database."""
+    # Given
+    integration_manager, connection_manager = _integration_manager()
+
+    # When
+    integration_manager.add_integration("harry", "google", {"access_token": "def"})
+
+    # Then
+    assert sorted(integration_manager.list_integrations("harry")) == ["google", "msal"]
+    assert connection_manager.reads == 0
+
+    # When
+    integration_manager.invalidate("harry")
+    integration_manager.list_integrations("harry")
+
+    # Then
+    assert connection_manager.reads == 1
+
+
+def test_update_integration_with_stale_version() -> None:
+    """A stale update writes nothing and returns the newer copy."""
+    # Given
+    integration_manager, connection_manager = _integration_manager()
+    stale = integration_manager.get_integration("harry", "msal")
+
+    # When
+    fresh = integration_manager.update_integration(
+        "harry", "msal", {"access_token": "first"}, version=stale.get("_version")
+    )
+    result = integration_manager.update_integration(
+        "harry", "msal", {"access_token": "second"}, version=stale.get("_version")
+    )
+
+    # Then
+    assert fresh["access_token"] == "first"
+    assert result["access_token"] == "first"
+    assert result["_version"] == 1
+    assert connection_manager.integrations["harry"]["msal"]["access_token"] == "first"
+
+
+def test_add_integration_records_expiry() -> None:
+    """The lifetime given with a new token is stored as when it expires."""
+    # Given
+    integration_manager, connection_manager = _integration_manager()
+
+    # When
+    integration = integration_manager.add_integration(
+        "harry", "google", {"access_token": "def", "expires_in": 3600}
+    )
+
+    # Then
+    assert abs(integration["google"]["expires_at"] - (time.time() + 3600)) < 5
+
+
+def test_concurrent_refreshes_request_one_token() -> None:
+    """Threads refreshing the same token at once only ask the provider once."""
+    # Given
+    integration_manager, connection_manager = _integration_manager()
+    stale = integration_manager.get_integration("harry", "msal")
+    requests = []
+
+    def _request_token() -> dict:
+        requests.append(1)
+        time.sleep(0.05)
+        return {"access_token": "fresh"}
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                integration_manager.refresh_integration(
+                    "harry", "msal", stale, _request_token
+                )
+            )
+        )
+        for _ in range(5)
+    ]
+
+    # When
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Then
+    assert len(requests) == 1
+    assert [result["access_token"] for result in results] == ["fresh"] * 5
+    assert "_refresh_lease" not in connection_manager.integrations["harry"]["msal"]
+
+
+def test_refresh_waits_for_lease_holder() -> None:
+    """While another process holds the lease, its refreshed token is used instead."""
+    # Given
+    integration_manager, connection_manager = _integration_manager()
+    stale = integration_manager.get_integration("harry", "msal")
+    connection_manager.integrations["harry"]["msal"]["_refresh_lease"] = (
+        int(time.time()) + 30
+    )
+
+    def _other_process() -> None:
+        time.sleep(0.05)
+        connection_manager.update_integration(
+            "harry", "msal", {"access_token": "theirs"}, None, remove=["_refresh_lease"]
+        )
+
+    threading.Thread(target=_other_process).start()
+
+    # When
+    result = integration_manager.refresh_integration(
+        "harry", "msal", stale, lambda: {"access_token": "ours"}
+    )
+
+    # Then
+    assert result["access_token"] == "theirs"
@@ -0,0 +1,95 @@
+"""Test the background job manager."""
+
+from typing import Any
+
+import pytest
+from flask import abort
+
+from src.jobs import ImmediateJobQueue, JobManager, ThreadJobQueue
+
+APP_CONFIG = {
+    "CACHE_REDIS_URL": None,
+    "SYNC_JOB_QUEUE": "immediate",
+    "SYNC_JOB_WORKERS": 2,
+    "SYNC_JOB_STORE_SIZE": 10,
+    "SYNC_JOB_TTL": 60,
+}
+
+
+def _job_manager(queue: Any = None) -> JobManager:
+    """Create a job manager with a job that counts its items and one that aborts."""
+    jm = JobManager()
+
+    def count(user: str, params: dict, progress: Any) -> dict:
+        """Count the items in the params."""
+        for _ in progress.count("items", params["items"]):
+            pass
+        return {"message": f"{user} counted {len(params['items'])} items."}
+
+    def fail(user: str, params: dict, progress: Any) -> dict:
+        """Abort part way through."""
+        progress.increment("items")
+        abort(413, "Too many requests.")
+
+    jm.register("count", count)
+    jm.register("fail", fail)
+    jm.initialise(APP_CONFIG, queue=queue)
+    return jm
+
+
+def test_job_runs_and_reports_progress() -> None:
+    """A submitted job runs and its result and counters can be read back."""
+    # Given
+    jm = _job_manager(ImmediateJobQueue())
+
+    # When
+    job = jm.submit("harry", "count", {"items": [1, 2, 3]})
+
+    # Then
+    assert job["status"] == "SUCCESS"
+    assert job["progress"] == {"items": 3}
+    assert job["result"] == {"message": "harry counted 3 items."}
+    assert "user" not in job and "params" not in job
+
+
+def test_failed_job_records_error() -> None:
+    """An abort inside a job is recorded with its status code."""
+    # Given
+    jm = _job_manager(ImmediateJobQueue())
+
+    # When
+    job = jm.submit("harry", "fail", {})
+
+    # Then
+    assert job["status"] == "FAILED"
+    assert job["progress"] == {"items": 1}
+    assert job["error"] == {"code": 413, "message": "Too many requests."}
+
+
+def test_jobs_are_private() -> None:
+    """Users can only read their own jobs."""
+    # Given
+    jm = _job_manager(ImmediateJobQueue())
+    job = jm.submit("harry", "count", {"items": []})
+
+    # Then
+    with pytest.raises(KeyError):
+        jm.get_job("sally", job["id"])
+    with pytest.raises(KeyError):
+        jm.submit("harry", "unknown", {})
+
+
+def test_thread_queue_runs_jobs() -> None:
+    """Jobs put on the thread queue are run in the background."""
+    # Given
+    queue = ThreadJobQueue(workers=2)
+    jm = _job_manager(queue)
+
+    # When
+    jobs = [jm.submit("harry", "count", {"items": [i] * i}) for i in range(5)]
+    queue.join()
+
+    # Then
+    for i, job in enumerate(jobs):
+        assert jm.get_job("harry", job["id"])["progress"].get("items", 0) == i
+        assert jm.get_job("harry", job["id"])["status"] == "SUCCESS"
@@ -0,0 +1,105 @@
+"""Test the cached JSON Web Key Set store."""
+
+import time
+from typing import Any
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwk, jwt
+
+from src.jwks import JWKSKeyStore
+
+
+def _make_jwk(kid: str) -> tuple:
+    """Return a private PEM and the matching public JWK for a fresh RSA key."""
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    public_jwk = jwk.construct(pem, "RS256").public_key().to_dict()
+    public_jwk.update({"kid": kid, "use": "sig"})
+    return pem, public_jwk
+
+
+def _counting_store(monkeypatch: Any, jwks: dict, **kwargs: Any) -> tuple:
+    """Create a store whose fetches are served from memory and counted."""
+    calls = []
+    store = JWKSKeyStore("https://tenant/.well-known/jwks.json", **kwargs)
+
+    def mock_fetch() -> dict:
+        """Return the in memory key set."""
+        calls.append(1)
+        return jwks
+
+    monkeypatch.setattr(store, "_fetch", mock_fetch)
+    return store, calls
+
+
+def test_keys_fetched_once(monkeypatch: Any) -> None:
+    """Repeated lookups of a known kid are served from the cache."""
+    # Given
+    pem, public_jwk = _make_jwk("kid_1")
+    store, calls = _counting_store(
+        monkeypatch, {"keys": [public_jwk]}, ttl=60, min_refetch_interval=30
+    )
+    token = jwt.encode(
+        {"sub": "harry"}, pem, algorithm="RS256", headers={"kid": "kid_1"}
+    )
+
+    # When
+    keys = [store.get_key("kid_1") for _ in range(5)]
+
+    # Then
+    assert len(calls) == 1
+    assert jwt.decode(token, [keys[0]], algorithms=["RS256"])["sub"] == "harry"
+
+
+def test_unknown_kid_refetch_is_rate_limited(monkeypatch: Any) -> None:
+    """Unknown kids trigger a refetch, but not more than once per interval."""
+    # Given
+    _, public_jwk = _make_jwk("kid_1")
+    jwks = {"keys": [public_jwk]}
+    store, calls = _counting_store(monkeypatch, jwks, ttl=60, min_refetch_interval=30)
+    store.get_key("kid_1")
+    store._fetched_at -= 31
+
+    # When
+    first = store.get_key("kid_2")
+    second = store.get_key("kid_2")
+
+    # Then
+    assert first is None and second is None
+    assert len(calls) == 2
+
+    # When the key is rotated in and the interval has passed.
+    _, rotated_jwk = _make_jwk("kid_2")
+    jwks["keys"].append(rotated_jwk)
+    store._fetched_at -= 31
+
+    # Then
+    assert store.get_key("kid_2") is not None
+    assert len(calls) == 3
+
+
+def test_stale_keys_refreshed_in_background(monkeypatch: Any) -> None:
+    """Stale keys are still served whilst a fresh copy is fetched."""
+    # Given
+    _, public_jwk = _make_jwk("kid_1")
+    store, calls = _counting_store(
+        monkeypatch, {"keys": [public_jwk]}, ttl=60, min_refetch_interval=30
+    )
+    store.get_key("kid_1")
+    store._fetched_at -= 61
+
+    # When
+    key = store.get_key("kid_1")
+    for _ in range(50):
+        if len(calls) == 2:
+            break
+        time.sleep(0.01)
+
+    # Then
+    assert key is not None
+    assert len(calls) == 2
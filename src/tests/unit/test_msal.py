@@ -0,0 +1,241 @@
+"""Test the MSAL requestor."""
+
+import json
+import time
+from typing import Any
+
+import msal
+
+from src.integrations import msal as msal_module
+from src.integrations.msal import MSALRequestor
+from src.integrations.rate_limit import AdaptiveRateLimiter
+
+
+class MockResponse:
+    """Stand in for a requests.Response."""
+
+    def __init__(
+        self: Any, status_code: int, body: Any = None, headers: dict = None
+    ) -> None:
+        """Hold the status, body and headers."""
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.text = str(body)
+
+    def json(self: Any) -> Any:
+        """Return the body."""
+        return self.body
+
+
+def _requestor() -> MSALRequestor:
+    """Create a requestor with a valid access token."""
+    return MSALRequestor(
+        "harry",
+        {"access_token": "abc", "_version": 1},
+        None,
+        {"SYNC_THROTTLE_RETRIES": 2, "INTEGRATIONS_TOKEN_REFRESH_MARGIN": 300},
+        limiter=AdaptiveRateLimiter(rate=1000, min_rate=1, max_rate=1000),
+    )
+
+
+def test_batch_get_splits_responses(monkeypatch: Any) -> None:
+    """Each $batch call packs 20 URLs, and the responses are returned in order."""
+    # Given
+    urls = [
+        f"https://graph.microsoft.com/v1.0/me/messages/{i}/attachments"
+        for i in range(25)
+    ]
+    posts = []
+
+    def mock_post(url: str, json: dict, headers: dict) -> MockResponse:
+        """Answer each sub-request with its own url, in reverse order."""
+        posts.append(json)
+        return MockResponse(
+            200,
+            {
+                "responses": [
+                    {"id": r["id"], "status": 200, "body": {"url": r["url"]}}
+                    for r in reversed(json["requests"])
+                ]
+            },
+        )
+
+    monkeypatch.setattr(msal_module.requests, "post", mock_post)
+
+    # When
+    responses = _requestor().batch_get(urls)
+
+    # Then
+    assert [len(post["requests"]) for post in posts] == [20, 5]
+    assert [response.json()["url"] for response in responses] == [
+        f"/me/messages/{i}/attachments" for i in range(25)
+    ]
+
+
+def test_batch_get_retries_throttled(monkeypatch: Any) -> None:
+    """Throttled sub-requests are retried on their own."""
+    # Given
+    urls = [
+        f"https://graph.microsoft.com/v1.0/me/messages/{i}/attachments"
+        for i in range(3)
+    ]
+    gets = []
+
+    def mock_post(url: str, json: dict, headers: dict) -> MockResponse:
+        """Throttle the second sub-request."""
+        return MockResponse(
+            200,
+            {
+                "responses": [
+                    {"id": "0", "status": 200, "body": {"value": 0}},
+                    {
+                        "id": "1",
+                        "status": 429,
+                        "headers": {"Retry-After": "0"},
+                        "body": {},
+                    },
+                    {"id": "2", "status": 200, "body": {"value": 2}},
+                ]
+            },
+        )
+
+    def mock_get(url: str, headers: dict) -> MockResponse:
+        """Succeed, recording the url."""
+        gets.append(url)
+        return MockResponse(200, {"value": 1})
+
+    monkeypatch.setattr(msal_module.requests, "post", mock_post)
+    monkeypatch.setattr(msal_module.requests, "get", mock_get)
+
+    # When
+    responses = _requestor().batch_get(urls)
+
+    # Then
+    assert gets == [urls[1]]
+    assert [response.json()["value"] for response in responses] == [0, 1, 2]
+
+
+def test_refreshes_before_expiry(monkeypatch: Any) -> None:
+    """A token about to expire is refreshed before the request, which then isn't rejected."""
+    # Given
+    refreshes = []
+
+    class MockIntegrationManager:
+        """Stand in for the integration manager, recording refreshes."""
+
+        def refresh_integration(
+            self: Any, user: str, integration: str, info: dict, request_token: Any
+        ) -> dict:
+            """Return a fresh token."""
+            refreshes.append(integration)
+            return {"access_token": "fresh", "expires_at": time.time() + 3600}
+
+    def mock_get(url: str, headers: dict) -> MockResponse:
+        """Reject all but the fresh token."""
+        if headers["Authorization"] != "Bearer fresh":
+            return MockResponse(401)
+        return MockResponse(200, {"value": 1})
+
+    monkeypatch.setattr(msal_module.requests, "get", mock_get)
+    requestor = _requestor()
+    requestor.im = MockIntegrationManager()
+    requestor.msal_info["expires_at"] = time.time() + 60
+
+    # When
+    response = requestor.get("https://graph.microsoft.com/v1.0/me/messages")
+
+    # Then
+    assert response.status_code == 200
+    assert refreshes == ["msal"]
+
+
+def test_msal_app_built_once(monkeypatch: Any) -> None:
+    """The MSAL app is discovered once, and copies bound to a token cache write to that cache.
+
+    This builds real MSAL apps, so it fails if the private `_build_client` that binding a
+    copy relies on changes in a new version of MSAL.
+
+    """
+    # Given
+    discoveries = []
+
+    class MockSession:
+        """Answer MSAL's discovery and token requests."""
+
+        def get(self: Any, url: str, **kwargs: Any) -> MockResponse:
+            """Return the authority's OpenID configuration."""
+            discoveries.append(url)
+            return MockResponse(
+                200,
+                json.dumps(
+                    {
+                        "authorization_endpoint": "https://login.example.com/authorize",
+                        "token_endpoint": "https://login.example.com/token",
+                        "issuer": "https://login.example.com",
+                    }
+                ),
+            )
+
+        def post(self: Any, url: str, **kwargs: Any) -> MockResponse:
+            """Return a new access token."""
+            return MockResponse(
+                200, json.dumps({"access_token": "fresh", "expires_in": 3600})
+            )
+
+    monkeypatch.setattr(msal_module, "_msal_app", None)
+    monkeypatch.setattr(msal_module, "create_session", lambda app_config: MockSession())
+    app_config = {
+        "MSAL_APP_ID": "app",
+        "MSAL_APP_SECRET": "secret",
+        "MSAL_AUTHORITY": "https://login.microsoftonline.com/common",
+    }
+    cache = msal.SerializableTokenCache()
+
+    # When
+    shared = msal_module.get_msal_app(app_config)
+    bound = msal_module.get_msal_app(app_config, cache)
+    result = bound.acquire_token_by_refresh_token("refresh", ["mail.read"])
+
+    # Then
+    assert result["access_token"] == "fresh"
+    assert len(discoveries) == 1
+    assert msal_module.get_msal_app(app_config) is shared
+    assert cache.find(msal.TokenCache.CredentialType.ACCESS_TOKEN)
+    assert not shared.token_cache.find(msal.TokenCache.CredentialType.ACCESS_TOKEN)
+
+
+def test_refresh_through_token_cache(monkeypatch: Any) -> None:
+    """Integrations with a token cache refresh through MSAL, always forcing a new token."""
+    # Given
+    calls = []
+
+    class MockApplication:
+        """Stand in for an MSAL app bound to the integration's token cache."""
+
+        def get_accounts(self: Any) -> list:
+            """Return the one signed in account."""
+            return [{"home_account_id": "harry"}]
+
+        def acquire_token_silent(
+            self: Any, scopes: list, account: dict, force_refresh: bool
+        ) -> dict:
+            """Return a fresh token."""
+            calls.append(force_refresh)
+            return {"access_token": "fresh", "expires_in": 3600}
+
+    monkeypatch.setattr(
+        msal_module, "get_msal_app", lambda app_config, cache: MockApplication()
+    )
+    requestor = _requestor()
+    requestor.app_config["MSAL_SCOPES"] = ["mail.read"]
+    requestor.msal_info["token_cache"] = "{}"
+
+    # When
+    fields = requestor._request_token()
+
+    # Then
+    assert calls == [True]
+    assert fields["access_token"] == "fresh"
+    assert abs(fields["expires_at"] - (time.time() + 3600)) < 5
+    assert "token_cache" not in fields
@@ -0,0 +1,139 @@
+"""Test the write stage of the synchronisation pipelines."""
+
+from typing import Any
+
+import pytest
+from werkzeug.exceptions import HTTPException
+
+from src.api.synchronisations import pipeline
+from src.api.synchronisations.pipeline import write_files
+
+
+class MockConnectionManager:
+    """Record the batches of files put."""
+
+    def __init__(self: Any, failing: list = None, error: Exception = None) -> None:
+        """Start with no batches, failing the referenced files or raising error on every put."""
+        self.batches = []
+        self.failing = failing or []
+        self.error = error
+
+    def put_files(self: Any, user: str, files: list) -> dict:
+        """Record the batch, keying the status by a reference set on each file."""
+        if self.error is not None:
+            raise self.error
+        self.batches.append([file["name"] for file in files])
+        status = {}
+        for file in files:
+            file["reference"] = (
+                f"{file['created']}#{file['name']}"
+                if "created" in file
+                else file["name"]
+            )
+            status[file["reference"]] = (
+                "FAILED" if file["reference"] in self.failing else "SUCCESS"
+            )
+        return status
+
+
+class MockProgress:
+    """Record the job's progress counters."""
+
+    def __init__(self: Any) -> None:
+        """Start with no counters."""
+        self.counters = {}
+
+    def increment(self: Any, counter: str, amount: int = 1) -> None:
+        """Add amount to the counter."""
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+
+def test_files_written_in_batches(monkeypatch: Any) -> None:
+    """Files are written as each batch fills, with the remainder written at the end."""
+    # Given
+    cm = MockConnectionManager()
+    monkeypatch.setattr(pipeline, "cm", cm)
+    files = ({"name": str(i)} for i in range(5))
+
+    # When
+    written = write_files("harry", files, batch_size=2)
+
+    # Then
+    assert written == 5
+    assert cm.batches == [["0", "1"], ["2", "3"], ["4"]]
+
+
+def test_progress_kept_on_error(monkeypatch: Any) -> None:
+    """Files found before an earlier stage fails are still written."""
+    # Given
+    cm = MockConnectionManager()
+    monkeypatch.setattr(pipeline, "cm", cm)
+
+    def files() -> Any:
+        """Yield three files and then fail."""
+        for i in range(3):
+            yield {"name": str(i)}
+        raise ValueError("Too many requests.")
+
+    # When
+    with pytest.raises(ValueError):
+        write_files("harry", files(), batch_size=2)
+
+    # Then
+    assert cm.batches == [["0", "1"], ["2"]]
+
+
+def test_failed_files_not_counted(monkeypatch: Any) -> None:
+    """Files the database fails to write aren't counted as written, and fail the sync."""
+    # Given
+    cm = MockConnectionManager(failing=["1", "3"])
+    monkeypatch.setattr(pipeline, "cm", cm)
+    progress = MockProgress()
+    files = ({"name": str(i)} for i in range(5))
+
+    # When
+    with pytest.raises(HTTPException) as e:
+        write_files("harry", files, batch_size=2, progress=progress)
+
+    # Then
+    assert e.value.code == 503
+    assert "2 attachments" in e.value.description
+    assert cm.batches == [["0", "1"], ["2", "3"], ["4"]]
+    assert progress.counters == {"attachments": 3, "failed": 2}
+
+
+def test_failures_counted_per_file_with_same_name(monkeypatch: Any) -> None:
+    """Files sharing a name are counted separately, so only the one that failed is failed."""
+    # Given
+    cm = MockConnectionManager(failing=["2021-01-02T00:00:00#image001.png"])
+    monkeypatch.setattr(pipeline, "cm", cm)
+    progress = MockProgress()
+    files = [
+        {"name": "image001.png", "created": "2021-01-01T00:00:00"},
+        {"name": "image001.png", "created": "2021-01-02T00:00:00"},
+    ]
+
+    # When
+    with pytest.raises(HTTPException) as e:
+        write_files("harry", iter(files), batch_size=2, progress=progress)
+
+    # Then
+    assert "1 attachments" in e.value.description
+    assert progress.counters == {"attachments": 1, "failed": 1}
+
+
+def test_original_error_kept_when_final_write_fails(monkeypatch: Any) -> None:
+    """If writing the files found so far fails too, the earlier stage's error is raised."""
+    # Given
+    monkeypatch.setattr(
+        pipeline, "cm", MockConnectionManager(error=IOError("Unavailable."))
+    )
+
+    def files() -> Any:
+        """Yield a file and then fail."""
+        yield {"name": "0"}
+        raise ValueError("Too many requests.")
+
+    # When
+    with pytest.raises(ValueError):
+        write_files("harry", files(), batch_size=2)
@@ -0,0 +1,98 @@
+"""Test the adaptive rate limiter."""
+
+from typing import Any
+
+from src.integrations import rate_limit
+from src.integrations.rate_limit import AdaptiveRateLimiter, get_limiter, send_paced
+
+
+class MockResponse:
+    """Stand in for a requests.Response."""
+
+    def __init__(self: Any, status_code: int, retry_after: str = "0") -> None:
+        """Hold the status and Retry-After header."""
+        self.status_code = status_code
+        self.headers = {"Retry-After": retry_after}
+
+
+def test_rate_adapts() -> None:
+    """The rate grows additively on success and halves when throttled, within its bounds."""
+    # Given
+    limiter = AdaptiveRateLimiter(rate=4, min_rate=1, max_rate=5)
+
+    # When
+    for _ in range(10):
+        limiter.succeeded()
+
+    # Then
+    assert limiter.rate == 5
+
+    # When
+    for _ in range(4):
+        limiter.throttled(0)
+
+    # Then
+    assert limiter.rate == 1
+
+
+def test_requests_wait_for_tokens(monkeypatch: Any) -> None:
+    """Once the bucket is empty, each request waits for its share of the rate."""
+    # Given
+    waits = []
+    monkeypatch.setattr(rate_limit.time, "sleep", waits.append)
+    limiter = AdaptiveRateLimiter(rate=2, min_rate=1, max_rate=2)
+
+    # When
+    for _ in range(4):
+        limiter.acquire()
+
+    # Then
+    assert len(waits) == 2
+    assert 0.4 < waits[0] < 0.6 and 0.9 < waits[1] < 1.1
+
+
+def test_throttled_requests_are_retried(monkeypatch: Any) -> None:
+    """Throttled responses pause the limiter for their Retry-After and the request is retried."""
+    # Given
+    waits = []
+    monkeypatch.setattr(rate_limit.time, "sleep", waits.append)
+    limiter = AdaptiveRateLimiter(rate=100, min_rate=1, max_rate=100)
+    responses = [MockResponse(429, "3"), MockResponse(503, "abc"), MockResponse(200)]
+
+    # When
+    response = send_paced(limiter, lambda: responses.pop(0), max_retries=5)
+
+    # Then
+    assert response.status_code == 200
+    assert waits[0] > 2.9
+    assert limiter.rate < 100
+
+
+def test_limiters_shared_per_user_and_provider() -> None:
+    """Each user's mailbox at each provider has its own limiter."""
+    assert get_limiter("harry", "msal", 1, 1, 1) is get_limiter(
+        "harry", "msal", 2, 2, 2
+    )
+    assert get_limiter("harry", "msal", 1, 1, 1) is not get_limiter(
+        "harry", "google", 1, 1, 1
+    )
+    assert get_limiter("harry", "msal", 1, 1, 1) is not get_limiter(
+        "sally", "msal", 1, 1, 1
+    )
+
+
+def test_idle_limiters_expire(monkeypatch: Any) -> None:
+    """A limiter left unused past the idle ttl is dropped, and the next caller gets a new one."""
+    now = [1000.0]
+    monkeypatch.setattr("src.cache.time.time", lambda: now[0])
+    limiter = get_limiter("idle", "msal", 1, 1, 1)
+
+    # Used within the ttl, the limiter is kept and its expiry pushed back.
+    now[0] += rate_limit._limiters.ttl - 1
+    assert get_limiter("idle", "msal", 1, 1, 1) is limiter
+    now[0] += rate_limit._limiters.ttl - 1
+    assert get_limiter("idle", "msal", 1, 1, 1) is limiter
+
+    # Left idle for longer than the ttl, it is replaced.
+    now[0] += rate_limit._limiters.ttl + 1
+    assert get_limiter("idle", "msal", 1, 1, 1) is not limiter
@@ -0,0 +1,444 @@
+"""Test the queries made by the synchronisation resources."""
+
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+import pytest
+
+from src.api.synchronisations import gmail as gmail_module
+from src.api.synchronisations import outlook as outlook_module
+from src.api.synchronisations import pipeline
+from src.api.synchronisations.gmail import Gmail
+from src.api.synchronisations.outlook import Outlook
+
+
+class MockResponse:
+    """Stand in for a requests.Response."""
+
+    def __init__(self: Any, body: dict, status_code: int = 200) -> None:
+        """Hold the body and status of the response."""
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self: Any) -> dict:
+        """Return the body."""
+        return self.body
+
+
+class MockRequestor:
+    """Serve pages of responses in turn, recording the urls requested."""
+
+    def __init__(self: Any, pages: list, info: dict = None) -> None:
+        """Hold the pages to serve, a page is a body or a MockResponse."""
+        self.pages = pages
+        self.urls = []
+        self.user = "harry"
+        self.msal_info = info or {}
+        self.google_info = info or {}
+
+    def get(self: Any, url: str, headers: dict = None) -> MockResponse:
+        """Return the next page."""
+        self.urls.append(url)
+        page = self.pages.pop(0)
+        return page if isinstance(page, MockResponse) else MockResponse(page)
+
+    def batch_get(self: Any, urls: list, headers: dict = None) -> list:
+        """List one attachment for each email, named after the email's id."""
+        return [
+            MockResponse(
+                {
+                    "value": [
+                        {
+                            "name": f"{url.split('/')[-2]}.pdf",
+                            "contentType": "application/pdf",
+                            "isInline": False,
+                        }
+                    ]
+                }
+            )
+            for url in urls
+        ]
+
+
+class MockGmailRequestor(MockRequestor):
+    """Serve pages of history or messages, and messages with attachments for those named."""
+
+    def __init__(
+        self: Any, pages: list, with_attachments: list, info: dict = None
+    ) -> None:
+        """Hold the pages to serve, and the ids of the messages with attachments."""
+        super().__init__(pages, info)
+        self.with_attachments = with_attachments
+
+    def batch_get(self: Any, urls: list, headers: dict = None) -> list:
+        """Return each message, with an attachment named after it if it has one."""
+        responses = []
+        for url in urls:
+            id = url.split("/messages/")[1].split("?")[0]
+            parts = [{"filename": "", "mimeType": "text/plain"}]
+            if id in self.with_attachments:
+                parts.append({"filename": f"{id}.pdf", "mimeType": "application/pdf"})
+            responses.append(
+                MockResponse(
+                    {
+                        "payload": {
+                            "headers": [
+                                {"name": "From", "value": "Ron <ron@example.com>"},
+                                {
+                                    "name": "Date",
+                                    "value": "Mon, 1 Mar 2021 10:00:00 +0000",
+                                },
+                            ],
+                            "parts": parts,
+                        }
+                    }
+                )
+            )
+        return responses
+
+
+class MockIntegrationManager:
+    """Hand out the requestor, recording the integration fields written."""
+
+    def __init__(self: Any, requestor: MockRequestor) -> None:
+        """Hold the requestor."""
+        self.requestor = requestor
+        self.writes = []
+
+    def get_requestor(self: Any, user: str, integration: str) -> MockRequestor:
+        """Return the requestor."""
+        return self.requestor
+
+    def set_integration_fields(
+        self: Any, user: str, integration: str, fields: dict, remove: list = None
+    ) -> dict:
+        """Record the fields written and removed."""
+        self.writes.append((fields, remove))
+        return {}
+
+
+class MockConnectionManager:
+    """Record the names of the files put, failing if asked to."""
+
+    def __init__(self: Any, fail: bool = False) -> None:
+        """Start with no files."""
+        self.fail = fail
+        self.names = []
+
+    def put_files(self: Any, user: str, files: list) -> dict:
+        """Record the files, or fail."""
+        if self.fail:
+            raise ValueError("The database is unavailable.")
+        self.names.extend(file["name"] for file in files)
+        for file in files:
+            file["reference"] = file["name"]
+        return {file["reference"]: "SUCCESS" for file in files}
+
+
+class MockProgress:
+    """Stand in for a job's progress, counting nothing."""
+
+    def increment(self: Any, counter: str, amount: int = 1) -> None:
+        """Ignore the increment."""
+
+    def count(self: Any, counter: str, items: Any) -> Any:
+        """Yield the items."""
+        yield from items
+
+
+def _delta_email(id: str, **fields: Any) -> dict:
+    """Return an email as listed by a Graph delta query."""
+    return {
+        "id": id,
+        "receivedDateTime": "2021-03-01T10:00:00Z",
+        "sender": {"emailAddress": {"address": "ron@example.com"}},
+        "webLink": f"https://outlook/{id}",
+        "hasAttachments": True,
+        **fields,
+    }
+
+
+def _delta_sync(
+    monkeypatch: Any,
+    requestor: MockRequestor,
+    cm: MockConnectionManager,
+    integration_manager: MockIntegrationManager,
+    from_datetime: datetime = datetime(2021, 2, 1),
+) -> None:
+    """Run a delta sync, from 2021-02-01 unless told otherwise, against the mocks."""
+    monkeypatch.setattr(outlook_module, "im", integration_manager)
+    monkeypatch.setattr(pipeline, "cm", cm)
+    monkeypatch.setitem(outlook_module.app_config, "GRAPH_API_BATCH_REQUESTS", True)
+    Outlook().synchronise("harry", from_datetime, "delta", None, MockProgress())
+
+
+def test_outlook_filters_dates_in_query() -> None:
+    """The date window is sent to Graph and every page of emails is yielded."""
+    # Given
+    email = {"id": "1", "receivedDateTime": "2021-03-01T10:00:00Z"}
+    requestor = MockRequestor(
+        [
+            {"value": [email], "@odata.nextLink": "next"},
+            {"value": [dict(email, id="2")]},
+        ]
+    )
+
+    # When
+    emails = list(
+        Outlook()._email_generator(
+            datetime(2021, 2, 1), requestor, to_datetime=datetime(2021, 4, 1)
+        )
+    )
+
+    # Then
+    assert [email["id"] for email in emails] == ["1", "2"]
+    assert (
+        "$filter=receivedDateTime ge 2021-02-01T00:00:00Z"
+        " and receivedDateTime lt 2021-04-01T00:00:00Z and hasAttachments eq true"
+    ) in requestor.urls[0]
+
+
+def test_gmail_filters_dates_in_query() -> None:
+    """The date window is sent to Gmail as epoch seconds."""
+    # Given
+    requestor = MockRequestor([{"messages": [{"id": "1"}]}])
+
+    # When
+    emails = list(
+        Gmail()._email_generator(
+            datetime(2021, 2, 1), requestor, to_datetime=datetime(2021, 4, 1)
+        )
+    )
+
+    # Then
+    assert emails == [{"id": "1"}]
+    assert 'q="has:attachment after:1612137600 before:1617235200"' in requestor.urls[0]
+
+
+def test_outlook_delta_starts_fresh(monkeypatch: Any) -> None:
+    """Without a stored link the delta query starts at from_datetime, skipping unwanted emails."""
+    # Given
+    requestor = MockRequestor(
+        [
+            {
+                "value": [
+                    _delta_email("1"),
+                    _delta_email("2", hasAttachments=False),
+                    {"id": "3", "@removed": {"reason": "deleted"}},
+                ],
+                "@odata.nextLink": "next",
+            },
+            {"value": [_delta_email("4")], "@odata.deltaLink": "delta_1"},
+        ]
+    )
+    cm = MockConnectionManager()
+    integration_manager = MockIntegrationManager(requestor)
+
+    # When
+    _delta_sync(monkeypatch, requestor, cm, integration_manager)
+
+    # Then
+    assert "messages/delta?" in requestor.urls[0]
+    assert "receivedDateTime ge 2021-02-01T00:00:00Z" in requestor.urls[0]
+    assert cm.names == ["1.pdf", "4.pdf"]
+    assert integration_manager.writes == [
+        ({"delta_link": "delta_1", "delta_from": "2021-02-01T00:00:00+00:00"}, None)
+    ]
+
+
+def test_outlook_delta_resumes_from_stored_link(monkeypatch: Any) -> None:
+    """A stored link made for an earlier from_datetime is resumed, keeping its from_datetime."""
+    # Given
+    requestor = MockRequestor(
+        [{"value": [_delta_email("5")], "@odata.deltaLink": "delta_2"}],
+        info={"delta_link": "delta_1", "delta_from": "2021-01-01T00:00:00"},
+    )
+    cm = MockConnectionManager()
+    integration_manager = MockIntegrationManager(requestor)
+
+    # When
+    _delta_sync(monkeypatch, requestor, cm, integration_manager)
+
+    # Then
+    assert requestor.urls == ["delta_1"]
+    assert cm.names == ["5.pdf"]
+    assert integration_manager.writes == [
+        ({"delta_link": "delta_2", "delta_from": "2021-01-01T00:00:00"}, None)
+    ]
+
+
+@pytest.mark.parametrize(
+    "delta_from, from_datetime, resumed",
+    [
+        ("2021-01-01T00:00:00", datetime(2021, 2, 1, tzinfo=timezone.utc), True),
+        ("2021-02-01T00:30:00+01:00", datetime(2021, 2, 1), True),
+        (
+            "2021-02-01T00:30:00",
+            datetime(2021, 2, 1, 1, tzinfo=timezone(timedelta(hours=1))),
+            False,
+        ),
+    ],
+)
+def test_outlook_delta_compares_naive_and_aware(
+    monkeypatch: Any, delta_from: str, from_datetime: datetime, resumed: bool
+) -> None:
+    """A stored delta_from and a requested from_datetime are compared in UTC, naive or not."""
+    # Given
+    requestor = MockRequestor(
+        [{"value": [], "@odata.deltaLink": "delta_2"}],
+        info={"delta_link": "delta_1", "delta_from": delta_from},
+    )
+    cm = MockConnectionManager()
+    integration_manager = MockIntegrationManager(requestor)
+
+    # When
+    _delta_sync(monkeypatch, requestor, cm, integration_manager, from_datetime)
+
+    # Then
+    assert (requestor.urls == ["delta_1"]) is resumed
+
+
+def test_outlook_delta_link_kept_until_written(monkeypatch: Any) -> None:
+    """If the attachments can't be written, the new deltaLink isn't stored."""
+    # Given
+    requestor = MockRequestor(
+        [{"value": [_delta_email("1")], "@odata.deltaLink": "delta_1"}]
+    )
+    cm = MockConnectionManager(fail=True)
+    integration_manager = MockIntegrationManager(requestor)
+
+    # When
+    with pytest.raises(ValueError):
+        _delta_sync(monkeypatch, requestor, cm, integration_manager)
+
+    # Then
+    assert integration_manager.writes == []
+
+
+def test_outlook_delta_recovers_from_expired_link(monkeypatch: Any) -> None:
+    """An expired stored link is dropped and the delta query started again from from_datetime."""
+    # Given
+    requestor = MockRequestor(
+        [
+            MockResponse({"error": {"code": "syncStateNotFound"}}, status_code=410),
+            {"value": [_delta_email("1")], "@odata.deltaLink": "delta_2"},
+        ],
+        info={"delta_link": "delta_1", "delta_from": "2021-01-01T00:00:00"},
+    )
+    cm = MockConnectionManager()
+    integration_manager = MockIntegrationManager(requestor)
+
+    # When
+    _delta_sync(monkeypatch, requestor, cm, integration_manager)
+
+    # Then
+    assert requestor.urls[0] == "delta_1"
+    assert "receivedDateTime ge 2021-02-01T00:00:00Z" in requestor.urls[1]
+    assert cm.names == ["1.pdf"]
+    assert integration_manager.writes == [
+        ({}, ["delta_link", "delta_from"]),
+        ({"delta_link": "delta_2", "delta_from": "2021-02-01T00:00:00+00:00"}, None),
+    ]
+
+
+def _history_sync(
+    monkeypatch: Any,
+    requestor: MockRequestor,
+    cm: MockConnectionManager,
+    integration_manager: MockIntegrationManager,
+) -> None:
+    """Run a history sync from 2021-02-01 against the mocks."""
+    monkeypatch.setattr(gmail_module, "im", integration_manager)
+    monkeypatch.setattr(pipeline, "cm", cm)
+    monkeypatch.setitem(gmail_module.app_config, "GMAIL_API_BATCH_REQUESTS", True)
+    Gmail().synchronise("harry", datetime(2021, 2, 1), "delta", None, MockProgress())
+
+
+def test_gmail_history_resumes_from_stored_id(monkeypatch: Any) -> None:
+    """Added messages are read from the stored history ID, keeping those with attachments."""
+    # Given
+    requestor = MockGmailRequestor(
+        [
+            {
+                "history": [
+                    {
+                        "messagesAdded": [
+                            {"message": {"id": "1"}},
+                            {"message": {"id": "2"}},
+                        ]
+                    },
+                    {"messagesDeleted": [{"message": {"id": "3"}}]},
+                    {"messagesAdded": [{"message": {"id": "1"}}]},
+                ],
+                "nextPageToken": "page_2",
+            },
+            {
+                "history": [{"messagesAdded": [{"message": {"id": "4"}}]}],
+                "historyId": "200",
+            },
+        ],
+        with_attachments=["1", "4"],
+        info={"history_id": "100"},
+    )
+    cm = MockConnectionManager()
+    integration_manager = MockIntegrationManager(requestor)
+
+    # When
+    _history_sync(monkeypatch, requestor, cm, integration_manager)
+
+    # Then
+    assert "users/me/history?startHistoryId=100" in requestor.urls[0]
+    assert "historyTypes=messageAdded" in requestor.urls[0]
+    assert "pageToken=page_2" in requestor.urls[1]
+    assert cm.names == ["1.pdf", "4.pdf"]
+    assert integration_manager.writes == [({"history_id": "200"}, None)]
+
+
+def test_gmail_history_id_kept_until_written(monkeypatch: Any) -> None:
+    """If the attachments can't be written, the new history ID isn't stored."""
+    # Given
+    requestor = MockGmailRequestor(
+        [
+            {
+                "history": [{"messagesAdded": [{"message": {"id": "1"}}]}],
+                "historyId": "200",
+            }
+        ],
+        with_attachments=["1"],
+        info={"history_id": "100"},
+    )
+    cm = MockConnectionManager(fail=True)
+    integration_manager = MockIntegrationManager(requestor)
+
+    # When
+    with pytest.raises(ValueError):
+        _history_sync(monkeypatch, requestor, cm, integration_manager)
+
+    # Then
+    assert integration_manager.writes == []
+
+
+def test_gmail_history_falls_back_to_query(monkeypatch: Any) -> None:
+    """An expired history ID falls back to a query bounded by from_datetime."""
+    # Given
+    requestor = MockGmailRequestor(
+        [
+            MockResponse({"error": {"code": 404}}, status_code=404),
+            {"historyId": "300"},
+            {"messages": [{"id": "5"}]},
+        ],
+        with_attachments=["5"],
+        info={"history_id": "100"},
+    )
+    cm = MockConnectionManager()
+    integration_manager = MockIntegrationManager(requestor)
+
+    # When
+    _history_sync(monkeypatch, requestor, cm, integration_manager)
+
+    # Then
+    assert "users/me/profile" in requestor.urls[1]
+    assert 'q="has:attachment after:1612137600"' in requestor.urls[2]
+    assert cm.names == ["5.pdf"]
+    assert integration_manager.writes == [({"history_id": "300"}, None)]